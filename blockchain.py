@@ -1,41 +1,238 @@
-import contextlib
+import bisect
+import concurrent.futures
 import hashlib
 import json
 import logging
+import os
 import sys
 import time
 import threading
-import requests
 
 from ecdsa import NIST256p
 from ecdsa import VerifyingKey
-
+from ecdsa import ellipticcurve
+
+import blockstore
+import codec
+import gossip
+import mempool
+import merkle
+import mining_engine
+import models
+import peer_client
+import scheduler
 import utils
 
 MINING_DIFFICULTY = 3
+# 作成するblockのversion（1: PoWでtransactionsを全てhashする，2: Merkle rootのheaderだけ）
+BLOCK_VERSION = 2
 MINING_SENDER = "THE BLOCKCHAIN"
 MINING_REWARD = 1.0
+# transactionがなくてもminingする間隔（size・ageで始まらなかった場合）
 MINING_TIMER_SEC = 20
+# mempoolがこの数になったらすぐにminingする
+MINING_TRIGGER_SIZE = 100
+# 最も古いtransactionがこの秒数待ったらminingする
+MINING_TRIGGER_AGE_SEC = 5
+# transactionのないblock（mining報酬だけ）をminingするか
+MINING_EMPTY_BLOCKS = True
+MINING_MODE = "serial"
+MINING_WORKERS = None
 
 BLOCKCHAIN_PORT_RANGE = (5000, 5003)
 NEIGHBOURS_IP_RANGE_NUM = (0, 1)
 BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC = 20
+BLOCKCHAIN_CONSENSUS_SEC = 60
+# nodeの検索・consensusの間隔をずらす割合（nodeどうしで同じ時刻に集まらないようにする）
+SCHEDULER_JITTER = 0.1
+CHAIN_SYNC_PAGE_SIZE = 500
+HEADERS_PAGE_SIZE = 2000
+MERKLE_TREE_CACHE_SIZE = 256
+BLOCK_MAX_TRANSACTIONS = None
+VERIFYING_KEY_CACHE_SIZE = 1024
+VERIFYING_KEY_PRECOMPUTE_HITS = 8
+VERIFIED_SIGNATURE_CACHE_SIZE = 65536
+CHAIN_VALIDATION_STRICT = True
+SIGNATURE_VERIFY_WORKERS = None
+SIGNATURE_VERIFY_CHUNK_SIZE = 64
+SIGNATURE_VERIFY_POOL_MIN = 128
+SIGNATURE_VERIFY_START_METHOD = "spawn"
+TRANSACTION_REQUIRED = (
+    "sender_blockchain_address",
+    "recipient_blockchain_address",
+    "value",
+    "sender_public_key",
+    "signature")
+CONSENSUS_PEER_TIMEOUT_SEC = 3
+CONSENSUS_DEADLINE_SEC = 10
+# binaryに対応していないnodeはjsonを返す
+CHAIN_ACCEPT = f"{codec.CONTENT_TYPE}, {codec.JSON_CONTENT_TYPE};q=0.5"
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 
+def transaction_message(transaction):
+    """
+    署名の対象となるmessage
+    sender_public_key, signatureを除いた3つのkeyのtransactionをSHA-256でハッシュ化する
+
+    Parameters
+    ----------
+    transaction: dict
+
+    Returns
+    -------
+    message : bytes
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(str(utils.sorted_dict_by_key({
+        "sender_blockchain_address": transaction["sender_blockchain_address"],
+        "recipient_blockchain_address": transaction["recipient_blockchain_address"],
+        "value": float(transaction["value"])
+    })).encode("utf-8"))
+    return sha256.digest()
+
+
+def _verify_signatures(items, get_verifying_key=None):
+    """
+    署名を1件ずつ確認する（workerプロセスとBlockChain.verify_signaturesで共通）
+
+    Parameters
+    ----------
+    items: list of tuple
+        [(message, signature, sender_public_key)]
+
+    get_verifying_key: callable
+        public keyからVerifyingKeyを返す．Noneの場合はこの呼び出しの中で使い回す
+
+    Returns
+    -------
+    results : list of bool
+    """
+    if get_verifying_key is None:
+        verifying_keys = {}
+
+        def get_verifying_key(sender_public_key):
+            verifying_key = verifying_keys.get(sender_public_key)
+            if verifying_key is None:
+                verifying_key = VerifyingKey.from_string(
+                    bytes().fromhex(sender_public_key), curve=NIST256p)
+                verifying_keys[sender_public_key] = verifying_key
+            return verifying_key
+
+    results = []
+    for message, signature, sender_public_key in items:
+        try:
+            results.append(bool(get_verifying_key(sender_public_key).verify(
+                bytes().fromhex(signature), message)))
+        except Exception:
+            results.append(False)
+    return results
+
+
+class MiningPolicy(object):
+    """
+    miningを始める条件
+
+    ・size: mempoolのtransactionがsize個以上
+    ・age: 最も古いtransactionがage秒以上待っている
+    ・timer: 前回のminingからinterval秒経った（transactionがない場合も）
+
+    Attributes
+    ----------
+    size : int
+
+    age : float
+
+    interval : float
+
+    allow_empty : bool
+        Falseの場合はtransactionのないblockをminingしない
+
+    See Also
+    --------
+    >>> policy = MiningPolicy(size=10, age=5, interval=20)
+    >>> policy.reason(10, 0.1, 1), policy.reason(1, 5.0, 1), policy.reason(0, None, 20), policy.reason(1, 0.1, 1)
+    ('size', 'age', 'timer', None)
+    >>> MiningPolicy(allow_empty=False).reason(0, None, 60) is None
+    True
+    """
+
+    def __init__(self, size=MINING_TRIGGER_SIZE, age=MINING_TRIGGER_AGE_SEC,
+                 interval=MINING_TIMER_SEC, allow_empty=MINING_EMPTY_BLOCKS):
+        self.size = size
+        self.age = age
+        self.interval = interval
+        self.allow_empty = allow_empty
+
+    def reason(self, pending, oldest_age, since_last):
+        """
+        miningを始める理由
+
+        Parameters
+        ----------
+        pending : int
+            mempoolのtransaction数
+
+        oldest_age : float
+            最も古いtransactionが待っている秒数．空の場合はNone
+
+        since_last : float
+            前回のminingからの秒数
+
+        Returns
+        -------
+        str
+            "size", "age", "timer"．始めない場合はNone
+        """
+        if pending >= self.size:
+            return "size"
+        if oldest_age is not None and oldest_age >= self.age:
+            return "age"
+        if since_last >= self.interval and (pending or self.allow_empty):
+            return "timer"
+        return None
+
+    def delay(self, pending, oldest_age):
+        """
+        次にminingを確認するまでの秒数．transactionがない場合はNone
+        """
+        if not pending:
+            return None
+        if pending >= self.size:
+            return 0.0
+        return max(0.0, self.age - oldest_age)
+
+
 class BlockChain(object):
     """
     blockchainを構成する機能
 
     Attributes
     ----------
-    transaction_pool : list of dicts
+    transaction_pool : mempool.Mempool
         mining前にtransactionを追加する場所
+        transaction idでの検索，senderごとの未承認の送金額，上限と古い順の削除
 
     chain : list of dicts
-        block chain
+        block chain．block_storeから読み込んだ場合はblockstore.StoredSequence
+        （保存済みのblockは必要な時に読む）
+
+    balances : dict
+        blockchain_addressごとの残高．chainの更新に合わせて差分で更新する
+
+    block_hashes : list of str
+        chainの各blockのhash．blockの作成時・受け入れ時に1度だけ計算する
+        block_storeから読み込んだ場合はindexから読むblockstore.StoredSequence
+
+    block_heights : dict
+        block hash -> height
+        Noneの場合はまだ作っていない（起動時には作らず，最初に使う時に作る）
+
+    address_index : dict
+        blockchain_address -> そのaddressを含むtransactionの[(height, blockでの位置)]
+        Noneの場合はまだ作っていない（起動時には作らず，最初のget_address_proofsで作る）
 
     neighbours : dict
         block chain serverとその情報
@@ -47,14 +244,36 @@ class BlockChain(object):
         wallet serverのlistenしているポート
         複数サーバーの代わりにポートを複数開ける
 
-    mining_semaphore : threading
-        並列処理をするプロセスが1つだけ
+    scheduler : scheduler.Scheduler
+        mining・nodeの検索・consensusを定期的に実行する
 
-    sync_neighbours_semaphore : threading
-        付近のノードを同期させる
+    mining_policy : MiningPolicy
+        self-miningを始める条件（mempoolのsize・age，timer）
+
+    mining_engine : mining_engine.SerialEngine
+        nonceを探索するengine（serial or parallel）
+
+    peer_client : peer_client.PeerClient
+        他のnodeとの通信（nodeごとのconnection pool，timeout，retry）
+
+    broadcaster : gossip.Broadcaster
+        transaction・blockの同期をbackgroundで行う
+
+    verifying_key_cache : utils.LRUCache
+        public key -> [VerifyingKey, 使用回数]
+
+    signature_cache : utils.LRUCache
+        確認済みの(transactionのhash, signature, public key)
+
+    block_store : blockstore.BlockStore
+        chainをdiskに保存する場所．Noneの場合はmemoryだけに持つ
+
+    snapshot_store : snapshot.SnapshotStore
+        残高のsnapshotを保存する場所．Noneの場合は作らない
     """
 
-    def __init__(self, blockchain_address=None, port=None):
+    def __init__(self, blockchain_address=None, port=None, block_store=None,
+                 snapshot_store=None):
         """
         blockchainを構成する機能
 
@@ -65,20 +284,662 @@ class BlockChain(object):
 
         port : int
             wallet serverのポート番号
+
+        block_store : blockstore.BlockStore
+            保存済みのblockがある場合はgenesis blockを作らずに読み込む
+
+        snapshot_store : snapshot.SnapshotStore
+            読み込み時は最新のsnapshotより後のblockだけを残高に反映する
         """
-        self.transaction_pool = []
-        self.chain = []
+        self._transaction_pool = mempool.Mempool(mining_sender=MINING_SENDER)
+        self._chain = []
+        self.block_hashes = []
+        self.block_heights = {}
+        self.balances = {}
+        self.address_index = {}
+        self.merkle_trees = utils.LRUCache(MERKLE_TREE_CACHE_SIZE)
         self.neighbours = []
-        self.create_block(0, self.hash({}))
+        self.peer_client = peer_client.PeerClient()
+        self.verifying_key_cache = utils.LRUCache(VERIFYING_KEY_CACHE_SIZE)
+        self.signature_cache = utils.LRUCache(VERIFIED_SIGNATURE_CACHE_SIZE)
+        self._verify_executor = None
+        self._verify_executor_lock = threading.Lock()
+        # chain・block_hashes・balances・address_indexの変更（mining・consensusは別のthread）
+        self._chain_lock = threading.RLock()
+        self.broadcaster = gossip.Broadcaster(
+            self.peer_client, lambda: self.neighbours)
+        self.block_store = block_store
+        self.snapshot_store = snapshot_store
+        if block_store is not None and len(block_store):
+            self.load_block_store()
+        else:
+            self.create_block(0, self.hash({}))
         self.blockchain_address = blockchain_address
         self.port = port
-        self.mining_semaphore = threading.Semaphore(1)
-        self.sync_neighbours_semaphore = threading.Semaphore(1)
+        self.scheduler = scheduler.Scheduler()
+        self.mining_policy = MiningPolicy()
+        # 前回のminingの時刻（time.monotonic）．Noneの場合は最初のtimerですぐにminingする
+        self._last_mined = None
+        self._transaction_pool.on_add = self._on_transaction_added
+        self.mining_engine = mining_engine.create_engine(
+            MINING_MODE, MINING_WORKERS)
+
+    @property
+    def transaction_pool(self):
+        """
+        mining前のtransaction
+        listを代入した場合は中身を入れ替える
+        """
+        return self._transaction_pool
+
+    @transaction_pool.setter
+    def transaction_pool(self, transactions):
+        transactions = list(transactions)
+        self._transaction_pool.clear()
+        for transaction in transactions:
+            self._transaction_pool.add(transaction)
+
+    @property
+    def chain(self):
+        """
+        block chain
+        代入した場合はchainを丸ごと置き換え，残高を再計算する
+        """
+        return self._chain
+
+    @chain.setter
+    def chain(self, chain):
+        with self._chain_lock:
+            self._chain = []
+            self.block_hashes = []
+            self.block_heights = {}
+            self.balances = {}
+            self.address_index = None
+            if self.block_store is not None:
+                self.block_store.truncate(0)
+            for block in chain:
+                self._append_block(block)
+
+    @property
+    def tip_hash(self):
+        """
+        最後のblockのhash
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.tip_hash == block_chain.hash(block_chain.chain[-1])
+        True
+        """
+        # chainの置き換え中（block_hashesが空になることがある）は待つ
+        with self._chain_lock:
+            return self.block_hashes[-1]
+
+    def get_tip(self):
+        """
+        最後のblockのheightとhash（同じ時点のもの）
+
+        Returns
+        -------
+        (height, tip_hash) : tuple
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.get_tip() == (0, block_chain.tip_hash)
+        True
+        """
+        with self._chain_lock:
+            return len(self.block_hashes) - 1, self.block_hashes[-1]
+
+    def _append_block(self, block, block_hash=None, persist=True):
+        """
+        blockをchainに追加し，hashと残高を更新する
+
+        Parameters
+        ----------
+        block: dict
+
+        block_hash: str
+            計算済みのhash．Noneの場合は計算する
+
+        persist: bool
+            block_storeに保存するか
+        """
+        block = models.freeze_block(block, block_hash)
+        if block_hash is None:
+            block_hash = self.hash(block)
+        if persist and self.block_store is not None:
+            self.block_store.append(block, block_hash)
+        height = len(self._chain)
+        if self.block_heights is not None:
+            self.block_heights[block_hash] = height
+        self._chain.append(block)
+        self.block_hashes.append(block_hash)
+        self._apply_block(block)
+        self._index_addresses(height, block)
+        if (persist and self.snapshot_store is not None
+                and self.snapshot_store.should_save(height)):
+            self.snapshot_store.save(height, block_hash, self.balances)
+
+    def load_block_store(self):
+        """
+        block_storeに保存されたchainを読み込む
+        hashはindexに保存されたものを使い，再計算・検証はしない
+        snapshot_storeがある場合はchainと一致する最新のsnapshotから残高を読み込み，
+        それより後のblockだけを反映する
+        続きは通常のresolve_conflictsで他のnodeから取得する
+
+        See Also
+        --------
+        >>> import os
+        >>> import tempfile
+        >>> import blockstore
+        >>> import snapshot
+        >>> path = tempfile.mkdtemp()
+        >>> def open_stores():
+        ...     return {"blockchain_address": "miner", "block_store": blockstore.BlockStore(path),
+        ...             "snapshot_store": snapshot.SnapshotStore(os.path.join(path, "snapshots"), interval=2)}
+        >>> block_chain = BlockChain(**open_stores())
+        >>> for _ in range(2):
+        ...     _ = block_chain.mining()
+        >>> block_chain.snapshot_store.heights()
+        [1]
+        >>> block_chain.block_store.close()
+        >>> restarted = BlockChain(**open_stores())
+        >>> restarted.chain == block_chain.chain, restarted.tip_hash == block_chain.tip_hash
+        (True, True)
+        >>> restarted.balances == block_chain.balances
+        True
+        >>> restarted.address_index is None, restarted.block_heights is None
+        (True, True)
+        >>> restarted.get_address_proofs("miner") == block_chain.get_address_proofs("miner")
+        True
+        >>> restarted.get_blocks(block_chain.block_hashes[1])[0]
+        2
+        """
+        started = time.perf_counter()
+        store = self.block_store
+
+        def read_block(height):
+            return models.freeze_block(store.read(height), store.block_hash(height))
+
+        # hash・tipはindexから読み，blockは必要な時に読む
+        length = len(store)
+        self._chain = blockstore.StoredSequence(read_block, length)
+        self.block_hashes = blockstore.StoredSequence(store.block_hash, length)
+        # 全blockの走査になるので起動時には作らない
+        self.block_heights = None
+        self.address_index = None
+
+        snapshot = None
+        if self.snapshot_store is not None:
+            snapshot = self.snapshot_store.latest(
+                lambda height: store.block_hash(height) if height < length else None)
+        if snapshot is None:
+            start_height = 0
+            self.balances = {}
+        else:
+            start_height = snapshot["height"] + 1
+            self.balances = dict(snapshot["balances"])
+        # snapshotより後のblockだけを読んで反映する
+        for height in range(start_height, length):
+            self._apply_block(self._chain[height])
+
+        logger.info({
+            "action": "load_block_store",
+            "path": store.path,
+            "height": length,
+            "snapshot_height": None if snapshot is None else snapshot["height"],
+            "replayed": length - start_height,
+            "elapsed": time.perf_counter() - started
+        })
+
+    def get_block_height(self, block_hash):
+        """
+        block hashのheight．chainにない場合はNone
+        block_heightsがない場合（起動直後）はここで作る
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.get_block_height(block_chain.tip_hash), block_chain.get_block_height("unknown")
+        (0, None)
+        """
+        with self._chain_lock:
+            if self.block_heights is None:
+                self.block_heights = {
+                    block_hash: height
+                    for height, block_hash in enumerate(self.block_hashes)}
+            return self.block_heights.get(block_hash)
+
+    def get_blocks(self, since=None, limit=None):
+        """
+        sinceより後のblockを返す
+
+        Parameters
+        ----------
+        since: int or str
+            height（int）またはblock hash（str）．Noneの場合はgenesis blockから
+
+        limit: int
+            返すblockの最大数
+
+        Returns
+        -------
+        (start_height, blocks) : tuple
+            blocks[0]のheightとblockのlist．sinceのhashが見つからない場合は(None, [])
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> _ = block_chain.mining()
+        >>> _ = block_chain.mining()
+        >>> start_height, blocks = block_chain.get_blocks(0, limit=1)
+        >>> start_height, blocks == block_chain.chain[1:2]
+        (1, True)
+        >>> start_height, blocks = block_chain.get_blocks(block_chain.block_hashes[1])
+        >>> start_height, len(blocks)
+        (2, 1)
+        >>> block_chain.get_blocks("unknown")
+        (None, [])
+        """
+        if since is None:
+            start_height = 0
+        elif isinstance(since, int):
+            start_height = max(since + 1, 0)
+        else:
+            height = self.get_block_height(since)
+            if height is None:
+                return None, []
+            start_height = height + 1
+        end_height = None if limit is None else start_height + limit
+        return start_height, self._chain[start_height:end_height]
+
+    def _apply_block(self, block, sign=1):
+        """
+        blockのtransactionを残高に反映する
+
+        Parameters
+        ----------
+        block: dict
+
+        sign: int
+            1: 反映，-1: 取り消し（rollback）
+        """
+        balances = self.balances
+        for transaction in block["transactions"]:
+            value = sign * float(transaction["value"])
+            recipient = transaction["recipient_blockchain_address"]
+            sender = transaction["sender_blockchain_address"]
+            balances[recipient] = balances.get(recipient, 0.0) + value
+            balances[sender] = balances.get(sender, 0.0) - value
+
+    def _revert_block(self, block):
+        self._apply_block(block, sign=-1)
+
+    def _index_addresses(self, height, block):
+        address_index = self.address_index
+        if address_index is None:
+            return
+        for position, transaction in enumerate(block["transactions"]):
+            for key in ("sender_blockchain_address", "recipient_blockchain_address"):
+                entries = address_index.setdefault(transaction[key], [])
+                entry = (height, position)
+                # 自分自身への送金は1回だけ
+                if not entries or entries[-1] != entry:
+                    entries.append(entry)
+
+    def _unindex_addresses(self, fork_height, block):
+        """
+        fork_height以降のentryを削除する（entryはheightの順）
+        """
+        if self.address_index is None:
+            return
+        for transaction in block["transactions"]:
+            for key in ("sender_blockchain_address", "recipient_blockchain_address"):
+                entries = self.address_index.get(transaction[key])
+                while entries and entries[-1][0] >= fork_height:
+                    entries.pop()
+                if entries == []:
+                    del self.address_index[transaction[key]]
+
+    def _build_address_index(self):
+        """
+        chain全体からaddress_indexを作る（最初のget_address_proofsの時だけ）
+        """
+        started = time.perf_counter()
+        self.address_index = {}
+        for height, block in enumerate(self._chain):
+            self._index_addresses(height, block)
+        logger.info({
+            "action": "build_address_index",
+            "addresses": len(self.address_index),
+            "elapsed": time.perf_counter() - started
+        })
+
+    def get_headers(self, since=None, limit=None):
+        """
+        sinceより後のblockのheader
+        version 2はmodels.block_header，version 1はheaderだけでは確認できないのでblock全体
+
+        Parameters
+        ----------
+        since: int or str
+            get_blocksと同じ
+
+        limit: int
+
+        Returns
+        -------
+        (start_height, headers) : tuple
+            sinceのhashが見つからない場合は(None, [])
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> _ = block_chain.mining()
+        >>> start_height, headers = block_chain.get_headers(0)
+        >>> start_height, sorted(headers[0])
+        (1, ['merkle_root', 'nonce', 'previous_hash', 'timestamp', 'version'])
+        >>> models.block_hash(headers[0]) == block_chain.tip_hash
+        True
+        """
+        start_height, blocks = self.get_blocks(since, limit)
+        headers = [
+            models.block_header(block) if models.block_version(block) >= 2
+            else models.to_dict(block)
+            for block in blocks
+        ]
+        return start_height, headers
+
+    def _merkle_tree(self, height):
+        block_hash = self.block_hashes[height]
+        tree = self.merkle_trees.get(block_hash)
+        if tree is None:
+            tree = merkle.MerkleTree(self._chain[height]["transactions"])
+            self.merkle_trees.put(block_hash, tree)
+        return tree
+
+    def get_address_proofs(self, blockchain_address, since=-1):
+        """
+        blockchain_addressを含むtransactionとblockに含まれることの証明
+        chainを走査せずにaddress_indexから探す
+
+        Parameters
+        ----------
+        blockchain_address: str
+
+        since: int
+            このheightより後のblockだけ
+
+        Returns
+        -------
+        proofs : list of dicts
+            {"height", "block_hash", "index", "transaction", "proof"}
+            version 1のblockはproofの代わりに"block"（block全体）
+
+        See Also
+        --------
+        >>> block_chain = BlockChain(blockchain_address="miner")
+        >>> _ = block_chain.mining()
+        >>> [entry] = block_chain.get_address_proofs("miner")
+        >>> entry["height"], entry["transaction"]["value"]
+        (1, 1.0)
+        >>> merkle.verify_proof(entry["transaction"], entry["proof"], block_chain.chain[1]["merkle_root"])
+        True
+        >>> block_chain.get_address_proofs("miner", since=1)
+        []
+        """
+        with self._chain_lock:
+            if self.address_index is None:
+                self._build_address_index()
+            entries = self.address_index.get(blockchain_address, [])
+            # entryはheightの順なのでsinceより後だけを二分探索で取り出す
+            start = bisect.bisect_left(entries, (since + 1, 0))
+            proofs = []
+            for height, index in entries[start:]:
+                block = self._chain[height]
+                entry = {
+                    "height": height,
+                    "block_hash": self.block_hashes[height],
+                    "index": index,
+                    "transaction": models.to_dict(block["transactions"][index])
+                }
+                if models.block_version(block) >= 2:
+                    entry["proof"] = self._merkle_tree(height).proof(index)
+                else:
+                    entry["block"] = models.to_dict(block)
+                proofs.append(entry)
+            return proofs
+
+    def replace_chain(self, chain, fork_height=None, block_hashes=None):
+        """
+        chainを置き換える
+        fork_height以降のblockだけrollbackして新しいblockを反映する
+
+        Parameters
+        ----------
+        chain: list of dicts
+
+        fork_height: int
+            最初に異なるblockのindex．Noneの場合は先頭から比較して求める
+
+        block_hashes: list of str
+            chainの各blockの計算済みのhash
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.transaction_pool = [{"recipient_blockchain_address": "A", "sender_blockchain_address": MINING_SENDER, "value": 3.0}]
+        >>> _ = block_chain.create_block(0, "hash")
+        >>> new_chain = block_chain.chain[:1] + [{"nonce": 0, "previous_hash": "hash", "timestamp": 0.0, "transactions": [{"recipient_blockchain_address": "B", "sender_blockchain_address": MINING_SENDER, "value": 2.0}]}]
+        >>> block_chain.replace_chain(new_chain)
+        >>> block_chain.calculate_total_amount("A"), block_chain.calculate_total_amount("B")
+        (0.0, 2.0)
+        """
+        if fork_height is None:
+            fork_height = 0
+            if block_hashes:
+                pairs = zip(self.block_hashes, block_hashes)
+            else:
+                pairs = zip(self._chain, chain)
+            for current, new in pairs:
+                if current != new:
+                    break
+                fork_height += 1
+
+        self._replace_blocks(
+            fork_height, chain[fork_height:],
+            block_hashes[fork_height:] if block_hashes else None)
+
+    def _replace_blocks(self, fork_height, blocks, block_hashes=None):
+        """
+        fork_height以降のblockをrollbackし，blocksを追加する
+
+        Parameters
+        ----------
+        fork_height: int
+            共通のblock数
+
+        blocks: list of dicts
+            fork_height以降の新しいblock
+
+        block_hashes: list of str
+            blocksの計算済みのhash
+        """
+        with self._chain_lock:
+            for block in reversed(self._chain[fork_height:]):
+                self._revert_block(block)
+            if self.block_heights is not None:
+                for block_hash in self.block_hashes[fork_height:]:
+                    self.block_heights.pop(block_hash, None)
+            for block in self._chain[fork_height:]:
+                self._unindex_addresses(fork_height, block)
+            del self._chain[fork_height:]
+            del self.block_hashes[fork_height:]
+            if self.block_store is not None:
+                self.block_store.truncate(fork_height)
+            for i, block in enumerate(blocks):
+                self._append_block(block, block_hashes[i] if block_hashes else None)
+                # 新しいblockに含まれたtransactionはpoolから除く
+                self.transaction_pool.remove_transactions(block["transactions"])
+
+    def find_fork_height(self, blocks, start_height=0):
+        """
+        自身のchainとの共通の祖先を探す
+        blocks[i]のprevious_hashが自身のblock_hashes[start_height + i - 1]と
+        一致する最も高いheightを返す（tipから順に比較するのでforkの長さ分だけ比較する）
+
+        Parameters
+        ----------
+        blocks: list of dicts
+            blocks[i]はheight start_height + iのblock
+
+        start_height: int
+
+        Returns
+        -------
+        fork_height : int
+            共通のblock数．このheight以降のblockが異なる．見つからない場合はNone
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> _ = block_chain.mining()
+        >>> other = BlockChain()
+        >>> other.chain = block_chain.chain
+        >>> _ = other.mining()
+        >>> block_chain.find_fork_height(other.chain)
+        2
+        >>> block_chain.find_fork_height(BlockChain().chain) is None
+        True
+        """
+        top = min(start_height + len(blocks) - 1, len(self._chain))
+        for height in range(top, max(start_height, 1) - 1, -1):
+            block = blocks[height - start_height]
+            if block["previous_hash"] == self.block_hashes[height - 1]:
+                return height
+        return None
+
+    def _validate_candidate(self, blocks, start_height=0, strict=False):
+        """
+        共通の祖先以降のblockだけvalidation checkを行う
+
+        Parameters
+        ----------
+        blocks: list of dicts
+            blocks[i]はheight start_height + iのblock
+
+        start_height: int
+
+        strict: bool
+            Trueの場合は署名も確認する
+
+        Returns
+        -------
+        (fork_height, block_hashes) : tuple
+            block_hashesはfork_height以降のblockのhash．
+            validでない場合block_hashesはNone
+        """
+        fork_height = self.find_fork_height(blocks, start_height)
+        if fork_height is None:
+            # 共通のblockがない場合はgenesis blockから確認する
+            if start_height != 0:
+                return None, None
+            return 0, self._valid_chain_hashes(blocks, strict)
+        return fork_height, self._valid_blocks_hashes(
+            blocks[fork_height - start_height:],
+            self.block_hashes[fork_height - 1], strict)
+
+    def set_mining_engine(self, mode, workers=None):
+        """
+        miningのengineを切り替える
+
+        Parameters
+        ----------
+        mode: str
+            "serial" or "parallel"
+
+        workers: int
+            parallelの場合のworkerプロセス数
+
+        Raises
+        ------
+        ValueError
+            modeが不明な場合
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.set_mining_engine("parallel", 2)
+        >>> engine = block_chain.mining_engine
+        >>> engine.workers
+        2
+        >>> block_chain.set_mining_engine("parallel", 2)
+        >>> block_chain.mining_engine is engine
+        True
+        >>> block_chain.set_mining_engine("fast")
+        Traceback (most recent call last):
+            ...
+        ValueError: unknown mining mode: fast
+        """
+        current = self.mining_engine
+        if current.mode == mode and (
+                mode != "parallel"
+                or current.workers == (workers or os.cpu_count() or 1)):
+            # 同じ設定の場合はworkerプロセスを作り直さない
+            return
+        engine = mining_engine.create_engine(mode, workers)
+        self.mining_engine.close()
+        self.mining_engine = engine
 
     def run(self):
         self.sync_neighbours()
         self.resolve_conflicts()
+        self.start_consensus()
         self.start_mining()
+        self.start_block_store_sync()
+
+    def start_block_store_sync(self):
+        """
+        fsyncが"interval"の場合，blockの追加が止まっても最後のblockを
+        BLOCKSTORE_FSYNC_INTERVAL_SEC以内にfsyncする
+        """
+        if self.block_store is None or self.block_store.fsync != "interval":
+            return False
+        return self._schedule(
+            "block_store_sync", self.block_store.sync_if_due,
+            blockstore.BLOCKSTORE_FSYNC_INTERVAL_SEC)
+
+    def _schedule(self, name, func, interval, jitter=0.0, delay=0.0):
+        """
+        schedulerにjobを追加して開始する．既にある場合は何もしない
+
+        Returns
+        -------
+        bool
+            追加した場合はTrue
+        """
+        added = self.scheduler.add_job(name, func, interval, jitter, delay)
+        self.scheduler.start()
+        return added
+
+    def shutdown(self):
+        """
+        定期的な処理を止め，実行中の処理と送信待ちのgossipが終わるのを待つ
+        block_storeはdiskに書き出してから閉じる
+        """
+        self.scheduler.stop()
+        self.broadcaster.stop()
+        self.mining_engine.close()
+        with self._verify_executor_lock:
+            if self._verify_executor is not None:
+                self._verify_executor.shutdown()
+                self._verify_executor = None
+        if self.block_store is not None:
+            with self._chain_lock:
+                self.block_store.close()
 
     def set_neighbours(self):
         """
@@ -102,6 +963,8 @@ class BlockChain(object):
             utils.get_host(), self.port,
             NEIGHBOURS_IP_RANGE_NUM[0], NEIGHBOURS_IP_RANGE_NUM[1],
             BLOCKCHAIN_PORT_RANGE[0], BLOCKCHAIN_PORT_RANGE[1])
+        # いなくなったnodeのconnectionを閉じる
+        self.peer_client.retain(self.neighbours)
         logger.info({
             "action": "set_neighbours",
             "neighbours": self.neighbours
@@ -109,25 +972,31 @@ class BlockChain(object):
 
     def sync_neighbours(self):
         """
-        set_neighboursを並列処理する
-        BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SECごとにsync_neighbours()を呼び出す
+        set_neighboursを行い，その後はBLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SECごとに
+        schedulerで行う
 
         See Also
         ----------
         BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC : int
         """
-        is_acquire = self.sync_neighbours_semaphore.acquire(blocking=False)
-        if is_acquire:
-            with contextlib.ExitStack() as stack:
-                stack.callback(self.sync_neighbours_semaphore.release)
-                self.set_neighbours()
-                loop = threading.Timer(
-                    BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC, self.sync_neighbours
-                )
-                loop.start()
+        self.set_neighbours()
+        self._schedule(
+            "sync_neighbours", self.set_neighbours,
+            BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC, SCHEDULER_JITTER,
+            delay=BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC)
+
+    def start_consensus(self):
+        """
+        BLOCKCHAIN_CONSENSUS_SECごとにresolve_conflictsを行う
+        （gossipのconsensusを受け取れなかった場合もchainを追いつかせる）
+        """
+        return self._schedule(
+            "consensus", self.resolve_conflicts,
+            BLOCKCHAIN_CONSENSUS_SEC, SCHEDULER_JITTER,
+            delay=BLOCKCHAIN_CONSENSUS_SEC)
 
     # blockの作成
-    def create_block(self, nonce, previous_hash):
+    def create_block(self, nonce, previous_hash, transactions=None):
         """
         Blockを作成する
 
@@ -137,9 +1006,13 @@ class BlockChain(object):
 
         previous_hash: str
 
+        transactions: list of dicts
+            blockに含めるtransaction．Noneの場合はtransaction_poolの全て
+
         Returns
         -------
-        block : dict
+        block : models.Block
+            BLOCK_VERSIONが2以降の場合はmerkle_rootとversionを含む
 
         See Also
         --------
@@ -155,19 +1028,25 @@ class BlockChain(object):
         >>> block_2['previous_hash']
         'hash 2'
         """
-        block = utils.sorted_dict_by_key({
+        if transactions is None:
+            transactions = self.transaction_pool.copy()
+        block = {
             "timestamp": time.time(),
-            "transactions": self.transaction_pool,
+            "transactions": transactions,
             "nonce": nonce,
             "previous_hash": previous_hash
-        })
-        self.chain.append(block)
-        self.transaction_pool = []
-
-        # 同期させる
-        for node in self.neighbours:
-            requests.delete(f"http://{node}/transactions")
-
+        }
+        if BLOCK_VERSION >= 2:
+            block["merkle_root"] = merkle.merkle_root(transactions)
+            block["version"] = BLOCK_VERSION
+        block = utils.sorted_dict_by_key(block)
+        with self._chain_lock:
+            self._append_block(block)
+            block = self._chain[-1]
+            self.transaction_pool.remove_transactions(transactions)
+
+        # 他のnodeのmempoolは消さない（blockに含まれたtransactionは
+        # consensusでchainを置き換えた時にそれぞれのnodeが取り除く）
         return block
 
     def hash(self, block):
@@ -196,8 +1075,12 @@ class BlockChain(object):
         >>> hashlib.sha256(json.dumps(block2, sort_keys=True).encode()).hexdigest()
         'd8497d9d82770a70729261095aa98f7ef5154d7af499f8037b6ca250296785a6'
         """
-        sorted_block = json.dumps(block, sort_keys=True)
-        return hashlib.sha256(sorted_block.encode()).hexdigest()
+        if isinstance(block, models.Block):
+            return block.hash()
+        if models.block_version(block) >= 2:
+            # transactionsはmerkle_rootとしてheaderに含まれる
+            return models.block_hash(block)
+        return hashlib.sha256(models.canonical_json(block)).hexdigest()
 
     def add_transaction(
         self, sender_blockchain_address, recipient_blockchain_address, value,
@@ -206,6 +1089,7 @@ class BlockChain(object):
         """
         transactionを追加する．
         ex. wallet A -> wallet B に 1.0送金．
+        senderがMINING_SENDERのtransactionは追加しない（mining報酬はmining()が追加する）
 
         Parameters
         ----------
@@ -228,37 +1112,258 @@ class BlockChain(object):
 
         See Also
         --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.add_transaction(MINING_SENDER, "A", 100.0)
+        False
         """
         transaction = utils.sorted_dict_by_key({
             "sender_blockchain_address": sender_blockchain_address,
             "recipient_blockchain_address": recipient_blockchain_address,
             "value": float(value)
         })
-        # miningの場合
+        # mining報酬はmining()だけが追加する（署名がないので外からは受け付けない）
         if sender_blockchain_address == MINING_SENDER:
-            self.transaction_pool.append(transaction)
-            return True
+            logger.error(
+                {'action': 'add_transaction', 'error': 'invalid_sender'})
+            return False
 
-        # mining以外の場合
         if self.verify_transaction_signature(
                 sender_public_key, signature, transaction):
 
+            # chainを受け取ったnodeが署名を確認できるように含める
+            signed_transaction = self._signed_transaction(
+                transaction, sender_public_key, signature)
+            # 残高の確認から追加までの間にchainが置き換わらないようにする
+            with self._chain_lock:
+                if mempool.transaction_id(signed_transaction) in self.transaction_pool:
+                    logger.error(
+                        {'action': 'add_transaction', 'error': 'duplicate'})
+                    return False
+
+                # 送り金がない場合（未承認の送金を差し引く）
+                balance = self.calculate_total_amount(sender_blockchain_address)
+                pending = self.transaction_pool.pending_debit(sender_blockchain_address)
+                if balance - pending < float(value):
+                    logger.error(
+                        {'action': 'add_transaction', 'error': 'no_value'})
+                    return False
+
+                return self.transaction_pool.add(signed_transaction)
+        return False
+
+    @staticmethod
+    def _signed_transaction(transaction, sender_public_key, signature):
+        return utils.sorted_dict_by_key(dict(
+            transaction,
+            sender_public_key=sender_public_key,
+            signature=signature))
+
+    def add_transactions(self, transactions):
+        """
+        transactionをまとめて追加する．
+
+        1. 署名をまとめて確認する（verify_signatures．件数が多い場合はプロセスプールで並列に確認する）
+        2. pool内の未承認の送金（batch内で追加したものを含む）を差し引いた残高で確認する
+
+        Parameters
+        ----------
+        transactions: list of dicts
+            TRANSACTION_REQUIREDを含むdict
+
+        Returns
+        -------
+        errors : list
+            transactionごとの結果．追加された場合はNone，
+            追加されなかった場合は理由（"missing_values", "invalid_value",
+            "invalid_sender", "invalid_signature", "no_value", "duplicate"）
+
+        See Also
+        --------
+        >>> import wallet
+        >>> wallet_A = wallet.Wallet()
+        >>> wallet_B = wallet.Wallet()
+        >>> block_chain = BlockChain(blockchain_address=wallet_A.blockchain_address)
+        >>> _ = block_chain.mining()
+        >>> def sign(value):
+        ...     t = wallet.Transaction(wallet_A.private_key, wallet_A.public_key, wallet_A.blockchain_address, wallet_B.blockchain_address, value)
+        ...     return {"sender_blockchain_address": wallet_A.blockchain_address, "recipient_blockchain_address": wallet_B.blockchain_address,
+        ...             "value": value, "sender_public_key": wallet_A.public_key, "signature": t.generate_signature()}
+        >>> forged = dict(sign(0.1), value=0.2)
+        >>> reward = {"sender_blockchain_address": MINING_SENDER, "recipient_blockchain_address": wallet_B.blockchain_address,
+        ...           "value": 100.0, "sender_public_key": "", "signature": ""}
+        >>> block_chain.add_transactions([sign(0.6), sign(0.6), forged, {"value": 0.1}, reward])
+        [None, 'no_value', 'invalid_signature', 'missing_values', 'invalid_sender']
+        >>> len(block_chain.transaction_pool)
+        1
+        """
+        errors = []
+        parsed = []
+        for transaction_json in transactions:
+            error, transaction = self._parse_pending_transaction(transaction_json)
+            errors.append(error)
+            parsed.append(transaction)
+
+        items = [
+            (transaction_message(transaction), transaction["signature"],
+             transaction["sender_public_key"])
+            for transaction in parsed if transaction is not None]
+        verified = iter(self.verify_signatures(items))
+        for i, transaction in enumerate(parsed):
+            if transaction is not None:
+                errors[i] = self._add_pending_transaction(
+                    transaction, next(verified))
+
+        for error in errors:
+            if error:
+                logger.error({'action': 'add_transactions', 'error': error})
+        return errors
+
+    @staticmethod
+    def _parse_pending_transaction(transaction_json):
+        """
+        add_transactionsの1件分の形式を確認する
+
+        Returns
+        -------
+        (error, transaction) : tuple
+            正しい場合は(None, 署名付きのtransaction)，それ以外は(理由, None)
+        """
+        if not all(k in transaction_json for k in TRANSACTION_REQUIRED):
+            return "missing_values", None
+        # mining報酬はmining()だけが追加する
+        if transaction_json["sender_blockchain_address"] == MINING_SENDER:
+            return "invalid_sender", None
+        try:
+            value = float(transaction_json["value"])
+        except (TypeError, ValueError):
+            return "invalid_value", None
+        if not isinstance(transaction_json["signature"], str) or not isinstance(
+                transaction_json["sender_public_key"], str):
+            return "invalid_signature", None
+        return None, utils.sorted_dict_by_key({
+            "sender_blockchain_address": transaction_json["sender_blockchain_address"],
+            "recipient_blockchain_address": transaction_json["recipient_blockchain_address"],
+            "value": value,
+            "sender_public_key": transaction_json["sender_public_key"],
+            "signature": transaction_json["signature"]
+        })
+
+    def _add_pending_transaction(self, signed_transaction, verified):
+        """
+        add_transactionsの1件分（署名は確認済み）
+
+        Returns
+        -------
+        error : str
+            追加された場合はNone
+        """
+        if not verified:
+            return "invalid_signature"
+        sender_blockchain_address = signed_transaction["sender_blockchain_address"]
+        value = signed_transaction["value"]
+        # 残高の確認から追加までの間にchainが置き換わらないようにする
+        with self._chain_lock:
+            if mempool.transaction_id(signed_transaction) in self.transaction_pool:
+                return "duplicate"
+
             # 送り金がない場合
-            if self.calculate_total_amount(sender_blockchain_address) < float(value):
-                logger.error(
-                    {'action': 'add_transaction', 'error': 'no_value'})
-                return False
+            balance = self.calculate_total_amount(sender_blockchain_address)
+            if balance - self.transaction_pool.pending_debit(sender_blockchain_address) < value:
+                return "no_value"
 
-            self.transaction_pool.append(transaction)
-            return True
-        return False
+            self.transaction_pool.add(signed_transaction)
+        return None
+
+    def verify_signatures(self, items, stop_on_failure=False):
+        """
+        署名を1件ずつの結果としてまとめて確認する
+
+        ・signature_cacheで確認済みのものは確認しない
+        ・SIGNATURE_VERIFY_POOL_MIN件未満の場合はこのプロセスで確認する
+        ・それ以上の場合はSIGNATURE_VERIFY_CHUNK_SIZE件ずつプロセスプールで確認する
+
+        Parameters
+        ----------
+        items: list of tuple
+            [(message, signature, sender_public_key)]
+
+        stop_on_failure: bool
+            Trueの場合は最初に失敗が見つかった時点で残りの確認を取り消す
+            （確認しなかったものはFalse）
+
+        Returns
+        -------
+        results : list of bool
+
+        See Also
+        --------
+        >>> import wallet
+        >>> wallet_A = wallet.Wallet()
+        >>> t = wallet.Transaction(wallet_A.private_key, wallet_A.public_key, wallet_A.blockchain_address, "B", 0.5)
+        >>> message = transaction_message({"sender_blockchain_address": wallet_A.blockchain_address, "recipient_blockchain_address": "B", "value": 0.5})
+        >>> item = (message, t.generate_signature(), wallet_A.public_key)
+        >>> BlockChain().verify_signatures([item, (message, "00" * 64, wallet_A.public_key), item])
+        [True, False, True]
+        """
+        results = [bool(self.signature_cache.get(item)) for item in items]
+        pending = [i for i, result in enumerate(results) if not result]
+        chunks = [
+            pending[i:i + SIGNATURE_VERIFY_CHUNK_SIZE]
+            for i in range(0, len(pending), SIGNATURE_VERIFY_CHUNK_SIZE)]
+        futures = {}
+        if len(pending) < SIGNATURE_VERIFY_POOL_MIN:
+            completed = (
+                (chunk, _verify_signatures(
+                    [items[i] for i in chunk], self.get_verifying_key))
+                for chunk in chunks)
+        else:
+            executor = self._get_verify_executor()
+            for chunk in chunks:
+                futures[executor.submit(
+                    _verify_signatures, [items[i] for i in chunk])] = chunk
+            completed = (
+                (futures[future], future.result())
+                for future in concurrent.futures.as_completed(futures))
+        try:
+            for chunk, chunk_results in completed:
+                for i, result in zip(chunk, chunk_results):
+                    results[i] = result
+                    if result:
+                        self.signature_cache.put(items[i], True)
+                if stop_on_failure and not all(chunk_results):
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+        return results
+
+    def create_transactions(self, transactions):
+        """
+        add_transactions + 同期
+        追加されたtransactionだけを同期する
+
+        Parameters
+        ----------
+        transactions: list of dicts
+
+        Returns
+        -------
+        errors : list
+            add_transactionsと同じ
+        """
+        errors = self.add_transactions(transactions)
+        for transaction_json, error in zip(transactions, errors):
+            if error is None:
+                self.broadcaster.send_transaction(
+                    {k: transaction_json[k] for k in TRANSACTION_REQUIRED})
+        return errors
 
     def create_transaction(self, sender_blockchain_address,
                            recipient_blockchain_address, value,
                            sender_public_key, signature):
         """
         ・add_transaction + 同期
-        ・miningの場合は同期はしない
+        ・追加されたtransactionだけを同期する
 
         Parameters
         ----------
@@ -290,17 +1395,13 @@ class BlockChain(object):
 
         # 同期
         if is_transacted:
-            for node in self.neighbours:
-                requests.put(
-                    f"http://{node}/transactions",
-                    json={
-                        "sender_blockchain_address": sender_blockchain_address,
-                        "recipient_blockchain_address": recipient_blockchain_address,
-                        "value": value,
-                        "sender_public_key": sender_public_key,
-                        "signature": signature,
-                    }
-                )
+            self.broadcaster.send_transaction({
+                "sender_blockchain_address": sender_blockchain_address,
+                "recipient_blockchain_address": recipient_blockchain_address,
+                "value": value,
+                "sender_public_key": sender_public_key,
+                "signature": signature,
+            })
 
         return is_transacted
 
@@ -314,6 +1415,10 @@ class BlockChain(object):
         2. signature_bytes: signatureをbytes化
         3. verifying_key: sender_public_keyから生成する
 
+        ・確認済みの(message, signature, public key)はsignature_cacheから返す
+        ・verifying_keyはverifying_key_cacheから使い回す
+        ・transactionにsender_public_key, signatureが含まれていてもmessageには含めない
+
         Parameters
         ----------
         sender_public_key: str
@@ -329,19 +1434,70 @@ class BlockChain(object):
         See Also
         --------
         """
-        sha256 = hashlib.sha256()
-        sha256.update(str(transaction).encode("utf-8"))
-        message = sha256.digest()
+        message = transaction_message(transaction)
+        cache_key = (message, signature, sender_public_key)
+        if self.signature_cache.get(cache_key):
+            return True
+
         signature_bytes = bytes().fromhex(signature)
-        verifying_key = VerifyingKey.from_string(
-            bytes().fromhex(sender_public_key), curve=NIST256p
-        )
+        verifying_key = self.get_verifying_key(sender_public_key)
         verified_Key = verifying_key.verify(signature_bytes, message)
+        if verified_Key:
+            self.signature_cache.put(cache_key, True)
         return verified_Key
 
-    def valid_proof(self, transactions, previous_hash, nonce, difficulty=MINING_DIFFICULTY):
+    def get_verifying_key(self, sender_public_key):
+        """
+        public keyからVerifyingKeyを作る
+        作ったものはverifying_key_cacheに入れて使い回し，
+        VERIFYING_KEY_PRECOMPUTE_HITS回使われたkeyは事前計算を行う
+
+        Parameters
+        ----------
+        sender_public_key: str
+
+        Returns
+        -------
+        verifying_key : VerifyingKey
+
+        See Also
+        --------
+        >>> import wallet
+        >>> wallet_A = wallet.Wallet()
+        >>> block_chain = BlockChain()
+        >>> key = block_chain.get_verifying_key(wallet_A.public_key)
+        >>> key is block_chain.get_verifying_key(wallet_A.public_key)
+        True
+        >>> block_chain.verifying_key_cache.stats()
+        {'size': 1, 'maxsize': 1024, 'hits': 1, 'misses': 1}
+        """
+        entry = self.verifying_key_cache.get(sender_public_key)
+        if entry is None:
+            verifying_key = VerifyingKey.from_string(
+                bytes().fromhex(sender_public_key), curve=NIST256p
+            )
+            entry = [verifying_key, 0]
+            self.verifying_key_cache.put(sender_public_key, entry)
+        entry[1] += 1
+        # よく使われるkeyは事前計算を行う（ecdsa 0.14以降）
+        # from_stringで作ったpointはorderを持たないので，orderを指定して作り直す
+        if (entry[1] == VERIFYING_KEY_PRECOMPUTE_HITS
+                and hasattr(entry[0], "precompute")):
+            point = entry[0].pubkey.point
+            verifying_key = VerifyingKey.from_public_point(
+                ellipticcurve.Point(
+                    NIST256p.curve, point.x(), point.y(), NIST256p.order),
+                curve=NIST256p)
+            verifying_key.precompute()
+            entry[0] = verifying_key
+        return entry[0]
+
+    def valid_proof(self, transactions, previous_hash, nonce, difficulty=MINING_DIFFICULTY,
+                    merkle_root=None):
         """
         nonceを計算する．
+        nonce以外を事前にserializeしたmining_engine.ProofTemplateで計算する
+        （BlockChain.hashと同じhash）
 
         Parameters
         ----------
@@ -357,6 +1513,9 @@ class BlockChain(object):
         difficulty: int
             miningの難易度．hash化した文字列の先頭"0"の連続数
 
+        merkle_root: str
+            version 2のblockの場合．transactionsの代わりにhashする
+
         Returns
         -------
         bool
@@ -364,36 +1523,61 @@ class BlockChain(object):
         See Also
         --------
         """
-        guess_block = utils.sorted_dict_by_key({
-            "transactions": transactions,
-            "nonce": nonce,
-            "previous_hash": previous_hash
-        })
-        guess_hash = self.hash(guess_block)
-        return guess_hash[:difficulty] == "0" * difficulty
+        return mining_engine.valid_proof(
+            transactions, previous_hash, nonce, difficulty, merkle_root)
 
-    def proof_of_work(self):
+    def proof_of_work(self, transactions=None, previous_hash=None):
         """
         nonceを計算できるまで繰り返し計算を行う
+        探索はmining_engineに任せる
+
+        Parameters
+        ----------
+        transactions: list of dicts
+            blockに含めるtransaction．Noneの場合はtransaction_poolの全て
+
+        previous_hash: str
+            つなげるblockのhash．Noneの場合は現在のtip
 
         See Also
         --------
         """
-        transactions = self.transaction_pool.copy()
-        previous_hash = self.hash(self.chain[-1])
-        nonce = 0
-        while self.valid_proof(transactions, previous_hash, nonce) is False:
-            nonce += 1
-        return nonce
-
-    def mining(self):
+        if transactions is None:
+            transactions = self.transaction_pool.copy()
+        if previous_hash is None:
+            previous_hash = self.tip_hash
+        if BLOCK_VERSION >= 2:
+            # version 2はheaderだけをhashするのでtransactionsはworkerに渡さない
+            return self.mining_engine.search(
+                None, previous_hash, MINING_DIFFICULTY,
+                merkle.merkle_root(transactions))
+        return self.mining_engine.search(
+            transactions, previous_hash, MINING_DIFFICULTY)
+
+    def mining(self, mode=None, workers=None):
         """
         miningをし，blockを生成する．
-        transactionが空の場合もminingを行う．
+        transactionが空の場合はmining_policy.allow_emptyがTrueの場合だけminingを行う．
+
+        Parameters
+        ----------
+        mode: str
+            "serial" or "parallel"．Noneの場合は現在のengineを使う
+
+        workers: int
+            parallelの場合のworkerプロセス数
+
+        Returns
+        -------
+        bool
+            blockを作らなかった場合はFalse
 
         See Also
         --------
         >>> block_chain = BlockChain()
+        >>> block_chain.mining_policy.allow_empty = False
+        >>> block_chain.mining(), len(block_chain.chain)
+        (False, 1)
         >>> my_blockchain_address = "my_blockchain_address"
         >>> block_chain = BlockChain(blockchain_address=my_blockchain_address)        
         >>> block_init = {}
@@ -402,60 +1586,181 @@ class BlockChain(object):
         >>> block_chain.transaction_pool = [{"recipient_blockchain_address": "A", "sender_blockchain_address": "B", "value": 1.0}]
         >>> nonce = block_chain.proof_of_work()
         >>> nonce
-        8636
+        1621
         >>> previous_hash = block_chain.hash(block_chain.chain[-1])
-        >>> guess_block = utils.sorted_dict_by_key({"transactions": block_chain.transaction_pool, "nonce": nonce, "previous_hash": previous_hash})
-        >>> block_chain.hash(guess_block)
-        '000494115f84a2b4e5526c65fe44364405f4af36e119ac75e1414f7da2f8f673'
+        >>> merkle_root = merkle.merkle_root(block_chain.transaction_pool.copy())
+        >>> guess_header = utils.sorted_dict_by_key({"merkle_root": merkle_root, "nonce": nonce, "previous_hash": previous_hash})
+        >>> block_chain.hash(guess_header)
+        '0008963742f1f3d08c09e82cb324f8b7d77b149a2f79edee7152d96abf79d713'
         """
         # 空のtransactionの時はマイニングにしないようにする
-        # if not self.transaction_pool:
-        #     return False
-
-        self.add_transaction(
-            sender_blockchain_address=MINING_SENDER,
-            recipient_blockchain_address=self.blockchain_address,
-            value=MINING_REWARD
-        )
-        nonce = self.proof_of_work()
-        previous_hash = self.hash(self.chain[-1])
-        self.create_block(nonce, previous_hash)
+        if not self.transaction_pool and not self.mining_policy.allow_empty:
+            return False
+
+        if mode is not None:
+            self.set_mining_engine(mode, workers)
+
+        # mining報酬（署名なし）はここでだけ追加する
+        reward = utils.sorted_dict_by_key({
+            "sender_blockchain_address": MINING_SENDER,
+            "recipient_blockchain_address": self.blockchain_address,
+            "value": float(MINING_REWARD)
+        })
+        self.transaction_pool.add(reward)
+        # PoWの間に追加されたtransactionは次のblockに入れる
+        transactions = self.transaction_pool.select(BLOCK_MAX_TRANSACTIONS)
+        # PoWに使ったprevious_hashでblockを作る（PoWの間にtipが変わることがある）
+        previous_hash = self.tip_hash
+        nonce = self.proof_of_work(transactions, previous_hash)
+        with self._chain_lock:
+            if self.tip_hash != previous_hash:
+                # PoWの間にconsensusでchainが置き換わった．このnonceは使えない
+                self.transaction_pool.remove(mempool.transaction_id(reward))
+                logger.info({
+                    "action": "mining",
+                    "status": "stale",
+                    "previous_hash": previous_hash
+                })
+                return False
+            self.create_block(nonce, previous_hash, transactions)
+        self._last_mined = time.monotonic()
 
         # logサーチするのに良い記法
         logger.info({
             "action": "mining",
-            "status": "success"
+            "status": "success",
+            "mode": self.mining_engine.mode,
+            "workers": self.mining_engine.workers,
+            "hash_rate": self.mining_engine.stats.get("hash_rate")
         })
 
         # 最も長いchainを採用
-        for node in self.neighbours:
-            requests.put(f'http://{node}/consensus')
+        self.broadcaster.consensus()
 
         return True
 
     def start_mining(self):
         """
-        MINING_TIMER_SECごとにself-mining（start_mining）を行う
+        self-miningを始める．mining_policyの条件を満たした時にminingを行う
 
-        ・blocking=Trueにすると待ち行列になる
-        ・ExitStackを使うと，callbackが明示的に記述できて、必ず実行したい処理が一目見てわかる。
+        ・mempoolがsize個になった場合はtransactionの追加時にすぐ
+        ・最も古いtransactionがage秒待った場合
+        ・それ以外は前回の終了からinterval秒ごと（最初はすぐ）
+        既に開始している場合は何もしない（self-miningは1つだけ）
+
+        Returns
+        -------
+        bool
+            開始した場合はTrue
 
         See Also
         --------
-        threading.Semaphore(1) : self-miningは1つだけ
         MINING_TIMER_SEC : 擬似的にマイニングの時間を設定
         """
-        is_acquire = self.mining_semaphore.acquire(blocking=False)
-        if is_acquire:
-            with contextlib.ExitStack() as stack:
-                stack.callback(self.mining_semaphore.release)
-                self.mining()
-                loop = threading.Timer(MINING_TIMER_SEC, self.start_mining)
-                loop.start()
+        return self._schedule(
+            "mining", self._mining_round, self.mining_policy.interval)
+
+    def set_mining_policy(self, **kwargs):
+        """
+        mining_policyを変える（self-mining中はtimerの間隔も変える）
+
+        Parameters
+        ----------
+        kwargs :
+            MiningPolicyの引数（size, age, interval, allow_empty）
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.set_mining_policy(size=10, allow_empty=False)
+        >>> block_chain.mining_policy.size, block_chain.mining_policy.allow_empty
+        (10, False)
+        """
+        policy = self.mining_policy
+        for key in ("size", "age", "interval", "allow_empty"):
+            if kwargs.get(key) is not None:
+                setattr(policy, key, kwargs[key])
+        if "mining" in self.scheduler:
+            self.scheduler.set_interval("mining", policy.interval)
+            self._schedule_mining()
+
+    def set_job_interval(self, name, interval):
+        """
+        定期的な処理のintervalを変える
+        miningはmining_policyのtimerも同じ値にする（miningするかはpolicyで決めるため）
+
+        Raises
+        ------
+        KeyError
+            jobがない場合
+
+        ValueError
+            intervalが正でない場合
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.scheduler.add_job("mining", block_chain._mining_round, 20)
+        True
+        >>> block_chain.set_job_interval("mining", 5)
+        >>> block_chain.mining_policy.interval, block_chain.scheduler.stats()["mining"]["interval"]
+        (5.0, 5.0)
+        """
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if name not in self.scheduler:
+            raise KeyError(name)
+        if name == "mining":
+            self.set_mining_policy(interval=interval)
+        else:
+            self.scheduler.set_interval(name, interval)
+
+    def _schedule_mining(self):
+        """
+        mempoolの状態から次にminingを確認する時刻を決める
+        """
+        pool = self.transaction_pool
+        delay = self.mining_policy.delay(len(pool), pool.oldest_age())
+        if delay is not None:
+            self.scheduler.run_now("mining", delay)
+
+    def _on_transaction_added(self, transaction):
+        if transaction["sender_blockchain_address"] == MINING_SENDER:
+            return
+        if "mining" in self.scheduler:
+            self._schedule_mining()
+
+    def _mining_round(self):
+        """
+        self-miningの1回．mining_policyの条件を満たしていればminingを行う
+
+        Returns
+        -------
+        bool
+            miningした場合はTrue
+        """
+        pool = self.transaction_pool
+        pending = len(pool)
+        since_last = float("inf") if self._last_mined is None else (
+            time.monotonic() - self._last_mined)
+        reason = self.mining_policy.reason(pending, pool.oldest_age(), since_last)
+        mined = False
+        if reason is not None:
+            logger.info({
+                "action": "mining_trigger",
+                "reason": reason,
+                "pending": pending
+            })
+            mined = self.mining()
+        # BLOCK_MAX_TRANSACTIONSで残ったtransaction
+        self._schedule_mining()
+        return mined
 
     def calculate_total_amount(self, blockchain_address):
         """
         walletのビットコインを計算する．
+        chainを走査せずに残高のindex（balances）から返す
         ex. 
         MINING_SENDER -> my_blockchain_address 10.0
         my_blockchain_address -> A 5.0
@@ -482,70 +1787,387 @@ class BlockChain(object):
         >>> print(block_chain.calculate_total_amount("Y"))
         0.0
         """
-        total_amount = 0.0
-        for block in self.chain:
-            for transaction in block["transactions"]:
-                value = float(transaction["value"])
-                if blockchain_address == transaction["recipient_blockchain_address"]:
-                    total_amount += value
-                if blockchain_address == transaction["sender_blockchain_address"]:
-                    total_amount -= value
-        return total_amount
+        # chainの置き換え中はblockごとに戻す・適用するので，途中の残高を読まない
+        with self._chain_lock:
+            return self.balances.get(blockchain_address, 0.0)
+
+    def get_amount_and_tip(self, blockchain_address):
+        """
+        残高とその残高を計算したtipのhash
+
+        Returns
+        -------
+        (amount, tip_hash) : tuple
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.get_amount_and_tip("A") == (0.0, block_chain.tip_hash)
+        True
+        """
+        with self._chain_lock:
+            return (self.balances.get(blockchain_address, 0.0),
+                    self.block_hashes[-1])
 
-    def valid_chain(self, chain):
+    def valid_chain(self, chain, strict=False):
         """
         blockのvalidation check
+        1. header: previous_hashのつながりとPoW（version 2はtransactionsを使わない）
+        2. body: version 2のtransactionsとmerkle_root
+        3. strictの場合は署名
 
         Parameters
         ----------
         chain: list in dict
 
+        strict: bool
+            Trueの場合はmining以外の全てのtransactionの署名も確認する
+
         See Also
         --------
         """
-        pre_block = chain[0]
-        current_index = 1
-        while current_index < len(chain):
-            block = chain[current_index]
+        return self._valid_chain_hashes(chain, strict) is not None
+
+    def _valid_chain_hashes(self, chain, strict=False):
+        """
+        valid_chainと同じcheckを行い，各blockのhashを返す
+        各blockのhashは1度だけ計算する
+
+        Parameters
+        ----------
+        chain: list in dict
+
+        Returns
+        -------
+        block_hashes : list of str
+            validでない場合はNone
+        """
+        genesis_hash = self.hash(chain[0])
+        block_hashes = self._valid_blocks_hashes(chain[1:], genesis_hash, strict)
+        if block_hashes is None:
+            return None
+        return [genesis_hash] + block_hashes
+
+    def _valid_blocks_hashes(self, blocks, previous_hash, strict=False):
+        """
+        previous_hashのblockに続くblocksのvalidation checkを行い，各blockのhashを返す
+
+        Parameters
+        ----------
+        blocks: list in dict
+
+        previous_hash: str
+            blocks[0]の前のblockのhash
+
+        strict: bool
+            Trueの場合はhashとnonceの確認の後に署名も確認する
+
+        Returns
+        -------
+        block_hashes : list of str
+            validでない場合はNone
+        """
+        block_hashes = []
+        for block in blocks:
 
             # blockが正しいかどうか
-            if block["previous_hash"] != self.hash(pre_block):
-                return False
+            if block["previous_hash"] != previous_hash:
+                return None
 
-            # 正しいnanceかどうか
-            if not self.valid_proof(
-                    block["transactions"], block["previous_hash"],
-                    block["nonce"], MINING_DIFFICULTY):
-                return False
+            # 正しいnanceかどうか（version 2はheaderだけで確認できる）
+            if not self.valid_header(block):
+                return None
+
+            previous_hash = self.hash(block)
+            block_hashes.append(previous_hash)
+
+        # headerが全て正しい場合だけtransactionsを確認する
+        if not self.valid_block_bodies(blocks):
+            return None
+        if strict and not self.verify_block_signatures(blocks):
+            return None
+        return block_hashes
 
-            pre_block = block
-            current_index += 1
+    def valid_header(self, block):
+        """
+        blockのPoWを確認する
+        version 1: transactionsを全て含めてhashする（以前のルール）
+        version 2: merkle_rootを含む固定長のheaderだけをhashする
+
+        Parameters
+        ----------
+        block: dict
+
+        Returns
+        -------
+        bool
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> _ = block_chain.mining()
+        >>> block = block_chain.chain[-1]
+        >>> block_chain.valid_header(block)
+        True
+        >>> block_chain.valid_header(dict(block, merkle_root=merkle.EMPTY_ROOT))
+        False
+        """
+        version = models.block_version(block)
+        if version == 1:
+            return self.valid_proof(
+                block["transactions"], block["previous_hash"],
+                block["nonce"], MINING_DIFFICULTY)
+        if version == 2:
+            return self.valid_proof(
+                None, block["previous_hash"], block["nonce"],
+                MINING_DIFFICULTY, block["merkle_root"])
+        return False
+
+    def valid_block_bodies(self, blocks):
+        """
+        version 2のblockのtransactionsがheaderのmerkle_rootと一致するか確認する
+
+        Parameters
+        ----------
+        blocks: list of dicts
+
+        Returns
+        -------
+        bool
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> _ = block_chain.mining()
+        >>> block = block_chain.chain[-1]
+        >>> block_chain.valid_block_bodies([block])
+        True
+        >>> block_chain.valid_block_bodies([dict(block, transactions=[])])
+        False
+        """
+        for block in blocks:
+            if models.block_version(block) < 2:
+                continue
+            if merkle.merkle_root(block["transactions"]) != block["merkle_root"]:
+                return False
         return True
 
+    def verify_block_signatures(self, blocks):
+        """
+        blocks内のmining以外の全てのtransactionの署名を確認する
+
+        verify_signaturesでまとめて確認し，最初に失敗したchunkが見つかった時点で
+        残りを確認しない
+
+        Parameters
+        ----------
+        blocks: list in dict
+
+        Returns
+        -------
+        bool
+
+        See Also
+        --------
+        >>> import wallet
+        >>> wallet_A = wallet.Wallet()
+        >>> block_chain = BlockChain(blockchain_address=wallet_A.blockchain_address)
+        >>> _ = block_chain.mining()
+        >>> t = wallet.Transaction(wallet_A.private_key, wallet_A.public_key, wallet_A.blockchain_address, "B", 0.5)
+        >>> block_chain.add_transaction(wallet_A.blockchain_address, "B", 0.5, wallet_A.public_key, t.generate_signature())
+        True
+        >>> _ = block_chain.mining()
+        >>> block_chain.verify_block_signatures(block_chain.chain)
+        True
+        >>> forged = utils.sorted_dict_by_key(dict(block_chain.chain[-1]["transactions"][0], value=0.9))
+        >>> block_chain.verify_block_signatures([{"transactions": [forged]}])
+        False
+        """
+        items = []
+        for block in blocks:
+            for transaction in block["transactions"]:
+                if transaction["sender_blockchain_address"] == MINING_SENDER:
+                    continue
+                if "sender_public_key" not in transaction or "signature" not in transaction:
+                    return False
+                item = (
+                    transaction_message(transaction),
+                    transaction["signature"],
+                    transaction["sender_public_key"])
+                items.append(item)
+        return all(self.verify_signatures(items, stop_on_failure=True))
+
+    def _get_verify_executor(self):
+        with self._verify_executor_lock:
+            if self._verify_executor is None:
+                # request・schedulerのthreadが動いている中でforkしないようにspawnで作る
+                self._verify_executor = utils.process_pool(
+                    SIGNATURE_VERIFY_WORKERS or os.cpu_count(),
+                    SIGNATURE_VERIFY_START_METHOD)
+            return self._verify_executor
+
+    def _locator_heights(self):
+        """
+        共通の祖先を探すためのheight
+        tipから1, 2, 4, 8, ...と間隔を広げて遡る
+
+        See Also
+        --------
+        >>> block_chain = BlockChain()
+        >>> block_chain.chain = block_chain.chain * 10
+        >>> block_chain._locator_heights()
+        [9, 8, 7, 5, 1, 0]
+        """
+        heights = []
+        height = len(self._chain) - 1
+        step = 1
+        while height > 0:
+            heights.append(height)
+            height -= step
+            if len(heights) > 1:
+                step *= 2
+        heights.append(0)
+        return heights
+
+    def _fetch_blocks(self, node, min_length, deadline=None):
+        """
+        nodeから自身のchainに足りないblockだけをページごとに取得する
+
+        1. 自身のblock hashをtipから遡ってsinceに指定し，nodeが知っているblockを探す
+        2. 見つからない場合はgenesis blockから取得する
+        3. nodeのtipまでCHAIN_SYNC_PAGE_SIZEずつ取得する
+
+        Parameters
+        ----------
+        node: str
+
+        min_length: int
+            nodeのchainがこの長さ以下の場合は取得しない
+
+        deadline: float
+            time.monotonic()の期限．各requestのtimeoutはCONSENSUS_PEER_TIMEOUT_SECと
+            期限までの残り時間の短い方
+
+        Returns
+        -------
+        (start_height, blocks) : tuple
+            blocks[0]のheightとblockのlist
+        """
+        def get(params):
+            timeout = CONSENSUS_PEER_TIMEOUT_SEC
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    raise TimeoutError(f"deadline exceeded: {node}")
+            return self.peer_client.get(
+                node, "chain", params=params, timeout=timeout,
+                headers={"Accept": CHAIN_ACCEPT})
+
+        def decode(response):
+            if response.headers.get("Content-Type", "").startswith(codec.CONTENT_TYPE):
+                return codec.decode_chain(response.content)
+            return response.json()
+
+        for since in [self.block_hashes[h] for h in self._locator_heights()] + [-1]:
+            response = get({"since": since, "limit": CHAIN_SYNC_PAGE_SIZE})
+            if response.status_code == 200:
+                break
+            if response.status_code != 404:
+                return 0, []
+        else:
+            return 0, []
+
+        response_json = decode(response)
+        blocks = response_json["chain"]
+        # sinceに対応していないnodeはchain全体を返す
+        start_height = response_json.get("start_height", 0)
+        tip_height = response_json.get("height", len(blocks) - 1)
+        if tip_height + 1 <= min_length:
+            return start_height, []
+
+        while blocks and start_height + len(blocks) <= tip_height:
+            response = get({
+                "since": start_height + len(blocks) - 1,
+                "limit": CHAIN_SYNC_PAGE_SIZE})
+            if response.status_code != 200:
+                return 0, []
+            page = decode(response)["chain"]
+            if not page:
+                break
+            blocks.extend(page)
+        return start_height, blocks
+
     def resolve_conflicts(self):
         """
         Consensus
         最も長いchainを採用する
+        共通の祖先以降のblockだけ取得し，validation checkを行う
+
+        ・全nodeから並列に取得し，取得できたものから順にvalidation checkを行う
+        ・nodeごとのtimeout（CONSENSUS_PEER_TIMEOUT_SEC）と
+          全体の期限（CONSENSUS_DEADLINE_SEC）を過ぎたnodeは無視する
 
         See Also
         --------
         """
-        longest_chain = None
+        longest_blocks = None
+        longest_chain_hashes = None
+        longest_fork_height = None
         max_length = len(self.chain)
-        for node in self.neighbours:
-            response = requests.get(f"http://{node}/chain")
-            if response.status_code == 200:
-                response_json = response.json()
-                chain = response_json["chain"]
-                chain_length = len(chain)
-                if chain_length > max_length and self.valid_chain(chain):
-                    max_length = chain_length
-                    longest_chain = chain
-
-        if longest_chain:
-            self.chain = longest_chain
-            logger.info({"action": "resolve_conflicts", "status": "replaced"})
-            return True
+        neighbours = list(self.neighbours)
+        if not neighbours:
+            logger.info({"action": "resolve_conflicts", "status": "not_replaced"})
+            return False
+
+        deadline = time.monotonic() + CONSENSUS_DEADLINE_SEC
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(neighbours))
+        futures = {
+            executor.submit(self._fetch_blocks, node, max_length, deadline): node
+            for node in neighbours
+        }
+        try:
+            for future in concurrent.futures.as_completed(
+                    futures, timeout=max(deadline - time.monotonic(), 0)):
+                try:
+                    start_height, blocks = future.result()
+                except Exception as ex:
+                    logger.error({
+                        "action": "resolve_conflicts",
+                        "node": futures[future],
+                        "ex": ex
+                    })
+                    continue
+                if not blocks or start_height + len(blocks) <= max_length:
+                    continue
+                fork_height, block_hashes = self._validate_candidate(
+                    blocks, start_height, CHAIN_VALIDATION_STRICT)
+                if block_hashes is not None:
+                    max_length = start_height + len(blocks)
+                    longest_blocks = blocks[fork_height - start_height:]
+                    longest_chain_hashes = block_hashes
+                    longest_fork_height = fork_height
+        except concurrent.futures.TimeoutError:
+            logger.error({
+                "action": "resolve_conflicts",
+                "error": "deadline_exceeded",
+                "nodes": [node for future, node in futures.items()
+                          if not future.done()]
+            })
+        finally:
+            # 始まっていない取得は取り消す（cancel_futuresはPython 3.9以降）
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if longest_blocks:
+            with self._chain_lock:
+                # 取得している間にminingでchainが伸びた場合は比べ直す
+                if max_length > len(self._chain):
+                    self._replace_blocks(
+                        longest_fork_height, longest_blocks, longest_chain_hashes)
+                    logger.info({"action": "resolve_conflicts", "status": "replaced"})
+                    return True
 
         logger.info({"action": "resolve_conflicts", "status": "not_replaced"})
         return False
@@ -1,8 +1,15 @@
+import os
+
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
 
 import blockchain
+import blockstore
+import codec
+import models
+import snapshot
 import wallet
 
 app = Flask(__name__)
@@ -25,10 +32,29 @@ def get_blockchain():
     # １度しか呼ばれない
     if not cached_blockchain:
         miners_wallet = wallet.Wallet()
+        block_store = None
+        snapshot_store = None
+        if app.config.get("datadir"):
+            block_store = blockstore.BlockStore(
+                app.config["datadir"],
+                app.config.get("fsync", blockstore.BLOCKSTORE_FSYNC))
+            snapshot_store = snapshot.SnapshotStore(
+                os.path.join(app.config["datadir"], "snapshots"),
+                app.config.get("snapshot_interval", snapshot.SNAPSHOT_INTERVAL_BLOCKS))
         cache["blockchain"] = blockchain.BlockChain(
             blockchain_address=miners_wallet.blockchain_address,
-            port=app.config["port"]
+            port=app.config["port"],
+            block_store=block_store,
+            snapshot_store=snapshot_store
         )
+        cache["blockchain"].set_mining_engine(
+            app.config.get("mining_mode", blockchain.MINING_MODE),
+            app.config.get("mining_workers", blockchain.MINING_WORKERS))
+        cache["blockchain"].set_mining_policy(
+            size=app.config.get("mining_trigger_size"),
+            age=app.config.get("mining_trigger_age"),
+            interval=app.config.get("mining_interval"),
+            allow_empty=app.config.get("mining_empty_blocks"))
         app.logger.warning({
             "private_key": miners_wallet.private_key,
             "public_key": miners_wallet.public_key,
@@ -37,20 +63,156 @@ def get_blockchain():
     return cache["blockchain"]
 
 
+def parse_since(since):
+    """
+    query parameterのsince
+    64文字の場合はblock hash，それ以外はheight（int）．不正な値の場合はFalse
+    """
+    if since is None or len(since) == 64:
+        return since
+    try:
+        return int(since)
+    except ValueError:
+        return False
+
+
 @app.route("/chain", methods=["GET"])
 def get_chain():
     """
     Blockの情報を取得する
+    sinceを指定した場合はその後のblockだけを返す
 
     See Also
     --------
+    since : str
+        query parameter．height（int）またはblock hash
+
+    limit : int
+        query parameter．返すblockの最大数
+
     response : dict
         key: "chain"
         val: list in dict
+        key: "start_height"
+        val: chainの先頭のblockのheight
+        key: "height"
+        val: tipのheight
+
+    Accept : header
+        codec.CONTENT_TYPEを指定した場合はbinaryで返す
+    """
+    block_chain = get_blockchain()
+    since = parse_since(request.args.get("since"))
+    limit = request.args.get("limit", type=int)
+    if since is False:
+        return jsonify({"message": "invalid since"}), 400
+
+    start_height, blocks = block_chain.get_blocks(since, limit)
+    if start_height is None:
+        return jsonify({"message": "unknown block"}), 404
+    height = len(block_chain.chain) - 1
+    best = request.accept_mimetypes.best_match(
+        (codec.JSON_CONTENT_TYPE, codec.CONTENT_TYPE))
+    if best == codec.CONTENT_TYPE:
+        try:
+            data = codec.encode_chain(blocks, start_height, height)
+        except ValueError:
+            # binaryにできないblockを含む場合はjsonで返す
+            pass
+        else:
+            return Response(data, status=200, mimetype=codec.CONTENT_TYPE)
+    response = {
+        "chain": [models.to_dict(block) for block in blocks],
+        "start_height": start_height,
+        "height": height
+    }
+    return jsonify(response), 200
+
+
+@app.route("/chain/tip", methods=["GET"])
+def get_chain_tip():
+    """
+    最後のblockのheightとhash（walletが残高のcacheを使えるか確認する用）
+
+    See Also
+    --------
+    response : dict
+        key: "height"
+        key: "hash"
+    """
+    block_chain = get_blockchain()
+    height, tip_hash = block_chain.get_tip()
+    return jsonify({
+        "height": height,
+        "hash": tip_hash
+    }), 200
+
+
+@app.route("/headers", methods=["GET"])
+def get_headers():
+    """
+    blockのheaderだけを返す（light clientのheader chain用）
+
+    See Also
+    --------
+    since : str
+        query parameter．height（int）またはblock hash
+
+    limit : int
+        query parameter．defaultはblockchain.HEADERS_PAGE_SIZE
+
+    response : dict
+        key: "headers"
+        val: version 2はheader，version 1はblock全体のlist
+        key: "start_height"
+        key: "height"
+    """
+    block_chain = get_blockchain()
+    since = parse_since(request.args.get("since"))
+    limit = request.args.get(
+        "limit", default=blockchain.HEADERS_PAGE_SIZE, type=int)
+    if since is False:
+        return jsonify({"message": "invalid since"}), 400
+
+    start_height, headers = block_chain.get_headers(
+        since, min(limit, blockchain.HEADERS_PAGE_SIZE))
+    if start_height is None:
+        return jsonify({"message": "unknown block"}), 404
+    response = {
+        "headers": headers,
+        "start_height": start_height,
+        "height": len(block_chain.chain) - 1
+    }
+    return jsonify(response), 200
+
+
+@app.route("/proofs", methods=["GET"])
+def get_proofs():
+    """
+    blockchain_addressを含むtransactionとMerkle inclusion proof
+
+    See Also
+    --------
+    blockchain_address : str
+        query parameter
+
+    since : int
+        query parameter．このheightより後のblockだけ
+
+    response : dict
+        key: "proofs"
+        val: [{"height", "block_hash", "index", "transaction", "proof"}]
+        key: "height"
+        val: tipのheight
     """
+    blockchain_address = request.args.get("blockchain_address")
+    if not blockchain_address:
+        return jsonify({"message": "missing blockchain_address"}), 400
+    since = request.args.get("since", default=-1, type=int)
     block_chain = get_blockchain()
     response = {
-        "chain": block_chain.chain
+        "proofs": block_chain.get_address_proofs(blockchain_address, since),
+        "height": len(block_chain.chain) - 1
     }
     return jsonify(response), 200
 
@@ -66,7 +228,7 @@ def transaction():
     """
     block_chain = get_blockchain()
     if request.method == "GET":
-        transactions = block_chain.transaction_pool
+        transactions = block_chain.transaction_pool.copy()
         response = {
             "transactions": transactions,
             "length": len(transactions)
@@ -125,13 +287,80 @@ def transaction():
         return jsonify({'message': 'success'}), 200
 
     if request.method == 'DELETE':
-        block_chain.transaction_pool = []
+        block_chain.transaction_pool.clear()
         return jsonify({'message': 'success'}), 200
 
 
+@app.route("/transactions/batch", methods=["POST", "PUT"])
+def transactions_batch():
+    """
+    transactionをまとめて追加する
+    署名はまとめて（件数が多い場合はプロセスプールで並列に）確認し，
+    残高はpool内の未承認の送金を差し引いて順に確認して，transactionごとの結果を返す
+    senderがMINING_SENDERのtransactionは受け付けない
+
+    POST: walletからのtransaction．追加されたものを他のnodeに同期する
+    PUT: 他のnodeから同期されたtransaction
+
+    See Also
+    --------
+    request : dict
+        key: "transactions"
+        val: list in dict（POST /transactionsと同じ形式）
+
+    response : dict
+        key: "results"
+        val: list in dict．transactionごとの{"message": "success"}
+             または{"message": "fail", "error": str}
+    """
+    block_chain = get_blockchain()
+    request_json = request.get_json(silent=True)
+    if not request_json or not isinstance(request_json.get("transactions"), list):
+        return jsonify({"message": "missing values"}), 400
+    transactions = [
+        t if isinstance(t, dict) else {} for t in request_json["transactions"]]
+
+    if request.method == "POST":
+        errors = block_chain.create_transactions(transactions)
+    else:
+        errors = block_chain.add_transactions(transactions)
+
+    results = [
+        {"message": "success"} if error is None
+        else {"message": "fail", "error": error}
+        for error in errors
+    ]
+    return jsonify({
+        "results": results,
+        "length": len(results),
+        "success": errors.count(None)
+    }), 200
+
+
 @app.route("/mine", methods=["GET"])
 def mine():
+    """
+    miningを行う
+
+    See Also
+    --------
+    mode : str
+        query parameter．"serial" or "parallel"
+
+    workers : int
+        query parameter．parallelの場合のworkerプロセス数
+    """
     block_chain = get_blockchain()
+    mode = request.args.get("mode")
+    workers = request.args.get("workers", type=int)
+    if workers is not None and workers < 1:
+        return jsonify({"message": "invalid workers"}), 400
+    if mode is not None:
+        # 現在と同じmode・workersの場合はengineを作り直さない
+        try:
+            block_chain.set_mining_engine(mode, workers)
+        except ValueError as ex:
+            return jsonify({"message": str(ex)}), 400
     is_mined = block_chain.mining()
     if is_mined:
         return jsonify({"message": "success"}), 200
@@ -145,6 +374,36 @@ def start_mine():
     return jsonify({'message': 'success'}), 200
 
 
+@app.route("/scheduler", methods=["GET", "PUT"])
+def scheduler_jobs():
+    """
+    定期的な処理（mining・sync_neighbours・consensus）の状態とintervalの変更
+
+    See Also
+    --------
+    GET response : dict
+        job name -> scheduler.Job.stats()
+        （lateness: 予定の時刻から実際に始まるまでの秒数）
+
+    PUT request : dict
+        job name -> interval（秒）
+    """
+    block_chain = get_blockchain()
+    if request.method == "PUT":
+        request_json = request.get_json(silent=True)
+        if not isinstance(request_json, dict):
+            return jsonify({"message": "missing values"}), 400
+        for name, interval in request_json.items():
+            if name not in block_chain.scheduler:
+                return jsonify({"message": f"unknown job: {name}"}), 404
+            try:
+                # miningはmining_policyのtimerも変える
+                block_chain.set_job_interval(name, interval)
+            except (TypeError, ValueError):
+                return jsonify({"message": f"invalid interval: {name}"}), 400
+    return jsonify(block_chain.scheduler.stats()), 200
+
+
 @app.route('/consensus', methods=['PUT'])
 # 最も長いchainを採用
 def consensus():
@@ -155,9 +414,24 @@ def consensus():
 
 @app.route('/amount', methods=['GET'])
 def get_total_amount():
+    """
+    残高とその時点のtipのhash
+
+    See Also
+    --------
+    tip_hash : str
+        query parameter．walletがcacheしている残高のtip．
+        tipが変わっていない場合は304を返す（残高は変わらない）
+    """
     blockchain_address = request.args['blockchain_address']
+    block_chain = get_blockchain()
+    # 残高とtipは同じ時点のもの（chainの置き換えの途中は読まない）
+    amount, tip_hash = block_chain.get_amount_and_tip(blockchain_address)
+    if request.args.get('tip_hash') == tip_hash:
+        return '', 304
     return jsonify({
-        'amount': get_blockchain().calculate_total_amount(blockchain_address)
+        'amount': amount,
+        'tip_hash': tip_hash
     }), 200
 
 
@@ -168,14 +442,46 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-p", "--port", default=5000,
                         type=int, help="port to listen on")
+    parser.add_argument("-m", "--mining-mode", default=blockchain.MINING_MODE,
+                        choices=("serial", "parallel"), help="mining mode")
+    parser.add_argument("-w", "--mining-workers", default=blockchain.MINING_WORKERS,
+                        type=int, help="number of mining processes")
+    parser.add_argument("--mining-trigger-size", default=blockchain.MINING_TRIGGER_SIZE,
+                        type=int, help="mine as soon as this many transactions are pending")
+    parser.add_argument("--mining-trigger-age", default=blockchain.MINING_TRIGGER_AGE_SEC,
+                        type=float, help="mine when the oldest pending transaction is this old")
+    parser.add_argument("--mining-interval", default=blockchain.MINING_TIMER_SEC,
+                        type=float, help="fallback seconds between mining rounds")
+    parser.add_argument("--no-empty-blocks", action="store_true",
+                        help="do not mine blocks without transactions")
+    parser.add_argument("-d", "--datadir", default=None,
+                        help="directory to persist blocks (memory only if omitted)")
+    parser.add_argument("--fsync", default=blockstore.BLOCKSTORE_FSYNC,
+                        choices=("always", "interval", "never"),
+                        help="fsync policy of the block store")
+    parser.add_argument("--snapshot-interval", default=snapshot.SNAPSHOT_INTERVAL_BLOCKS,
+                        type=int, help="blocks between balance snapshots")
 
     args = parser.parse_args()
     port = args.port
 
     # 設定ファイルの作成
     app.config["port"] = port
+    app.config["mining_mode"] = args.mining_mode
+    app.config["mining_workers"] = args.mining_workers
+    app.config["mining_trigger_size"] = args.mining_trigger_size
+    app.config["mining_trigger_age"] = args.mining_trigger_age
+    app.config["mining_interval"] = args.mining_interval
+    app.config["mining_empty_blocks"] = not args.no_empty_blocks
+    app.config["datadir"] = args.datadir
+    app.config["fsync"] = args.fsync
+    app.config["snapshot_interval"] = args.snapshot_interval
 
     get_blockchain().run()
 
     # 同時リクエストを引き受ける
-    app.run(host="0.0.0.0", port=port, threaded=True, debug=True)
+    try:
+        app.run(host="0.0.0.0", port=port, threaded=True, debug=True)
+    finally:
+        # 実行中のminingと送信待ちのgossipを終わらせてから止める
+        get_blockchain().shutdown()
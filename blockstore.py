@@ -0,0 +1,455 @@
+import collections
+import collections.abc
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import models
+import utils
+
+BLOCKSTORE_FSYNC = "interval"
+BLOCKSTORE_FSYNC_INTERVAL_SEC = 1.0
+INDEX_GROW_RECORDS = 4096
+STORED_BLOCK_CACHE_SIZE = 1024
+
+LOG_FILE = "blocks.log"
+INDEX_FILE = "blocks.idx"
+
+# index: header（magic, version, block数）+ block数 x (logのoffset, block hash)
+INDEX_MAGIC = b"PBIX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct(">4sIQ")
+INDEX_RECORD = struct.Struct(">Q32s")
+# log: block数 x (jsonの長さ, json)
+LOG_RECORD_HEADER = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+
+class BlockStore(object):
+    """
+    blockをdiskに保存する
+
+    ・blocks.log: blockのjsonを追記するだけのlog
+    ・blocks.idx: height -> (logのoffset, block hash)の固定長のindex．mmapで読み書きする
+    ・chainが置き換わった場合はforkしたheight以降を切り詰める
+
+    fsyncの方針
+        "always": 追加するたびにfsyncする
+        "interval": 最後のfsyncからBLOCKSTORE_FSYNC_INTERVAL_SEC経った場合にfsyncする
+            （追加がない間はsync_if_due()を定期的に呼んで最後のblockもfsyncする）
+        "never": OSに任せる
+
+    Attributes
+    ----------
+    path : str
+        保存するdirectory
+
+    fsync : str
+        "always", "interval", "never"
+
+    readonly : bool
+        Trueの場合はfileを変更しない（recoverもせず，logに収まっているblockだけを読む）
+
+    See Also
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> store = BlockStore(path)
+    >>> store.append({"nonce": 0, "transactions": []}, "00" * 32)
+    >>> store.append({"nonce": 1, "transactions": []}, "11" * 32)
+    >>> store.close()
+    >>> store = BlockStore(path)
+    >>> len(store), store.read(1)["nonce"], store.block_hash(1) == "11" * 32
+    (2, 1, True)
+    >>> store.truncate(1)
+    >>> blocks, block_hashes = store.load()
+    >>> [block["nonce"] for block in blocks], len(block_hashes)
+    ([0], 1)
+    >>> store.close()
+    >>> store = BlockStore(path, readonly=True)
+    >>> len(store)
+    1
+    >>> store.append({"nonce": 1, "transactions": []}, "11" * 32)
+    Traceback (most recent call last):
+        ...
+    ValueError: read-only block store
+    >>> store.close()
+    """
+
+    def __init__(self, path, fsync=BLOCKSTORE_FSYNC, readonly=False):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"unknown fsync policy: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._last_sync = time.monotonic()
+        # fsyncしていないblockがあるか
+        self._dirty = False
+        if readonly:
+            self._open_readonly()
+            return
+        os.makedirs(path, exist_ok=True)
+
+        self._log = open(os.path.join(path, LOG_FILE), "a+b")
+        index_path = os.path.join(path, INDEX_FILE)
+        self._index_file = open(
+            index_path, "r+b" if os.path.exists(index_path) else "w+b")
+        if os.fstat(self._index_file.fileno()).st_size < INDEX_HEADER.size:
+            self._index_file.truncate(
+                INDEX_HEADER.size + INDEX_RECORD.size * INDEX_GROW_RECORDS)
+            self._map()
+            self._write_count(0)
+        else:
+            self._map()
+            magic, version, _ = INDEX_HEADER.unpack_from(self._index, 0)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError(f"invalid block index: {index_path}")
+        self._recover()
+
+    def _open_readonly(self):
+        self._log = open(os.path.join(self.path, LOG_FILE), "rb")
+        index_path = os.path.join(self.path, INDEX_FILE)
+        self._index_file = open(index_path, "rb")
+        self._index = mmap.mmap(
+            self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._capacity = (len(self._index) - INDEX_HEADER.size) // INDEX_RECORD.size
+        magic, version, count = INDEX_HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"invalid block index: {index_path}")
+        self._count = self._valid_count(count)
+
+    def _check_writable(self):
+        if self.readonly:
+            raise ValueError("read-only block store")
+
+    def _map(self):
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self._capacity = (len(self._index) - INDEX_HEADER.size) // INDEX_RECORD.size
+
+    def _write_count(self, count):
+        INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, INDEX_VERSION, count)
+        self._count = count
+
+    def _record(self, height):
+        return INDEX_RECORD.unpack_from(
+            self._index, INDEX_HEADER.size + INDEX_RECORD.size * height)
+
+    def _record_end(self, height, size):
+        """
+        heightのblockのlog上の終わり．logのsize内に収まらない場合はNone
+        """
+        offset, _ = self._record(height)
+        if offset + LOG_RECORD_HEADER.size > size:
+            return None
+        self._log.seek(offset)
+        (length,) = LOG_RECORD_HEADER.unpack(
+            self._log.read(LOG_RECORD_HEADER.size))
+        end = offset + LOG_RECORD_HEADER.size + length
+        return end if end <= size else None
+
+    def _end_offset(self):
+        """
+        indexに含まれる最後のblockのlog上の終わり
+        """
+        if self._count == 0:
+            return 0
+        return self._record_end(self._count - 1, float("inf"))
+
+    def _valid_count(self, count):
+        """
+        logに全て含まれている最後のblockまでのblock数
+        """
+        size = os.fstat(self._log.fileno()).st_size
+        count = min(count, self._capacity)
+        # logは追記だけなので，最後のblockから順に収まっているものを探す
+        while count > 0 and self._record_end(count - 1, size) is None:
+            count -= 1
+        return count
+
+    def _recover(self):
+        """
+        logとindexの書き込みの途中で止まった場合に整合させる
+
+        ・indexに書き込まれる前に止まった場合，logの余分な部分を切り詰める
+        ・logがdiskに書かれる前に止まった場合（fsyncが"always"以外），
+          logに全て含まれている最後のblockまでindexのblock数を減らす
+
+        See Also
+        --------
+        >>> import tempfile
+        >>> path = tempfile.mkdtemp()
+        >>> store = BlockStore(path)
+        >>> for nonce in range(3):
+        ...     store.append({"nonce": nonce, "transactions": []}, "00" * 32)
+        >>> end = store._record_end(1, float("inf"))
+        >>> store.close()
+        >>> with open(os.path.join(path, LOG_FILE), "r+b") as log:
+        ...     _ = log.truncate(end + 3)
+        >>> store = BlockStore(path)
+        >>> len(store), [block["nonce"] for block in store.load()[0]]
+        (2, [0, 1])
+        >>> os.path.getsize(os.path.join(path, LOG_FILE)) == end
+        True
+        >>> store.close()
+        """
+        _, _, indexed = INDEX_HEADER.unpack_from(self._index, 0)
+        size = os.fstat(self._log.fileno()).st_size
+        count = self._count = self._valid_count(indexed)
+        if count != indexed:
+            logger.warning({
+                "action": "blockstore_recover",
+                "path": self.path,
+                "indexed": indexed,
+                "count": count
+            })
+            self._write_count(count)
+            self._index.flush()
+        end = self._end_offset()
+        if size != end:
+            logger.warning({
+                "action": "blockstore_recover",
+                "path": self.path,
+                "truncated_at": end
+            })
+            self._log.truncate(end)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, block, block_hash):
+        """
+        Parameters
+        ----------
+        block: dict
+
+        block_hash: str
+        """
+        self._check_writable()
+        data = models.canonical_json(block)
+        with self._lock:
+            self._log.seek(0, os.SEEK_END)
+            offset = self._log.tell()
+            self._log.write(LOG_RECORD_HEADER.pack(len(data)) + data)
+            self._log.flush()
+            # logが先にdiskに書かれていることを保証してからindexを更新する
+            sync = self._should_sync()
+            if sync:
+                os.fsync(self._log.fileno())
+
+            if self._count >= self._capacity:
+                self._index.close()
+                self._index_file.truncate(
+                    INDEX_HEADER.size
+                    + INDEX_RECORD.size * (self._capacity + INDEX_GROW_RECORDS))
+                self._map()
+            INDEX_RECORD.pack_into(
+                self._index, INDEX_HEADER.size + INDEX_RECORD.size * self._count,
+                offset, bytes.fromhex(block_hash))
+            self._write_count(self._count + 1)
+            if sync:
+                self._index.flush()
+                self._last_sync = time.monotonic()
+            self._dirty = not sync
+
+    def sync_if_due(self):
+        """
+        fsyncしていないblockがあり，最後のfsyncからBLOCKSTORE_FSYNC_INTERVAL_SEC
+        経った場合にfsyncする（"interval"で追加が止まった場合の最後のblock用）
+
+        Returns
+        -------
+        bool
+            fsyncした場合はTrue
+
+        See Also
+        --------
+        >>> import tempfile
+        >>> store = BlockStore(tempfile.mkdtemp(), "interval")
+        >>> store.append({"nonce": 0, "transactions": []}, "00" * 32)
+        >>> store._last_sync -= BLOCKSTORE_FSYNC_INTERVAL_SEC
+        >>> store.sync_if_due(), store.sync_if_due()
+        (True, False)
+        >>> store.close()
+        """
+        with self._lock:
+            if not self._dirty or self._log.closed:
+                return False
+            if time.monotonic() - self._last_sync < BLOCKSTORE_FSYNC_INTERVAL_SEC:
+                return False
+            self.flush()
+            return True
+
+    def _should_sync(self):
+        if self.fsync == "always":
+            return True
+        if self.fsync == "interval":
+            return time.monotonic() - self._last_sync >= BLOCKSTORE_FSYNC_INTERVAL_SEC
+        return False
+
+    def truncate(self, height):
+        """
+        height以降のblockを削除する
+
+        Parameters
+        ----------
+        height: int
+        """
+        self._check_writable()
+        with self._lock:
+            if height >= self._count:
+                return
+            offset, _ = self._record(height)
+            self._write_count(height)
+            self._index.flush()
+            self._log.truncate(offset)
+            self._log.flush()
+            if self.fsync != "never":
+                os.fsync(self._log.fileno())
+
+    def read(self, height):
+        """
+        Returns
+        -------
+        block : collections.OrderedDict
+        """
+        with self._lock:
+            offset, _ = self._record(height)
+            self._log.seek(offset)
+            (length,) = LOG_RECORD_HEADER.unpack(
+                self._log.read(LOG_RECORD_HEADER.size))
+            return json.loads(
+                self._log.read(length), object_pairs_hook=collections.OrderedDict)
+
+    def block_hash(self, height):
+        return self._record(height)[1].hex()
+
+    def load(self):
+        """
+        全てのblockとhashを読み込む
+        hashはindexから読むので再計算しない
+
+        Returns
+        -------
+        (blocks, block_hashes) : tuple
+        """
+        with self._lock:
+            block_hashes = [self.block_hash(h) for h in range(self._count)]
+            end = self._end_offset()
+            self._log.seek(0)
+            data = self._log.read(end)
+        blocks = []
+        position = 0
+        for _ in range(len(block_hashes)):
+            (length,) = LOG_RECORD_HEADER.unpack_from(data, position)
+            position += LOG_RECORD_HEADER.size
+            blocks.append(json.loads(
+                data[position:position + length],
+                object_pairs_hook=collections.OrderedDict))
+            position += length
+        return blocks, block_hashes
+
+    def flush(self):
+        if self.readonly:
+            return
+        with self._lock:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._index.flush()
+            self._last_sync = time.monotonic()
+            self._dirty = False
+
+    def close(self):
+        with self._lock:
+            if self._log.closed:
+                return
+            self.flush()
+            self._index.close()
+            self._index_file.close()
+            self._log.close()
+
+
+class StoredSequence(collections.abc.Sequence):
+    """
+    先頭のstored個はblock storeから必要な時に読み，それより後はmemoryに持つlist
+
+    起動時に全てのblockを読み込まずにchain・block hashのlistとして使う
+
+    ・appendはmemoryに追加する（block storeへの保存は呼び出し側で行う）
+    ・del seq[height:]はheight以降を削除する（block storeの切り詰めは呼び出し側で行う）
+
+    Attributes
+    ----------
+    read : callable
+        heightから値を返す
+
+    stored : int
+        block storeから読む数
+
+    See Also
+    --------
+    >>> seq = StoredSequence(lambda height: height * 10, 3, cache_size=2)
+    >>> seq.append(30)
+    >>> len(seq), seq[1], seq[-1], seq[2:], list(seq) == [0, 10, 20, 30]
+    (4, 10, 30, [20, 30], True)
+    >>> del seq[1:]
+    >>> seq.append(99)
+    >>> seq == [0, 99]
+    True
+    """
+
+    def __init__(self, read, stored, cache_size=STORED_BLOCK_CACHE_SIZE):
+        self.read = read
+        self.stored = stored
+        self._cache = utils.LRUCache(cache_size)
+        self._items = []
+
+    def __len__(self):
+        return self.stored + len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("index out of range")
+        if index >= self.stored:
+            return self._items[index - self.stored]
+        item = self._cache.get(index)
+        if item is None:
+            item = self.read(index)
+            self._cache.put(index, item)
+        return item
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice) or index.stop is not None or index.step is not None:
+            raise TypeError("only del seq[height:] is supported")
+        height = min(max(index.start or 0, 0), len(self))
+        if height < self.stored:
+            self._items = []
+            self.stored = height
+            self._cache = utils.LRUCache(self._cache.maxsize)
+        else:
+            del self._items[height - self.stored:]
+
+    def append(self, item):
+        self._items.append(item)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return f"StoredSequence(stored={self.stored}, length={len(self)})"
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,424 @@
+import collections
+import functools
+import struct
+
+import base58
+
+CODEC_VERSION = 1
+CONTENT_TYPE = "application/vnd.pyblockchain.v1+octet-stream"
+JSON_CONTENT_TYPE = "application/json"
+
+ADDRESS_SIZE = 25
+HASH_SIZE = 32
+PUBLIC_KEY_SIZE = 64
+SIGNATURE_SIZE = 64
+
+# 可変長の値の先頭につけるtag
+TAG_RAW = 0
+TAG_TEXT = 1
+
+# transactionのflag
+FLAG_SIGNED = 1
+
+BLOCK_HEADER = struct.Struct(">BdQ")
+CHAIN_HEADER = struct.Struct(">BQQI")
+COUNT = struct.Struct(">I")
+VALUE = struct.Struct(">d")
+TEXT_LENGTH = struct.Struct(">H")
+
+BLOCK_KEYS = frozenset(("nonce", "previous_hash", "timestamp", "transactions"))
+BLOCK_V2_KEYS = BLOCK_KEYS | {"merkle_root", "version"}
+TRANSACTION_KEYS = frozenset((
+    "recipient_blockchain_address", "sender_blockchain_address", "value"))
+SIGNED_TRANSACTION_KEYS = TRANSACTION_KEYS | {"sender_public_key", "signature"}
+
+
+def _pack_field(name, pack, *args):
+    """
+    pack(*args)のstruct.errorを値の名前を含むValueErrorにする
+
+    See Also
+    --------
+    >>> _pack_field("nonce", BLOCK_HEADER.pack, 1, 0.0, 2 ** 64)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ValueError: nonce does not fit the binary layout: ...
+    """
+    try:
+        return pack(*args)
+    except (struct.error, OverflowError) as ex:
+        raise ValueError(f"{name} does not fit the binary layout: {ex}") from None
+
+
+def _pack_text(text):
+    data = text.encode()
+    return bytes((TAG_TEXT,)) + TEXT_LENGTH.pack(len(data)) + data
+
+
+@functools.lru_cache(maxsize=4096)
+def _pack_hex(value, size):
+    """
+    小文字の16進数でsize bytesの値はbytesで，それ以外は文字列のまま保存する
+
+    See Also
+    --------
+    >>> _pack_hex("ab" * 32, 32) == bytes((TAG_RAW,)) + bytes.fromhex("ab" * 32)
+    True
+    >>> _pack_hex("hash", 32)
+    b'\\x01\\x00\\x04hash'
+    """
+    if len(value) == size * 2:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            raw = None
+        if raw is not None and raw.hex() == value:
+            return bytes((TAG_RAW,)) + raw
+    return _pack_text(value)
+
+
+@functools.lru_cache(maxsize=4096)
+def _pack_address(address):
+    """
+    base58のaddressは25 bytesで，それ以外（MINING_SENDERなど）は文字列のまま保存する
+
+    See Also
+    --------
+    >>> len(_pack_address("1HN2qZXDkEs9oe5nE2h7jdwFZKxLCLkYdE"))
+    26
+    >>> _pack_address("THE BLOCKCHAIN")
+    b'\\x01\\x00\\x0eTHE BLOCKCHAIN'
+    """
+    try:
+        raw = base58.b58decode(address)
+    except ValueError:
+        raw = None
+    if raw is not None and len(raw) == ADDRESS_SIZE:
+        encoded = base58.b58encode(raw)
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode()
+        if encoded == address:
+            return bytes((TAG_RAW,)) + raw
+    return _pack_text(address)
+
+
+@functools.lru_cache(maxsize=4096)
+def _address_from_raw(raw):
+    encoded = base58.b58encode(raw)
+    return encoded.decode() if isinstance(encoded, bytes) else encoded
+
+
+def _read_text(data, position):
+    (length,) = TEXT_LENGTH.unpack_from(data, position)
+    position += TEXT_LENGTH.size
+    end = position + length
+    if end > len(data):
+        raise ValueError("truncated data")
+    return data[position:end].decode(), end
+
+
+def _read_hex(data, position, size):
+    if data[position] == TAG_RAW:
+        end = position + 1 + size
+        if end > len(data):
+            raise ValueError("truncated data")
+        return data[position + 1:end].hex(), end
+    return _read_text(data, position + 1)
+
+
+def _read_address(data, position):
+    if data[position] == TAG_RAW:
+        end = position + 1 + ADDRESS_SIZE
+        if end > len(data):
+            raise ValueError("truncated data")
+        return _address_from_raw(data[position + 1:end]), end
+    return _read_text(data, position + 1)
+
+
+def encode_transaction(transaction):
+    """
+    transactionを固定layoutのbytesにする
+    keyの順番に関係なく同じ内容は同じbytesになる
+    keyをsortした順に並べる（decodeでそのままOrderedDictにできる）
+
+        flags (1) | recipient | sender
+        | sender_public_key (64) | signature (64)   ※ FLAG_SIGNEDの場合
+        | value (8, double)
+
+    Parameters
+    ----------
+    transaction: dict
+
+    Returns
+    -------
+    bytes
+
+    See Also
+    --------
+    >>> tx = {"sender_blockchain_address": "THE BLOCKCHAIN", "recipient_blockchain_address": "1HN2qZXDkEs9oe5nE2h7jdwFZKxLCLkYdE", "value": 1.0}
+    >>> decode_transaction(encode_transaction(tx)) == tx
+    True
+    >>> encode_transaction(dict(tx, sender_blockchain_address="A" * 65536))  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ValueError: sender_blockchain_address does not fit the binary layout: ...
+    """
+    keys = transaction.keys()
+    if keys == SIGNED_TRANSACTION_KEYS:
+        flags = FLAG_SIGNED
+    elif keys == TRANSACTION_KEYS:
+        flags = 0
+    else:
+        raise ValueError(f"unknown transaction keys: {sorted(keys)}")
+    parts = [
+        bytes((flags,)),
+        _pack_field("recipient_blockchain_address", _pack_address,
+                    transaction["recipient_blockchain_address"]),
+        _pack_field("sender_blockchain_address", _pack_address,
+                    transaction["sender_blockchain_address"])
+    ]
+    if flags & FLAG_SIGNED:
+        parts.append(_pack_field(
+            "sender_public_key", _pack_hex,
+            transaction["sender_public_key"], PUBLIC_KEY_SIZE))
+        parts.append(_pack_field(
+            "signature", _pack_hex, transaction["signature"], SIGNATURE_SIZE))
+    parts.append(_pack_field(
+        "value", lambda value: VALUE.pack(float(value)), transaction["value"]))
+    return b"".join(parts)
+
+
+def _read_transaction(data, position):
+    flags = data[position]
+    transaction = collections.OrderedDict()
+    transaction["recipient_blockchain_address"], position = _read_address(
+        data, position + 1)
+    transaction["sender_blockchain_address"], position = _read_address(
+        data, position)
+    if flags & FLAG_SIGNED:
+        transaction["sender_public_key"], position = _read_hex(
+            data, position, PUBLIC_KEY_SIZE)
+        transaction["signature"], position = _read_hex(
+            data, position, SIGNATURE_SIZE)
+    (transaction["value"],) = VALUE.unpack_from(data, position)
+    return transaction, position + VALUE.size
+
+
+def decode_transaction(data):
+    """
+    Returns
+    -------
+    transaction : collections.OrderedDict
+        keyでsortしたもの
+    """
+    try:
+        return _read_transaction(bytes(data), 0)[0]
+    except (struct.error, IndexError) as ex:
+        raise ValueError(f"truncated data: {ex}")
+
+
+def encode_block(block):
+    """
+    blockを固定layoutのbytesにする（canonical: 同じ内容は常に同じbytes）
+
+        blockのversion (1) | timestamp (8, double) | nonce (8)
+        | previous_hash (32) | merkle_root (32)   ※ version 2の場合
+        | transaction数 (4) | transactions
+
+    Parameters
+    ----------
+    block: dict
+
+    Returns
+    -------
+    bytes
+
+    See Also
+    --------
+    >>> block = {"nonce": 7, "previous_hash": "ab" * 32, "timestamp": 1.5,
+    ...          "transactions": [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": 2.0}]}
+    >>> data = encode_block(block)
+    >>> len(data), decode_block(data) == block
+    (71, True)
+    >>> encode_block(dict(reversed(list(block.items())))) == data
+    True
+    >>> block_v2 = dict(block, merkle_root="cd" * 32, version=2)
+    >>> decode_block(encode_block(block_v2)) == block_v2
+    True
+    >>> encode_block(dict(block, nonce=2 ** 64))  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ValueError: nonce does not fit the binary layout: ...
+    """
+    keys = block.keys()
+    if keys == BLOCK_KEYS:
+        version = 1
+    elif keys == BLOCK_V2_KEYS and block["version"] == 2:
+        version = 2
+    else:
+        raise ValueError(f"unknown block keys: {sorted(keys)}")
+    transactions = block["transactions"]
+    timestamp = _pack_field("timestamp", float, block["timestamp"])
+    parts = [
+        # version・timestampは必ず収まるので，失敗するのはnonce
+        _pack_field("nonce", BLOCK_HEADER.pack, version, timestamp, block["nonce"]),
+        _pack_field("previous_hash", _pack_hex, block["previous_hash"], HASH_SIZE)
+    ]
+    if version == 2:
+        parts.append(_pack_field(
+            "merkle_root", _pack_hex, block["merkle_root"], HASH_SIZE))
+    parts.append(_pack_field("transactions", COUNT.pack, len(transactions)))
+    parts.extend(encode_transaction(transaction) for transaction in transactions)
+    return b"".join(parts)
+
+
+def _read_block(data, position):
+    version, timestamp, nonce = BLOCK_HEADER.unpack_from(data, position)
+    if version not in (1, 2):
+        raise ValueError(f"unknown block version: {version}")
+    previous_hash, position = _read_hex(data, position + BLOCK_HEADER.size, HASH_SIZE)
+    if version == 2:
+        merkle_root, position = _read_hex(data, position, HASH_SIZE)
+    (count,) = COUNT.unpack_from(data, position)
+    position += COUNT.size
+    transactions = []
+    for _ in range(count):
+        transaction, position = _read_transaction(data, position)
+        transactions.append(transaction)
+    block = collections.OrderedDict()
+    if version == 2:
+        block["merkle_root"] = merkle_root
+    block["nonce"] = nonce
+    block["previous_hash"] = previous_hash
+    block["timestamp"] = timestamp
+    block["transactions"] = transactions
+    if version == 2:
+        block["version"] = version
+    return block, position
+
+
+def decode_block(data):
+    """
+    Returns
+    -------
+    block : collections.OrderedDict
+        keyでsortしたもの（BlockChain.create_blockと同じ形）
+    """
+    try:
+        return _read_block(bytes(data), 0)[0]
+    except (struct.error, IndexError) as ex:
+        raise ValueError(f"truncated data: {ex}")
+
+
+def encode_chain(blocks, start_height, height):
+    """
+    GET /chainのresponseをbytesにする
+
+        version (1) | start_height (8) | height (8) | block数 (4)
+        | block数 x (blockのbytes数 (4) | block)
+
+    See Also
+    --------
+    >>> blocks = [{"nonce": 0, "previous_hash": "hash", "timestamp": 0.0, "transactions": []}]
+    >>> data = encode_chain(blocks, 0, 0)
+    >>> decode_chain(data) == {"chain": blocks, "start_height": 0, "height": 0}
+    True
+    >>> decode_chain(data[:-3])  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ValueError: truncated data: ...
+    """
+    parts = [CHAIN_HEADER.pack(CODEC_VERSION, start_height, height, len(blocks))]
+    for block in blocks:
+        data = encode_block(block)
+        parts.append(COUNT.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_chain(data):
+    """
+    Returns
+    -------
+    response : dict
+        GET /chainのjsonと同じ形 {"chain", "start_height", "height"}
+    """
+    data = bytes(data)
+    try:
+        version, start_height, height, count = CHAIN_HEADER.unpack_from(data, 0)
+        if version != CODEC_VERSION:
+            raise ValueError(f"unknown codec version: {version}")
+        position = CHAIN_HEADER.size
+        blocks = []
+        for _ in range(count):
+            (length,) = COUNT.unpack_from(data, position)
+            position += COUNT.size
+            block, end = _read_block(data, position)
+            if end != position + length:
+                raise ValueError("invalid block length")
+            blocks.append(block)
+            position = end
+    except (struct.error, IndexError) as ex:
+        raise ValueError(f"truncated data: {ex}")
+    return {"chain": blocks, "start_height": start_height, "height": height}
+
+
+def benchmark(blocks=200, transactions=50, repeat=5):
+    """
+    jsonとのsize・encode/decodeの速度を比較する
+
+    $ python codec.py
+
+    Returns
+    -------
+    results : dict
+        format -> {"bytes", "encode_sec", "decode_sec"}
+    """
+    import json
+    import time
+
+    import wallet
+
+    senders = [wallet.Wallet() for _ in range(4)]
+    chain = []
+    previous_hash = "0" * 64
+    for i in range(blocks):
+        txs = [collections.OrderedDict(sorted({
+            "sender_blockchain_address": senders[j % 4].blockchain_address,
+            "recipient_blockchain_address": senders[(j + 1) % 4].blockchain_address,
+            "value": 0.1 * j,
+            "sender_public_key": senders[j % 4].public_key,
+            "signature": "%0128x" % (i * transactions + j)
+        }.items())) for j in range(transactions)]
+        chain.append(collections.OrderedDict((
+            ("nonce", 1000 + i), ("previous_hash", previous_hash),
+            ("timestamp", time.time()), ("transactions", txs))))
+        previous_hash = "%064x" % i
+
+    def measure(encode, decode):
+        data = encode()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            encode()
+        encode_sec = (time.perf_counter() - started) / repeat
+        started = time.perf_counter()
+        for _ in range(repeat):
+            decode(data)
+        decode_sec = (time.perf_counter() - started) / repeat
+        return {"bytes": len(data), "encode_sec": encode_sec, "decode_sec": decode_sec}
+
+    response = {"chain": chain, "start_height": 0, "height": blocks - 1}
+    return {
+        "json": measure(lambda: json.dumps(response).encode(), json.loads),
+        "binary": measure(
+            lambda: encode_chain(chain, 0, blocks - 1), decode_chain)
+    }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+    for name, result in benchmark().items():
+        print(f"{name:7s} {result['bytes']:>10,d} bytes  "
+              f"encode {result['encode_sec'] * 1000:8.2f} ms  "
+              f"decode {result['decode_sec'] * 1000:8.2f} ms")
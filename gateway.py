@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+import requests
+
+import peer_client
+import utils
+
+GATEWAY_FAILURE_COOLDOWN_SEC = 5
+GATEWAY_LATENCY_ALPHA = 0.2
+BALANCE_CACHE_SIZE = 1024
+BALANCE_CACHE_TTL_SEC = 30
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayPool(object):
+    """
+    複数のgatewayへのrequestを，応答の速いgatewayから順に試す
+
+    ・connectionはPeerClientのsessionを使い回す
+    ・応答時間の指数移動平均が最も小さいgatewayを使う（未計測のgatewayは先に試す）
+    ・接続エラー・5xxの場合は次のgatewayに切り替え，失敗したgatewayは
+      GATEWAY_FAILURE_COOLDOWN_SEC秒の間後回しにする
+
+    Attributes
+    ----------
+    gateways : list of str
+
+    client : peer_client.PeerClient
+
+    See Also
+    --------
+    >>> pool = GatewayPool(["127.0.0.1:5000", "127.0.0.1:5001"])
+    >>> pool._record("127.0.0.1:5000", 0.05)
+    >>> pool._record("127.0.0.1:5001", 0.01)
+    >>> pool.ordered()
+    ['127.0.0.1:5001', '127.0.0.1:5000']
+    >>> pool._record("127.0.0.1:5001", None)
+    >>> pool.ordered()
+    ['127.0.0.1:5000', '127.0.0.1:5001']
+    """
+
+    def __init__(self, gateways, client=None,
+                 cooldown=GATEWAY_FAILURE_COOLDOWN_SEC):
+        if not gateways:
+            raise ValueError("no gateway")
+        self.gateways = list(gateways)
+        self.client = client or peer_client.PeerClient()
+        self.cooldown = cooldown
+        # gateway -> {"latency": 応答時間の移動平均, "failed_at": 最後に失敗した時刻}
+        self._stats = {
+            gateway: {"latency": None, "failed_at": None}
+            for gateway in self.gateways
+        }
+        self._lock = threading.Lock()
+
+    def ordered(self):
+        """
+        試す順のgateway
+        """
+        now = time.time()
+        with self._lock:
+            def key(gateway):
+                stats = self._stats[gateway]
+                failed_at = stats["failed_at"]
+                cooling = failed_at is not None and now - failed_at < self.cooldown
+                latency = stats["latency"]
+                return (cooling, latency is not None, latency or 0.0)
+            return sorted(self.gateways, key=key)
+
+    def select(self):
+        """
+        最も優先度の高いgateway
+        """
+        return self.ordered()[0]
+
+    def _record(self, gateway, elapsed):
+        """
+        応答時間を記録する．elapsedがNoneの場合は失敗
+        """
+        with self._lock:
+            stats = self._stats[gateway]
+            if elapsed is None:
+                stats["failed_at"] = time.time()
+                return
+            stats["failed_at"] = None
+            if stats["latency"] is None:
+                stats["latency"] = elapsed
+            else:
+                stats["latency"] += GATEWAY_LATENCY_ALPHA * (elapsed - stats["latency"])
+
+    def request(self, method, path, **kwargs):
+        """
+        gatewayにrequestする．失敗した場合は次のgatewayを試す
+
+        Returns
+        -------
+        (gateway, requests.Response) : tuple
+
+        Raises
+        ------
+        requests.RequestException
+            全てのgatewayに接続できない場合
+        """
+        response = None
+        error = None
+        for gateway in self.ordered():
+            start = time.perf_counter()
+            try:
+                response = self.client.request(method, gateway, path, **kwargs)
+            except requests.RequestException as ex:
+                error = ex
+                self._record(gateway, None)
+                logger.warning({
+                    "action": "gateway_failover",
+                    "gateway": gateway,
+                    "path": path,
+                    "ex": ex
+                })
+                continue
+            if response.status_code >= 500:
+                self._record(gateway, None)
+                logger.warning({
+                    "action": "gateway_failover",
+                    "gateway": gateway,
+                    "path": path,
+                    "status": response.status_code
+                })
+                continue
+            self._record(gateway, time.perf_counter() - start)
+            return gateway, response
+        if response is not None:
+            return gateway, response
+        raise error
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {gateway: dict(stats) for gateway, stats in self._stats.items()}
+
+
+class BalanceCache(object):
+    """
+    (blockchain_address, gatewayのtipのhash) -> 残高のcache
+
+    残高はblockが追加された場合にだけ変わるので，tipが同じ間は同じ値を返す
+    addressごとに最後のtipの残高だけを保持し，LRUとTTLで消える
+    tip_hash()をGET /amountに渡すと，tipが変わっていない場合gatewayは304を返す
+
+    See Also
+    --------
+    >>> cache = BalanceCache(maxsize=2, ttl=30)
+    >>> cache.put("A", "tip", 1.0)
+    >>> cache.get("A", "tip"), cache.get("A", "new tip"), cache.tip_hash("A")
+    (1.0, None, 'tip')
+    >>> cache.put("B", "tip", 2.0, now=0.0)
+    >>> cache.get("B", "tip") is None, cache.tip_hash("B") is None
+    (True, True)
+    """
+
+    def __init__(self, maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL_SEC):
+        self.ttl = ttl
+        self._cache = utils.LRUCache(maxsize)
+
+    def _fresh(self, blockchain_address):
+        cached = self._cache.get(blockchain_address)
+        if cached is None or time.time() - cached[2] > self.ttl:
+            return None
+        return cached
+
+    def get(self, blockchain_address, tip_hash):
+        cached = self._fresh(blockchain_address)
+        if cached is None or cached[0] != tip_hash:
+            return None
+        return cached[1]
+
+    def tip_hash(self, blockchain_address):
+        """
+        cacheしている残高のtipのhash．ない場合はNone
+        """
+        cached = self._fresh(blockchain_address)
+        return None if cached is None else cached[0]
+
+    def put(self, blockchain_address, tip_hash, amount, now=None):
+        if now is None:
+            now = time.time()
+        self._cache.put(blockchain_address, (tip_hash, amount, now))
+
+    def stats(self):
+        return self._cache.stats()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,193 @@
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+GOSSIP_BATCH_SIZE = 100
+GOSSIP_LINGER_SEC = 0.05
+GOSSIP_MAX_WORKERS = 8
+# PUT /consensusは相手のnodeがresolve_conflicts（最大でCONSENSUS_DEADLINE_SEC）を
+# 終えるまで返らないので，通常のtimeoutより長く待つ
+GOSSIP_CONSENSUS_TIMEOUT_SEC = 15
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster(object):
+    """
+    transaction・blockの同期をbackgroundのthreadで行う
+
+    ・送信する内容はqueueに入れるだけなので，呼び出し側はnodeの数に関係なくすぐに戻る
+    ・GOSSIP_LINGER_SECの間に溜まったものをまとめて送る
+        transaction: 重複を除き，GOSSIP_BATCH_SIZEずつPUT /transactions/batchで送る
+        consensus: 最後に1回だけ送る
+    ・nodeごとの送信順は保つ
+
+    Attributes
+    ----------
+    client : peer_client.PeerClient
+
+    get_neighbours : callable
+        送信先のnodeのlistを返す
+
+    stats : dict
+        queueに入れた数，まとめて減った数，送ったrequest数
+    """
+
+    def __init__(self, client, get_neighbours):
+        self.client = client
+        self.get_neighbours = get_neighbours
+        self.stats = collections.Counter()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def send_transaction(self, transaction):
+        """
+        Parameters
+        ----------
+        transaction : dict
+            PUT /transactionsと同じ形式
+        """
+        self._put(("transaction", transaction))
+
+    def consensus(self):
+        self._put(("consensus", None))
+
+    def flush(self):
+        """
+        queueに入っているものを全て送り終わるまで待つ
+        """
+        self._queue.join()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._executor.shutdown()
+            self._thread = None
+            self._executor = None
+
+    def _put(self, message):
+        # 送信先がない場合は何もしない
+        if not self.get_neighbours():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=GOSSIP_MAX_WORKERS)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self.stats["queued"] += 1
+        self._queue.put(message)
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                self._queue.task_done()
+                return
+            messages = [message]
+            deadline = time.monotonic() + GOSSIP_LINGER_SEC
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if message is None:
+                    # stop()は溜まっているものを送ってから止める
+                    self._queue.put(None)
+                    self._queue.task_done()
+                    break
+                messages.append(message)
+            try:
+                self._send(self.coalesce(messages))
+            except Exception as ex:
+                logger.error({"action": "gossip", "ex": ex})
+            finally:
+                for _ in messages:
+                    self._queue.task_done()
+
+    def coalesce(self, messages):
+        """
+        messagesをnodeに送るrequestのlistにまとめる
+
+        Parameters
+        ----------
+        messages : list of tuple
+            [(kind, payload)]
+
+        Returns
+        -------
+        requests : list of tuple
+            [(method, path, json)]
+
+        See Also
+        --------
+        >>> broadcaster = Broadcaster(None, list)
+        >>> tx_1 = {"signature": "1"}
+        >>> tx_2 = {"signature": "2"}
+        >>> messages = [("transaction", tx_1), ("consensus", None), ("transaction", tx_1),
+        ...             ("transaction", tx_2), ("consensus", None)]
+        >>> for request in broadcaster.coalesce(messages):
+        ...     print(request)
+        ('PUT', 'transactions/batch', {'transactions': [{'signature': '1'}, {'signature': '2'}]})
+        ('PUT', 'consensus', None)
+        """
+        requests = []
+        transactions = []
+        seen = set()
+        consensus = False
+
+        def flush_transactions():
+            for i in range(0, len(transactions), GOSSIP_BATCH_SIZE):
+                requests.append((
+                    "PUT", "transactions/batch",
+                    {"transactions": transactions[i:i + GOSSIP_BATCH_SIZE]}))
+            transactions.clear()
+
+        for kind, payload in messages:
+            if kind == "transaction":
+                key = payload.get("signature") or repr(sorted(payload.items()))
+                if key in seen:
+                    self.stats["coalesced"] += 1
+                    continue
+                seen.add(key)
+                transactions.append(payload)
+            elif kind == "consensus":
+                if consensus:
+                    self.stats["coalesced"] += 1
+                consensus = True
+        flush_transactions()
+        if consensus:
+            requests.append(("PUT", "consensus", None))
+        return requests
+
+    def _send(self, requests):
+        nodes = self.get_neighbours()
+        futures = [
+            self._executor.submit(self._send_to_node, node, requests)
+            for node in nodes
+        ]
+        concurrent.futures.wait(futures)
+
+    def _send_to_node(self, node, requests):
+        for method, path, body in requests:
+            kwargs = {"json": body}
+            if path == "consensus":
+                kwargs["timeout"] = GOSSIP_CONSENSUS_TIMEOUT_SEC
+            self.client.broadcast(method, [node], path, **kwargs)
+            self.stats["sent"] += 1
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,223 @@
+import collections
+import logging
+import threading
+import time
+
+import utils
+import wallet
+
+KEYPOOL_SIZE = 256
+KEYPOOL_LOW_WATERMARK = 64
+KEYPOOL_BATCH_SIZE = 16
+KEYPOOL_WORKERS = 2
+# requestのthreadが動いている中でforkしないようにspawnで作る
+KEYPOOL_START_METHOD = "spawn"
+
+logger = logging.getLogger(__name__)
+
+
+def _generate_keypairs(count):
+    """
+    worker processでcount個のkeypairを作る（1回のprocess間通信でまとめて返す）
+    """
+    return [wallet.generate_keypair() for _ in range(count)]
+
+
+class KeyPool(object):
+    """
+    作成済みのkeypairのpool
+
+    ECDSAの鍵生成とaddressの計算（SHA-256・RIPEMD-160・Base58）をrequestの
+    threadから外し，POST /walletをqueueからのpopだけにする
+
+    ・残りがlow_watermark個を下回るとbackgroundのthreadが補充を始め，
+      worker processでsize個（high watermark）になるまで作る
+    ・poolが空の場合はrequestのthreadで作る（missとして数える）
+
+    Attributes
+    ----------
+    size : int
+        保持するkeypairの上限（high watermark）
+
+    low_watermark : int
+
+    batch_size : int
+        1回のworkerへの依頼で作る数
+
+    workers : int
+        worker process数．0の場合はbackgroundのthreadで作る
+
+    See Also
+    --------
+    >>> pool = KeyPool(size=4, low_watermark=2, batch_size=2, workers=0)
+    >>> pool.start()
+    >>> pool.wait_filled(timeout=10)
+    True
+    >>> sorted(pool.pop())
+    ['blockchain_address', 'private_key', 'public_key']
+    >>> pool.stop()
+    >>> metrics = pool.metrics()
+    >>> metrics["hits"], metrics["misses"], metrics["generated"] >= 4
+    (1, 0, True)
+    """
+
+    def __init__(self, size=KEYPOOL_SIZE, low_watermark=KEYPOOL_LOW_WATERMARK,
+                 batch_size=KEYPOOL_BATCH_SIZE, workers=KEYPOOL_WORKERS):
+        if not 0 <= low_watermark < size:
+            raise ValueError("low_watermark must be smaller than size")
+        self.size = size
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.workers = workers
+        self._keypairs = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._running = False
+        self._hits = 0
+        self._misses = 0
+        self._generated = 0
+        self._refills = 0
+        self._last_refill_sec = None
+
+    def __len__(self):
+        return len(self._keypairs)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        if self.workers:
+            self._executor = utils.process_pool(
+                self.workers, KEYPOOL_START_METHOD)
+        self._thread = threading.Thread(
+            target=self._run, name="keypool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def pop(self):
+        """
+        keypairを1つ取り出す
+
+        Returns
+        -------
+        keypair : dict
+            wallet.generate_keypair()と同じ形式
+        """
+        with self._condition:
+            try:
+                keypair = self._keypairs.popleft()
+            except IndexError:
+                keypair = None
+                self._misses += 1
+            else:
+                self._hits += 1
+            if len(self._keypairs) < self.low_watermark:
+                self._condition.notify_all()
+        if keypair is None:
+            keypair = wallet.generate_keypair()
+        return keypair
+
+    def wait_filled(self, timeout=None):
+        """
+        sizeまで補充されるのを待つ
+
+        Returns
+        -------
+        bool
+            timeoutした場合はFalse
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: len(self._keypairs) >= self.size, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: not self._running
+                    or len(self._keypairs) < self.low_watermark)
+                if not self._running:
+                    return
+            try:
+                self._refill()
+            except Exception as ex:
+                logger.error({"action": "keypool_refill", "ex": ex})
+                with self._condition:
+                    self._condition.wait(1)
+
+    def _refill(self):
+        """
+        size個になるまでbatch_size個ずつ作る
+        """
+        start = time.perf_counter()
+        generated = 0
+        while self._running:
+            missing = self.size - len(self._keypairs)
+            if missing <= 0:
+                break
+            batches = [
+                min(self.batch_size, missing - i)
+                for i in range(0, missing, self.batch_size)
+            ]
+            if self._executor is None:
+                results = (_generate_keypairs(count) for count in batches)
+            else:
+                results = self._executor.map(_generate_keypairs, batches)
+            for keypairs in results:
+                with self._condition:
+                    room = self.size - len(self._keypairs)
+                    self._keypairs.extend(keypairs[:room])
+                    self._generated += len(keypairs)
+                    self._condition.notify_all()
+                generated += len(keypairs)
+                if not self._running:
+                    break
+        elapsed = time.perf_counter() - start
+        with self._condition:
+            self._refills += 1
+            self._last_refill_sec = elapsed
+        logger.info({
+            "action": "keypool_refill",
+            "generated": generated,
+            "size": len(self._keypairs),
+            "elapsed": elapsed
+        })
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        metrics : dict
+            "available": 残りの数, "size", "low_watermark",
+            "hits": poolから返した数, "misses": requestのthreadで作った数,
+            "generated": backgroundで作った数, "refills": 補充の回数,
+            "last_refill_sec": 最後の補充にかかった秒数
+        """
+        with self._condition:
+            return {
+                "available": len(self._keypairs),
+                "size": self.size,
+                "low_watermark": self.low_watermark,
+                "hits": self._hits,
+                "misses": self._misses,
+                "generated": self._generated,
+                "refills": self._refills,
+                "last_refill_sec": self._last_refill_sec
+            }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,222 @@
+import collections
+import hashlib
+import threading
+import time
+
+import models
+
+MEMPOOL_MAX_SIZE = 10000
+
+
+def transaction_id(transaction):
+    """
+    transactionのid（sort_keysしたjsonのSHA-256）
+
+    Parameters
+    ----------
+    transaction: dict
+
+    Returns
+    -------
+    str
+
+    See Also
+    --------
+    >>> transaction_id({"b": 2, "a": 1}) == transaction_id({"a": 1, "b": 2})
+    True
+    """
+    return hashlib.sha256(models.canonical_json(transaction)).hexdigest()
+
+
+class Mempool(object):
+    """
+    mining前のtransactionを保持する
+
+    ・transaction idでO(1)に検索できる（重複を追加しない）
+    ・senderごとの未承認の送金額を保持する
+    ・maxsizeを超えた場合は最も古いtransactionから削除する（mining報酬は削除しない）
+    ・追加された順に取り出せる
+
+    Attributes
+    ----------
+    maxsize : int
+
+    mining_sender : str
+        mining報酬のsender．このsenderのtransactionは削除せず，selectで必ず選ぶ
+
+    evicted : int
+        maxsizeを超えて削除した数
+
+    on_add : callable
+        transactionを追加した後に(transaction)で呼ぶ（lockの外）．Noneの場合は呼ばない
+
+    See Also
+    --------
+    >>> pool = Mempool(maxsize=2)
+    >>> tx_1 = {"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": 1.0}
+    >>> tx_2 = {"sender_blockchain_address": "A", "recipient_blockchain_address": "C", "value": 2.0}
+    >>> tx_3 = {"sender_blockchain_address": "B", "recipient_blockchain_address": "C", "value": 3.0}
+    >>> pool.add(tx_1), pool.add(tx_1), pool.add(tx_2)
+    (True, False, True)
+    >>> pool.pending_debit("A")
+    3.0
+    >>> pool.add(tx_3)
+    True
+    >>> [t["value"] for t in pool], pool.evicted, pool.pending_debit("A")
+    ([2.0, 3.0], 1, 2.0)
+    """
+
+    def __init__(self, transactions=(), maxsize=MEMPOOL_MAX_SIZE,
+                 mining_sender=None):
+        self.maxsize = maxsize
+        self.mining_sender = mining_sender
+        self.evicted = 0
+        self.on_add = None
+        self._transactions = collections.OrderedDict()
+        self._added_at = {}
+        self._pending = collections.defaultdict(float)
+        self._lock = threading.RLock()
+        for transaction in transactions:
+            self.add(transaction)
+
+    def add(self, transaction):
+        """
+        Parameters
+        ----------
+        transaction: dict
+
+        Returns
+        -------
+        bool
+            既に含まれている場合はFalse
+        """
+        txid = transaction_id(transaction)
+        with self._lock:
+            if txid in self._transactions:
+                return False
+            while len(self._transactions) >= self.maxsize and self._evict():
+                pass
+            self._transactions[txid] = transaction
+            self._added_at[txid] = time.monotonic()
+            self._pending[transaction["sender_blockchain_address"]] += float(
+                transaction["value"])
+        if self.on_add is not None:
+            self.on_add(transaction)
+        return True
+
+    def append(self, transaction):
+        """
+        listと同じように使えるようにする
+        """
+        self.add(transaction)
+
+    def _evict(self):
+        for txid, transaction in self._transactions.items():
+            if transaction["sender_blockchain_address"] != self.mining_sender:
+                self._remove(txid)
+                self.evicted += 1
+                return True
+        return False
+
+    def _remove(self, txid):
+        transaction = self._transactions.pop(txid)
+        del self._added_at[txid]
+        sender = transaction["sender_blockchain_address"]
+        self._pending[sender] -= float(transaction["value"])
+        if self._pending[sender] <= 1e-9:
+            del self._pending[sender]
+        return transaction
+
+    def remove(self, txid):
+        """
+        Returns
+        -------
+        transaction : dict
+            含まれていない場合はNone
+        """
+        with self._lock:
+            if txid not in self._transactions:
+                return None
+            return self._remove(txid)
+
+    def remove_transactions(self, transactions):
+        """
+        blockに含まれたtransactionを削除する
+
+        Parameters
+        ----------
+        transactions: list of dicts
+        """
+        with self._lock:
+            for transaction in transactions:
+                txid = transaction_id(transaction)
+                if txid in self._transactions:
+                    self._remove(txid)
+
+    def get(self, txid):
+        return self._transactions.get(txid)
+
+    def pending_debit(self, sender_blockchain_address):
+        """
+        senderの未承認の送金額
+        """
+        return self._pending.get(sender_blockchain_address, 0.0)
+
+    def oldest_age(self):
+        """
+        最も古いtransactionが追加されてからの秒数．空の場合はNone
+        """
+        with self._lock:
+            for txid in self._added_at:
+                return time.monotonic() - self._added_at[txid]
+        return None
+
+    def select(self, limit=None):
+        """
+        miningするtransactionを古い順に選ぶ
+        mining報酬はlimitに関係なく含める
+
+        Parameters
+        ----------
+        limit: int
+            mining報酬以外のtransactionの最大数．Noneの場合は全て
+
+        Returns
+        -------
+        transactions : list of dicts
+        """
+        with self._lock:
+            if limit is None:
+                return list(self._transactions.values())
+            selected = []
+            count = 0
+            for transaction in self._transactions.values():
+                if transaction["sender_blockchain_address"] == self.mining_sender:
+                    selected.append(transaction)
+                elif count < limit:
+                    selected.append(transaction)
+                    count += 1
+            return selected
+
+    def copy(self):
+        return self.select()
+
+    def clear(self):
+        with self._lock:
+            self._transactions.clear()
+            self._added_at.clear()
+            self._pending.clear()
+
+    def __contains__(self, txid):
+        return txid in self._transactions
+
+    def __iter__(self):
+        return iter(self.select())
+
+    def __len__(self):
+        return len(self._transactions)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,174 @@
+import hashlib
+
+import models
+
+# leafとnodeのhashを区別する（leafをnodeとして偽装できないようにする）
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+
+
+def leaf_hash(transaction):
+    """
+    transactionのleafのhash
+
+    Parameters
+    ----------
+    transaction: dict
+
+    Returns
+    -------
+    bytes
+    """
+    return hashlib.sha256(LEAF_PREFIX + models.canonical_json(transaction)).digest()
+
+
+def _node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _levels(transactions):
+    """
+    leafからrootまでの各段のhash
+    奇数個の段では最後のhashをそのまま上の段に上げる（複製しない）
+    """
+    level = [leaf_hash(transaction) for transaction in transactions]
+    levels = [level]
+    while len(level) > 1:
+        parents = [
+            _node_hash(level[i], level[i + 1])
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+        levels.append(level)
+    return levels
+
+
+class MerkleTree(object):
+    """
+    1つのblockのMerkle tree
+    同じblockの複数のtransactionの証明を作る場合に各段のhashを使い回す
+
+    See Also
+    --------
+    >>> txs = [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": float(v)} for v in range(3)]
+    >>> tree = MerkleTree(txs)
+    >>> tree.root == merkle_root(txs), tree.proof(2) == merkle_proof(txs, 2)
+    (True, True)
+    """
+
+    def __init__(self, transactions):
+        self.size = len(transactions)
+        self._levels = _levels(transactions) if transactions else [[]]
+
+    @property
+    def root(self):
+        if not self.size:
+            return EMPTY_ROOT
+        return self._levels[-1][0].hex()
+
+    def proof(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        proof = []
+        for level in self._levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                side = "L" if sibling < index else "R"
+                proof.append([side, level[sibling].hex()])
+            index //= 2
+        return proof
+
+
+def merkle_root(transactions):
+    """
+    transactionsのMerkle root
+
+    Parameters
+    ----------
+    transactions: list of dicts
+
+    Returns
+    -------
+    str
+        16進数．空の場合はEMPTY_ROOT
+
+    See Also
+    --------
+    >>> txs = [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": float(v)} for v in range(3)]
+    >>> merkle_root([]) == EMPTY_ROOT
+    True
+    >>> merkle_root(txs[:1]) == leaf_hash(txs[0]).hex()
+    True
+    >>> merkle_root(txs) == _node_hash(_node_hash(leaf_hash(txs[0]), leaf_hash(txs[1])), leaf_hash(txs[2])).hex()
+    True
+    """
+    return MerkleTree(transactions).root
+
+
+def merkle_proof(transactions, index):
+    """
+    transactions[index]がrootに含まれることの証明
+
+    Parameters
+    ----------
+    transactions: list of dicts
+
+    index: int
+
+    Returns
+    -------
+    proof : list of list
+        leafに近い順の[side, hash]．sideは兄弟のnodeが"L"（左）か"R"（右）か
+
+    See Also
+    --------
+    >>> txs = [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": float(v)} for v in range(5)]
+    >>> root = merkle_root(txs)
+    >>> all(verify_proof(txs[i], merkle_proof(txs, i), root) for i in range(5))
+    True
+    >>> [side for side, _ in merkle_proof(txs, 4)]
+    ['L']
+    >>> verify_proof(txs[1], merkle_proof(txs, 0), root)
+    False
+    """
+    return MerkleTree(transactions).proof(index)
+
+
+def verify_proof(transaction, proof, root):
+    """
+    merkle_proofを確認する
+
+    Parameters
+    ----------
+    transaction: dict
+
+    proof: list of list
+        merkle_proofの戻り値
+
+    root: str
+
+    Returns
+    -------
+    bool
+    """
+    digest = leaf_hash(transaction)
+    try:
+        for side, sibling in proof:
+            sibling = bytes.fromhex(sibling)
+            if side == "L":
+                digest = _node_hash(sibling, digest)
+            elif side == "R":
+                digest = _node_hash(digest, sibling)
+            else:
+                return False
+    except (TypeError, ValueError):
+        return False
+    return digest.hex() == root
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
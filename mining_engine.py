@@ -0,0 +1,410 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import models
+import utils
+
+# workerが停止フラグを確認する間隔（hash回数）
+CHECK_INTERVAL = 1024
+# scheduler・requestのthreadが動いている中でforkしないようにspawnで作る
+MINING_START_METHOD = "spawn"
+
+logger = logging.getLogger(__name__)
+
+
+def check_difficulty(digest, difficulty):
+    """
+    hash（bytes）の先頭がdifficulty個の"0"（16進数）で始まるか確認する
+
+    Parameters
+    ----------
+    digest: bytes
+
+    difficulty: int
+
+    Returns
+    -------
+    bool
+
+    See Also
+    --------
+    >>> check_difficulty(bytes.fromhex("000fff"), 3)
+    True
+    >>> check_difficulty(bytes.fromhex("000fff"), 4)
+    False
+    >>> check_difficulty(bytes.fromhex("00ffff"), 3)
+    False
+    """
+    full, half = divmod(difficulty, 2)
+    if digest[:full] != bytes(full):
+        return False
+    return not half or digest[full] < 0x10
+
+
+def proof_fields(transactions, previous_hash, merkle_root=None):
+    """
+    PoWでhashするnonce以外のfield
+
+    version 1: {"previous_hash", "transactions"}（transactionsを全て含む）
+    version 2: {"merkle_root", "previous_hash"}（固定長）
+
+    See Also
+    --------
+    >>> sorted(proof_fields([], "hash"))
+    ['previous_hash', 'transactions']
+    >>> sorted(proof_fields([], "hash", "root"))
+    ['merkle_root', 'previous_hash']
+    """
+    if merkle_root is None:
+        return {"previous_hash": previous_hash, "transactions": transactions}
+    return {"merkle_root": merkle_root, "previous_hash": previous_hash}
+
+
+class ProofTemplate(object):
+    """
+    nonce以外を事前にserializeしたblockのテンプレート
+
+    json.dumps(sort_keys=True)で"nonce"より前のkeyまでをhash済みのprefixとしてcopyし，
+    nonceとその後ろのbytesだけを追加する
+    BlockChain.hashと同じhashを返す
+
+    Attributes
+    ----------
+    _prefix : hashlib.sha256
+        '"nonce": 'までをupdateしたhash object
+
+    _suffix : bytes
+        nonceの後ろのkeyをserializeしたもの
+    """
+
+    def __init__(self, transactions, previous_hash, merkle_root=None):
+        fields = proof_fields(transactions, previous_hash, merkle_root)
+        # chainのblockのtransactionsはmodels.Transaction
+        before = json.dumps(
+            {key: value for key, value in fields.items() if key < "nonce"},
+            sort_keys=True, default=models.to_dict)
+        after = json.dumps(
+            {key: value for key, value in fields.items() if key > "nonce"},
+            sort_keys=True, default=models.to_dict)
+        prefix = before[:-1] + (", " if before != "{}" else "") + '"nonce": '
+        suffix = ", " + after[1:] if after != "{}" else "}"
+        self._prefix = hashlib.sha256(prefix.encode())
+        self._suffix = suffix.encode()
+
+    def digest(self, nonce):
+        """
+        Parameters
+        ----------
+        nonce: int
+
+        Returns
+        -------
+        bytes
+
+        See Also
+        --------
+        >>> transactions = [{"value": 1.0, "sender_blockchain_address": "B", "recipient_blockchain_address": "A"}]
+        >>> guess_block = utils.sorted_dict_by_key({"transactions": transactions, "nonce": 42, "previous_hash": "hash"})
+        >>> expected = hashlib.sha256(json.dumps(guess_block, sort_keys=True).encode()).hexdigest()
+        >>> ProofTemplate(transactions, "hash").digest(42).hex() == expected
+        True
+        >>> header = {"merkle_root": "root", "nonce": 42, "previous_hash": "hash"}
+        >>> expected = hashlib.sha256(json.dumps(header, sort_keys=True).encode()).hexdigest()
+        >>> ProofTemplate(None, "hash", "root").digest(42).hex() == expected
+        True
+        """
+        sha256 = self._prefix.copy()
+        sha256.update(b"%d" % nonce)
+        sha256.update(self._suffix)
+        return sha256.digest()
+
+    def hash(self, nonce):
+        return self.digest(nonce).hex()
+
+    def is_valid(self, nonce, difficulty):
+        return check_difficulty(self.digest(nonce), difficulty)
+
+    def search(self, start, step, difficulty, count):
+        """
+        start, start + step, ... の順にcount回探索する
+
+        Returns
+        -------
+        nonce : int
+            見つからなかった場合はNone
+        """
+        full, half = divmod(difficulty, 2)
+        zeros = bytes(full)
+        prefix = self._prefix
+        suffix = self._suffix
+        nonce = start
+        for _ in range(count):
+            sha256 = prefix.copy()
+            sha256.update(b"%d" % nonce)
+            sha256.update(suffix)
+            digest = sha256.digest()
+            if digest[:full] == zeros and (not half or digest[full] < 0x10):
+                return nonce
+            nonce += step
+        return None
+
+
+def valid_proof(transactions, previous_hash, nonce, difficulty, merkle_root=None):
+    """
+    nonceが条件を満たすか確認する．
+    BlockChain.valid_proofと同じ計算をworkerプロセスからも呼べるようにする
+
+    Parameters
+    ----------
+    transactions: list of dicts
+
+    previous_hash: str
+
+    nonce: int
+
+    difficulty: int
+        hash化した文字列の先頭"0"の連続数
+
+    merkle_root: str
+        version 2のblockの場合．transactionsの代わりにhashする
+
+    Returns
+    -------
+    bool
+
+    See Also
+    --------
+    >>> valid_proof([], "hash", 0, 0)
+    True
+    >>> valid_proof([], "hash", 0, 64)
+    False
+    """
+    return ProofTemplate(transactions, previous_hash, merkle_root).is_valid(
+        nonce, difficulty)
+
+
+class SerialEngine(object):
+    """
+    1つのスレッドでnonceを0から順に探索する
+
+    Attributes
+    ----------
+    workers : int
+        常に1
+
+    stats : dict
+        直前の探索のhash数，経過時間，hashes/sec
+    """
+
+    mode = "serial"
+
+    def __init__(self):
+        self.workers = 1
+        self.stats = {}
+
+    def search(self, transactions, previous_hash, difficulty, merkle_root=None):
+        """
+        条件を満たすnonceを探索する
+
+        Parameters
+        ----------
+        transactions: list of dicts
+
+        previous_hash: str
+
+        difficulty: int
+
+        merkle_root: str
+            version 2のblockの場合．transactionsの代わりにhashする
+
+        Returns
+        -------
+        nonce : int
+
+        See Also
+        --------
+        >>> engine = SerialEngine()
+        >>> engine.search([], "hash", 2)
+        300
+        >>> engine.stats["hashes"]
+        301
+        """
+        started = time.perf_counter()
+        template = ProofTemplate(transactions, previous_hash, merkle_root)
+        start = 0
+        nonce = None
+        while nonce is None:
+            nonce = template.search(start, 1, difficulty, CHECK_INTERVAL)
+            start += CHECK_INTERVAL
+        self._record(nonce + 1, started)
+        return nonce
+
+    def close(self):
+        pass
+
+    def _record(self, hashes, started):
+        elapsed = time.perf_counter() - started
+        self.stats = {
+            "mode": self.mode,
+            "workers": self.workers,
+            "hashes": hashes,
+            "elapsed": elapsed,
+            "hash_rate": hashes / elapsed if elapsed > 0 else 0.0
+        }
+
+
+def _init_worker(found):
+    """
+    workerプロセスに停止フラグを渡す
+    """
+    global _found
+    _found = found
+
+
+def _search_worker(args):
+    """
+    start, start + step, start + 2 * step, ... の順にnonceを探索する
+    CHECK_INTERVALごとに他のworkerが見つけていないか確認する
+
+    Returns
+    -------
+    (nonce, hashes) : tuple
+        見つからずに停止した場合nonceはNone
+    """
+    transactions, previous_hash, merkle_root, difficulty, start, step = args
+    template = ProofTemplate(transactions, previous_hash, merkle_root)
+    hashes = 0
+    while not _found.is_set():
+        nonce = template.search(start, step, difficulty, CHECK_INTERVAL)
+        if nonce is not None:
+            _found.set()
+            return nonce, hashes + (nonce - start) // step + 1
+        hashes += CHECK_INTERVAL
+        start += step * CHECK_INTERVAL
+    return None, hashes
+
+
+class ParallelEngine(SerialEngine):
+    """
+    nonce空間をworker数で分割し，プロセスプールで探索する
+    最初に見つけたworkerが停止フラグを立て，他のworkerは探索をやめる
+
+    Attributes
+    ----------
+    workers : int
+        workerプロセス数
+
+    stats : dict
+        直前の探索のhash数，経過時間，hashes/sec
+    """
+
+    mode = "parallel"
+
+    def __init__(self, workers=None):
+        super().__init__()
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._found = None
+        self._lock = threading.Lock()
+
+    def search(self, transactions, previous_hash, difficulty, merkle_root=None):
+        """
+        条件を満たすnonceを探索する
+
+        Parameters
+        ----------
+        transactions: list of dicts
+
+        previous_hash: str
+
+        difficulty: int
+
+        merkle_root: str
+            version 2のblockの場合．transactionsの代わりにhashする
+
+        Returns
+        -------
+        nonce : int
+
+        See Also
+        --------
+        >>> engine = ParallelEngine(workers=2)
+        >>> nonce = engine.search([], "hash", 2)
+        >>> valid_proof([], "hash", nonce, 2)
+        True
+        >>> engine.stats["workers"]
+        2
+        >>> engine.close()
+        """
+        with self._lock:
+            if self._pool is None:
+                ctx = multiprocessing.get_context(MINING_START_METHOD)
+                self._found = ctx.Event()
+                self._pool = ctx.Pool(
+                    self.workers, initializer=_init_worker,
+                    initargs=(self._found,))
+            self._found.clear()
+
+            started = time.perf_counter()
+            tasks = [
+                (transactions, previous_hash, merkle_root, difficulty, start,
+                 self.workers)
+                for start in range(self.workers)
+            ]
+            nonce = None
+            hashes = 0
+            for worker_nonce, worker_hashes in self._pool.imap_unordered(
+                    _search_worker, tasks):
+                hashes += worker_hashes
+                if nonce is None and worker_nonce is not None:
+                    nonce = worker_nonce
+                    self._found.set()
+            self._record(hashes, started)
+            return nonce
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+def create_engine(mode="serial", workers=None):
+    """
+    miningのengineを作成する
+
+    Parameters
+    ----------
+    mode: str
+        "serial" or "parallel"
+
+    workers: int
+        parallelの場合のworkerプロセス数．Noneの場合はCPU数
+
+    Returns
+    -------
+    SerialEngine or ParallelEngine
+
+    See Also
+    --------
+    >>> create_engine().mode
+    'serial'
+    >>> create_engine("parallel", 4).workers
+    4
+    """
+    if mode == "serial":
+        return SerialEngine()
+    if mode == "parallel":
+        return ParallelEngine(workers)
+    raise ValueError(f"unknown mining mode: {mode}")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,420 @@
+import collections
+import collections.abc
+import hashlib
+import json
+import sys
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+BLOCK_V1_KEYS = frozenset(("nonce", "previous_hash", "timestamp", "transactions"))
+BLOCK_V2_KEYS = BLOCK_V1_KEYS | {"merkle_root", "version"}
+BLOCK_HEADER_KEYS = ("merkle_root", "nonce", "previous_hash", "timestamp", "version")
+
+
+class _Frozen(collections.abc.Mapping):
+    """
+    __slots__の値をdictと同じように読めるようにする（書き換えはできない）
+
+    keyはfieldsをsortした順．値がNoneのfieldはkeyに含めない
+    """
+
+    __slots__ = ()
+    fields = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.fields:
+            if getattr(self, key) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __reduce__(self):
+        return (type(self).from_dict, (self.to_dict(),))
+
+
+class Transaction(_Frozen):
+    """
+    block・transaction poolのtransaction
+
+    OrderedDictの代わりに__slots__で持つ．dictと同じように["value"]などで読め，
+    canonical_json()はjson.dumps(transaction, sort_keys=True)と同じbytesを返す
+
+    Attributes
+    ----------
+    recipient_blockchain_address : str
+
+    sender_blockchain_address : str
+
+    sender_public_key : str
+        mining報酬の場合はNone
+
+    signature : str
+        mining報酬の場合はNone
+
+    value : float
+
+    See Also
+    --------
+    >>> tx = {"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": 1.0}
+    >>> transaction = Transaction.from_dict(tx)
+    >>> transaction["value"], list(transaction)
+    (1.0, ['recipient_blockchain_address', 'sender_blockchain_address', 'value'])
+    >>> transaction == tx, transaction.canonical_json() == json.dumps(tx, sort_keys=True).encode()
+    (True, True)
+    >>> transaction.value = 2.0
+    Traceback (most recent call last):
+        ...
+    AttributeError: Transaction is immutable
+    """
+
+    fields = (
+        "recipient_blockchain_address",
+        "sender_blockchain_address",
+        "sender_public_key",
+        "signature",
+        "value"
+    )
+    __slots__ = fields
+
+    def __init__(self, recipient_blockchain_address, sender_blockchain_address,
+                 value, sender_public_key=None, signature=None):
+        # addressとpublic keyは多くのtransactionで同じなので共有する
+        setattr_ = object.__setattr__
+        setattr_(self, "recipient_blockchain_address",
+                 sys.intern(recipient_blockchain_address))
+        setattr_(self, "sender_blockchain_address",
+                 sys.intern(sender_blockchain_address))
+        setattr_(self, "sender_public_key",
+                 None if sender_public_key is None else sys.intern(sender_public_key))
+        setattr_(self, "signature", signature)
+        setattr_(self, "value", value)
+
+    @classmethod
+    def from_dict(cls, transaction):
+        """
+        Parameters
+        ----------
+        transaction: dict
+
+        Returns
+        -------
+        Transaction
+            既にTransactionの場合はそのまま返す
+        """
+        if isinstance(transaction, cls):
+            return transaction
+        unknown = set(transaction) - set(cls.fields)
+        if unknown:
+            raise ValueError(f"unknown transaction keys: {sorted(unknown)}")
+        return cls(**transaction)
+
+    def to_dict(self):
+        return collections.OrderedDict(self.items())
+
+    def canonical_json(self):
+        """
+        json.dumps(transaction, sort_keys=True).encode()と同じbytes
+        """
+        parts = []
+        for key in self:
+            value = getattr(self, key)
+            if key == "value":
+                encoded = json.dumps(value)
+            else:
+                encoded = _encode_string(value)
+            parts.append(f'"{key}": {encoded}')
+        return ("{" + ", ".join(parts) + "}").encode()
+
+
+class Block(_Frozen):
+    """
+    chainのblock
+
+    OrderedDictの代わりに__slots__で持ち，transactionsはTransactionのtuple
+    dictと同じように["transactions"]などで読め，dictのblockとも比較できる
+    hashは1度だけ計算して保持する（BlockChain.hashと同じ値）
+    canonicalなjsonはhashの計算・送信時に作るだけで保持しない
+    （保持するとOrderedDictより大きくなるため）
+
+    Attributes
+    ----------
+    merkle_root : str
+        version 2以降．transactionsのMerkle root
+
+    nonce : int
+
+    previous_hash : str
+
+    timestamp : float
+
+    transactions : tuple of Transaction
+
+    version : int
+        version 1のblockはNone（keyを持たない）
+
+    See Also
+    --------
+    >>> block = {"nonce": 1, "previous_hash": "hash", "timestamp": 0.5,
+    ...          "transactions": [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": 1.0}]}
+    >>> frozen = Block.from_dict(block)
+    >>> frozen == block, frozen["transactions"][0]["value"]
+    (True, 1.0)
+    >>> frozen.hash() == hashlib.sha256(json.dumps(block, sort_keys=True).encode()).hexdigest()
+    True
+    >>> json.dumps(frozen.to_dict()) == json.dumps(block, sort_keys=True)
+    True
+    >>> block_v2 = dict(block, merkle_root="root", version=2)
+    >>> frozen = Block.from_dict(block_v2)
+    >>> frozen.canonical_json() == json.dumps(block_v2, sort_keys=True).encode()
+    True
+    >>> frozen.hash() == block_hash(block_v2)
+    True
+    """
+
+    fields = (
+        "merkle_root", "nonce", "previous_hash", "timestamp", "transactions",
+        "version")
+    __slots__ = fields + ("_hash",)
+
+    def __init__(self, nonce, previous_hash, timestamp, transactions,
+                 merkle_root=None, version=None):
+        setattr_ = object.__setattr__
+        setattr_(self, "merkle_root", merkle_root)
+        setattr_(self, "nonce", nonce)
+        setattr_(self, "previous_hash", previous_hash)
+        setattr_(self, "timestamp", timestamp)
+        setattr_(self, "transactions", tuple(
+            Transaction.from_dict(transaction) for transaction in transactions))
+        setattr_(self, "version", version)
+        setattr_(self, "_hash", None)
+
+    @classmethod
+    def from_dict(cls, block, block_hash=None):
+        """
+        Parameters
+        ----------
+        block: dict
+
+        block_hash: str
+            計算済みのhash
+
+        Returns
+        -------
+        Block
+            既にBlockの場合はそのまま返す
+        """
+        if not isinstance(block, cls):
+            if set(block) not in (BLOCK_V1_KEYS, BLOCK_V2_KEYS):
+                raise ValueError(f"unknown block keys: {sorted(block)}")
+            block = cls(**block)
+        if block_hash is not None and block._hash is None:
+            object.__setattr__(block, "_hash", block_hash)
+        return block
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Mapping):
+            return NotImplemented
+        if set(self) != set(other):
+            return False
+        for key in self:
+            value = self[key]
+            other_value = other[key]
+            if key == "transactions":
+                value, other_value = list(value), list(other_value)
+            if value != other_value:
+                return False
+        return True
+
+    def __hash__(self):
+        return hash(self.hash())
+
+    def to_dict(self):
+        """
+        jsonにできるOrderedDict（wireの形式）
+        """
+        block = collections.OrderedDict(self.items())
+        block["transactions"] = [t.to_dict() for t in self.transactions]
+        return block
+
+    def canonical_json(self):
+        """
+        json.dumps(block, sort_keys=True).encode()と同じbytes
+        """
+        parts = []
+        for key in self:
+            if key == "transactions":
+                encoded = b"[" + b", ".join(
+                    t.canonical_json() for t in self.transactions) + b"]"
+            else:
+                value = getattr(self, key)
+                if isinstance(value, str):
+                    encoded = _encode_string(value).encode()
+                else:
+                    encoded = json.dumps(value).encode()
+            parts.append(b'"' + key.encode() + b'": ' + encoded)
+        return b"{" + b", ".join(parts) + b"}"
+
+    def hash(self):
+        """
+        BlockChain.hashと同じSHA-256（1度だけ計算する）
+        """
+        if self._hash is None:
+            object.__setattr__(self, "_hash", block_hash(self))
+        return self._hash
+
+
+def block_version(block):
+    """
+    versionのkeyがないblockはversion 1
+    """
+    return block.get("version") or 1
+
+
+def block_header(block):
+    """
+    version 2以降のblockのheader（transactionsの代わりにmerkle_rootを持つ）
+
+    See Also
+    --------
+    >>> block_header({"merkle_root": "root", "nonce": 1, "previous_hash": "hash", "timestamp": 0.5, "transactions": [], "version": 2})
+    OrderedDict([('merkle_root', 'root'), ('nonce', 1), ('previous_hash', 'hash'), ('timestamp', 0.5), ('version', 2)])
+    """
+    return collections.OrderedDict(
+        (key, block[key]) for key in BLOCK_HEADER_KEYS)
+
+
+def block_hash(block):
+    """
+    blockのhash
+    version 1: block全体のjson（sort_keys）のSHA-256
+    version 2: headerのjson（sort_keys）のSHA-256．transactionsはmerkle_rootで含まれる
+
+    Parameters
+    ----------
+    block: dict or Block
+
+    Returns
+    -------
+    str
+    """
+    if block_version(block) >= 2:
+        data = json.dumps(block_header(block), sort_keys=True).encode()
+    else:
+        data = canonical_json(block)
+    return hashlib.sha256(data).hexdigest()
+
+
+def freeze_block(block, block_hash=None):
+    """
+    blockをBlockにする
+    Blockにできない（知らないkeyを含むなど）場合はそのまま返す
+
+    See Also
+    --------
+    >>> type(freeze_block({"nonce": 0, "previous_hash": "hash", "timestamp": 0.0, "transactions": []})).__name__
+    'Block'
+    >>> freeze_block({"nonce": 0, "version": 2})
+    {'nonce': 0, 'version': 2}
+    """
+    try:
+        return Block.from_dict(block, block_hash)
+    except (ValueError, TypeError):
+        return block
+
+
+def to_dict(value):
+    """
+    Block・Transactionをjsonにできるdictにする．それ以外はそのまま返す
+    """
+    if isinstance(value, _Frozen):
+        return value.to_dict()
+    return value
+
+
+def canonical_json(value):
+    """
+    json.dumps(value, sort_keys=True).encode()と同じbytes
+
+    See Also
+    --------
+    >>> canonical_json({"b": 1, "a": 2})
+    b'{"a": 2, "b": 1}'
+    """
+    if isinstance(value, _Frozen):
+        return value.canonical_json()
+    return json.dumps(value, sort_keys=True, default=to_dict).encode()
+
+
+def measure_memory(blocks=100, transactions=100):
+    """
+    OrderedDictのchainとBlockのchainのmemory使用量をtracemallocで比較する
+
+    $ python models.py
+
+    Returns
+    -------
+    results : dict
+        "ordered_dict", "block" -> 1 transactionあたりのbytes数
+    """
+    import tracemalloc
+
+    import wallet
+
+    wallets = [wallet.Wallet() for _ in range(10)]
+    chain = []
+    for i in range(blocks):
+        txs = []
+        for j in range(transactions):
+            sender = wallets[j % len(wallets)]
+            txs.append({
+                "recipient_blockchain_address": wallets[(j + 1) % len(wallets)].blockchain_address,
+                "sender_blockchain_address": sender.blockchain_address,
+                "sender_public_key": sender.public_key,
+                "signature": "%0128x" % (i * transactions + j),
+                "value": 0.1 * j
+            })
+        chain.append({
+            "nonce": i, "previous_hash": "%064x" % i,
+            "timestamp": 1.0 * i, "transactions": txs
+        })
+    # 受信したchainと同じように，jsonから読み込んだ状態で比較する
+    data = json.dumps(chain)
+    count = blocks * transactions
+
+    def measure(load):
+        tracemalloc.start()
+        loaded = load()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del loaded
+        return size / count
+
+    return {
+        "ordered_dict": measure(lambda: json.loads(
+            data, object_pairs_hook=collections.OrderedDict)),
+        "block": measure(lambda: [Block.from_dict(block) for block in json.loads(data)])
+    }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+    for name, size in measure_memory().items():
+        print(f"{name:12s} {size:8.1f} bytes / transaction")
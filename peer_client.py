@@ -0,0 +1,187 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PEER_TIMEOUT_SEC = 3
+PEER_MAX_RETRIES = 2
+PEER_RETRY_BACKOFF_SEC = 0.1
+PEER_POOL_MAXSIZE = 10
+# read timeout・502/503/504の場合にretryするmethod
+# （PUT・POST・DELETEは相手が処理済みの可能性があるので繰り返さない．接続エラーは全てretryする）
+PEER_RETRY_METHODS = frozenset({"GET", "HEAD"})
+
+logger = logging.getLogger(__name__)
+
+
+class PeerClient(object):
+    """
+    node間の通信を行うclient
+
+    nodeごとにkeep-aliveのconnection poolを持つsessionを作り，使い回す
+
+    Attributes
+    ----------
+    timeout : float
+        requestのdefaultのtimeout
+
+    retries : int
+        接続エラー・502/503/504の場合のretry回数
+        （read timeout・502/503/504はPEER_RETRY_METHODSだけ）
+
+    pool_maxsize : int
+        nodeごとのconnection数の上限
+    """
+
+    def __init__(self, timeout=PEER_TIMEOUT_SEC, retries=PEER_MAX_RETRIES,
+                 pool_maxsize=PEER_POOL_MAXSIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def base_url(node):
+        """
+        Parameters
+        ----------
+        node : str
+            "host:port" または "http://host:port"
+
+        See Also
+        --------
+        >>> PeerClient.base_url("127.0.0.1:5000")
+        'http://127.0.0.1:5000'
+        >>> PeerClient.base_url("http://127.0.0.1:5000/")
+        'http://127.0.0.1:5000'
+        """
+        if "://" not in node:
+            node = f"http://{node}"
+        return node.rstrip("/")
+
+    def _retry(self):
+        """
+        See Also
+        --------
+        >>> retry = PeerClient()._retry()
+        >>> retry.is_retry("GET", 503), retry.is_retry("PUT", 503)
+        (True, False)
+        """
+        kwargs = {
+            "total": self.retries,
+            "backoff_factor": PEER_RETRY_BACKOFF_SEC,
+            "status_forcelist": (502, 503, 504),
+            "raise_on_status": False
+        }
+        try:
+            return Retry(allowed_methods=PEER_RETRY_METHODS, **kwargs)
+        except TypeError:
+            # urllib3 < 1.26
+            return Retry(method_whitelist=PEER_RETRY_METHODS, **kwargs)
+
+    def _session(self, node):
+        base_url = self.base_url(node)
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                retry = self._retry()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize,
+                    max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[base_url] = session
+            return base_url, session
+
+    def request(self, method, node, path, **kwargs):
+        """
+        nodeにrequestする
+
+        Parameters
+        ----------
+        method : str
+
+        node : str
+            "host:port" または "http://host:port"
+
+        path : str
+            ex. "transactions"
+
+        kwargs :
+            requests.Session.requestの引数．timeoutのdefaultはself.timeout
+
+        Returns
+        -------
+        requests.Response
+        """
+        base_url, session = self._session(node)
+        kwargs.setdefault("timeout", self.timeout)
+        return session.request(method, f"{base_url}/{path.lstrip('/')}", **kwargs)
+
+    def get(self, node, path, **kwargs):
+        return self.request("GET", node, path, **kwargs)
+
+    def post(self, node, path, **kwargs):
+        return self.request("POST", node, path, **kwargs)
+
+    def put(self, node, path, **kwargs):
+        return self.request("PUT", node, path, **kwargs)
+
+    def delete(self, node, path, **kwargs):
+        return self.request("DELETE", node, path, **kwargs)
+
+    def broadcast(self, method, nodes, path, **kwargs):
+        """
+        全nodeにrequestする
+        失敗したnodeはlogに残して続ける
+
+        Returns
+        -------
+        responses : dict
+            node -> requests.Response（失敗した場合はNone）
+        """
+        responses = {}
+        for node in nodes:
+            try:
+                responses[node] = self.request(method, node, path, **kwargs)
+            except requests.RequestException as ex:
+                logger.error({
+                    "action": "broadcast",
+                    "method": method,
+                    "node": node,
+                    "path": path,
+                    "ex": ex
+                })
+                responses[node] = None
+        return responses
+
+    def retain(self, nodes):
+        """
+        nodesに含まれないnodeのsessionを閉じる
+
+        See Also
+        --------
+        >>> client = PeerClient()
+        >>> _ = client._session("127.0.0.1:5000")
+        >>> _ = client._session("127.0.0.1:5001")
+        >>> client.retain(["127.0.0.1:5001"])
+        >>> list(client._sessions)
+        ['http://127.0.0.1:5001']
+        """
+        keep = {self.base_url(node) for node in nodes}
+        with self._lock:
+            for base_url in list(self._sessions):
+                if base_url not in keep:
+                    self._sessions.pop(base_url).close()
+
+    def close(self):
+        self.retain([])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
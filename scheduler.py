@@ -0,0 +1,310 @@
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+
+SCHEDULER_WORKERS = 4
+SCHEDULER_STOP_TIMEOUT_SEC = 30
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    定期的に実行する処理
+
+    前回の実行が終わってからinterval秒後に次を実行する（同じjobは重ならない）
+
+    Attributes
+    ----------
+    name : str
+
+    func : callable
+
+    interval : float
+
+    jitter : float
+        intervalに対する割合．interval * (1 ± jitter)の間でずらす
+        （複数のnodeの同期が同じ時刻に集まらないようにする）
+
+    next_run : float
+        次に実行する時刻（time.monotonic）
+    """
+
+    def __init__(self, name, func, interval, jitter=0.0, delay=0.0):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if not 0 <= jitter < 1:
+            raise ValueError("jitter must be in [0, 1)")
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run = time.monotonic() + delay
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.last_lateness = None
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.last_duration = None
+        self.last_finished = None
+        # 実行中にrun_nowされた時刻（終了後に反映する）
+        self.requested_run = None
+
+    def delay(self):
+        """
+        次の実行までの秒数
+
+        See Also
+        --------
+        >>> job = Job("job", print, 10, jitter=0.1)
+        >>> all(9 <= job.delay() <= 11 for _ in range(100))
+        True
+        """
+        if not self.jitter:
+            return self.interval
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "running": self.running,
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness,
+            "mean_lateness": self.total_lateness / self.runs if self.runs else None,
+            "last_duration": self.last_duration,
+            "next_run_in": None if self.running else max(
+                0.0, self.next_run - time.monotonic())
+        }
+
+
+class Scheduler(object):
+    """
+    定期的な処理（mining，nodeの検索，consensusなど）を1つのthreadで管理する
+
+    ・threading.Timerを毎回作る代わりに，1つのthreadが次に実行するjobを待ち，
+      実行はthread poolに渡す
+    ・intervalは実行中でもset_intervalで変えられる
+    ・stop()は新しい実行を止め，実行中のjobが終わるのを待つ
+    ・jobごとに予定の時刻からの遅れ（lateness）を記録する
+
+    See Also
+    --------
+    >>> runs = []
+    >>> scheduler = Scheduler()
+    >>> scheduler.add_job("job", lambda: runs.append(1), interval=0.01)
+    True
+    >>> scheduler.start()
+    >>> time.sleep(0.2)
+    >>> scheduler.stop()
+    True
+    >>> count = len(runs)
+    >>> count > 1, scheduler.stats()["job"]["runs"] == count
+    (True, True)
+    >>> time.sleep(0.05); len(runs) == count
+    True
+    """
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.workers = workers
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._running = False
+
+    def add_job(self, name, func, interval, jitter=0.0, delay=0.0):
+        """
+        jobを追加する．同じ名前のjobがある場合は置き換えずにFalseを返す
+
+        Parameters
+        ----------
+        name : str
+
+        func : callable
+            引数なしで呼ぶ
+
+        interval : float
+            前回の実行が終わってから次の実行までの秒数
+
+        jitter : float
+
+        delay : float
+            最初の実行までの秒数
+
+        Returns
+        -------
+        bool
+        """
+        with self._condition:
+            if name in self._jobs:
+                return False
+            self._jobs[name] = Job(name, func, interval, jitter, delay)
+            self._condition.notify_all()
+            return True
+
+    def remove_job(self, name):
+        with self._condition:
+            return self._jobs.pop(name, None) is not None
+
+    def set_interval(self, name, interval):
+        """
+        jobのintervalを変える
+        待っている間の場合は，前回の実行の終了からの新しいintervalで次の時刻を決め直す
+
+        See Also
+        --------
+        >>> scheduler = Scheduler()
+        >>> scheduler.add_job("job", print, interval=60, delay=60)
+        True
+        >>> scheduler.set_interval("job", 1)
+        >>> scheduler.stats()["job"]["next_run_in"] <= 1
+        True
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        with self._condition:
+            job = self._jobs[name]
+            job.interval = interval
+            if not job.running:
+                base = job.last_finished or time.monotonic()
+                job.next_run = min(job.next_run, base + job.delay())
+            self._condition.notify_all()
+
+    def run_now(self, name, delay=0.0):
+        """
+        intervalを待たずにdelay秒後に実行する（予定がそれより早い場合は変えない）
+        実行中の場合は終了後に実行する
+
+        Returns
+        -------
+        bool
+            jobがない場合はFalse
+
+        See Also
+        --------
+        >>> scheduler = Scheduler()
+        >>> scheduler.add_job("job", print, interval=60, delay=60)
+        True
+        >>> scheduler.run_now("job", delay=5)
+        True
+        >>> 4 < scheduler.stats()["job"]["next_run_in"] <= 5
+        True
+        """
+        with self._condition:
+            job = self._jobs.get(name)
+            if job is None:
+                return False
+            at = time.monotonic() + delay
+            if job.running:
+                if job.requested_run is None or at < job.requested_run:
+                    job.requested_run = at
+            else:
+                job.next_run = min(job.next_run, at)
+            self._condition.notify_all()
+            return True
+
+    def __contains__(self, name):
+        return name in self._jobs
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="scheduler")
+            self._thread = threading.Thread(
+                target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=SCHEDULER_STOP_TIMEOUT_SEC):
+        """
+        新しい実行を止め，実行中のjobが終わるまで（最大timeout秒）待つ
+
+        Returns
+        -------
+        bool
+            timeoutした場合はFalse
+        """
+        with self._condition:
+            if not self._running:
+                return True
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        with self._condition:
+            finished = self._condition.wait_for(
+                lambda: not any(job.running for job in self._jobs.values()),
+                timeout)
+        self._executor.shutdown(wait=finished)
+        self._thread = None
+        self._executor = None
+        if not finished:
+            logger.warning({
+                "action": "scheduler_stop",
+                "running": [n for n, job in self._jobs.items() if job.running]
+            })
+        return finished
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                timeout = None
+                for job in self._jobs.values():
+                    if job.running:
+                        continue
+                    if job.next_run <= now:
+                        job.running = True
+                        self._executor.submit(self._execute, job, job.next_run)
+                    else:
+                        wait = job.next_run - now
+                        timeout = wait if timeout is None else min(timeout, wait)
+                self._condition.wait(timeout)
+
+    def _execute(self, job, scheduled):
+        start = time.monotonic()
+        lateness = start - scheduled
+        try:
+            job.func()
+        except Exception as ex:
+            job.errors += 1
+            logger.error({"action": "scheduler", "job": job.name, "ex": ex})
+        finally:
+            finished = time.monotonic()
+            with self._condition:
+                job.runs += 1
+                job.last_lateness = lateness
+                job.max_lateness = max(job.max_lateness, lateness)
+                job.total_lateness += lateness
+                job.last_duration = finished - start
+                job.last_finished = finished
+                job.next_run = finished + job.delay()
+                if job.requested_run is not None:
+                    job.next_run = min(job.next_run, job.requested_run)
+                    job.requested_run = None
+                job.running = False
+                self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+            job name -> {"interval", "jitter", "running", "runs", "errors",
+            "last_lateness", "max_lateness", "mean_lateness", "last_duration",
+            "next_run_in"}
+        """
+        with self._condition:
+            return {name: job.stats() for name, job in self._jobs.items()}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
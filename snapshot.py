@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import re
+
+SNAPSHOT_INTERVAL_BLOCKS = 100
+SNAPSHOT_KEEP = 3
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TOLERANCE = 1e-9
+
+SNAPSHOT_FILE = "snapshot-{height:010d}.json"
+SNAPSHOT_FILE_PATTERN = re.compile(r"^snapshot-(\d{10})\.json$")
+
+logger = logging.getLogger(__name__)
+
+
+def replay_balances(blocks, balances=None):
+    """
+    blockのtransactionを順に反映した残高を計算する
+
+    Parameters
+    ----------
+    blocks: list of dicts
+
+    balances: dict
+        反映を始める残高．Noneの場合は空
+
+    Returns
+    -------
+    balances : dict
+
+    See Also
+    --------
+    >>> blocks = [{"transactions": [{"sender_blockchain_address": "X", "recipient_blockchain_address": "A", "value": 3.0}]},
+    ...           {"transactions": [{"sender_blockchain_address": "A", "recipient_blockchain_address": "B", "value": 1.0}]}]
+    >>> replay_balances(blocks)
+    {'A': 2.0, 'X': -3.0, 'B': 1.0}
+    """
+    balances = dict(balances or {})
+    for block in blocks:
+        for transaction in block["transactions"]:
+            value = float(transaction["value"])
+            recipient = transaction["recipient_blockchain_address"]
+            sender = transaction["sender_blockchain_address"]
+            balances[recipient] = balances.get(recipient, 0.0) + value
+            balances[sender] = balances.get(sender, 0.0) - value
+    return balances
+
+
+def diff_balances(expected, actual, tolerance=SNAPSHOT_TOLERANCE):
+    """
+    残高の違いを返す．含まれないaddressは0として比較する
+
+    Returns
+    -------
+    diff : dict
+        address -> (expected, actual)
+
+    See Also
+    --------
+    >>> diff_balances({"A": 1.0, "B": 0.0}, {"A": 1.0})
+    {}
+    >>> diff_balances({"A": 1.0}, {"A": 2.0})
+    {'A': (1.0, 2.0)}
+    """
+    diff = {}
+    for address in set(expected) | set(actual):
+        e = expected.get(address, 0.0)
+        a = actual.get(address, 0.0)
+        if abs(e - a) > tolerance:
+            diff[address] = (e, a)
+    return diff
+
+
+class SnapshotStore(object):
+    """
+    残高のsnapshotをdiskに保存する
+
+    ・SNAPSHOT_INTERVAL_BLOCKSごとのheightで，そのheightまでのblockを反映した残高を保存する
+    ・block hashも保存し，chainが置き換わった場合は一致するsnapshotだけを使う
+    ・新しい順にSNAPSHOT_KEEP個だけ残す
+
+    Attributes
+    ----------
+    path : str
+        保存するdirectory
+
+    interval : int
+        snapshotを作るblock数の間隔
+
+    keep : int
+        残すsnapshotの数
+
+    See Also
+    --------
+    >>> import tempfile
+    >>> store = SnapshotStore(tempfile.mkdtemp(), interval=2, keep=2)
+    >>> [store.should_save(height) for height in range(4)]
+    [False, True, False, True]
+    >>> for height in (1, 3, 5):
+    ...     store.save(height, "%064x" % height, {"A": float(height)})
+    >>> store.heights()
+    [5, 3]
+    >>> store.load(3)["balances"]
+    {'A': 3.0}
+    >>> store.latest(lambda height: "%064x" % height if height < 5 else None)["height"]
+    3
+    """
+
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL_BLOCKS, keep=SNAPSHOT_KEEP):
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+        os.makedirs(path, exist_ok=True)
+
+    def should_save(self, height):
+        """
+        heightのblockを追加した後にsnapshotを作るか
+        """
+        return (height + 1) % self.interval == 0
+
+    def heights(self):
+        """
+        保存されているsnapshotのheight（新しい順）
+        """
+        heights = []
+        for name in os.listdir(self.path):
+            match = SNAPSHOT_FILE_PATTERN.match(name)
+            if match:
+                heights.append(int(match.group(1)))
+        return sorted(heights, reverse=True)
+
+    def _file(self, height):
+        return os.path.join(self.path, SNAPSHOT_FILE.format(height=height))
+
+    def save(self, height, block_hash, balances):
+        """
+        一時fileに書き込んでからrenameする（途中で止まっても壊れたsnapshotを残さない）
+
+        Parameters
+        ----------
+        height: int
+            反映済みの最後のblockのheight
+
+        block_hash: str
+            heightのblockのhash
+
+        balances: dict
+        """
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "height": height,
+            "block_hash": block_hash,
+            "balances": balances
+        }
+        path = self._file(height)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logger.info({
+            "action": "save_snapshot",
+            "height": height,
+            "addresses": len(balances)
+        })
+        for old_height in self.heights()[self.keep:]:
+            os.remove(self._file(old_height))
+
+    def load(self, height):
+        with open(self._file(height)) as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"unknown snapshot version: {snapshot.get('version')}")
+        return snapshot
+
+    def latest(self, block_hash_at):
+        """
+        chainと一致する最新のsnapshot
+
+        Parameters
+        ----------
+        block_hash_at: callable
+            height -> chainのそのheightのblock hash（chainにない場合はNone）
+
+        Returns
+        -------
+        snapshot : dict
+            一致するものがない場合はNone
+        """
+        for height in self.heights():
+            try:
+                snapshot = self.load(height)
+            except (OSError, ValueError) as ex:
+                logger.warning({"action": "load_snapshot", "height": height, "ex": ex})
+                continue
+            if block_hash_at(height) == snapshot["block_hash"]:
+                return snapshot
+        return None
+
+
+def verify_snapshot(snapshot, blocks, block_hashes):
+    """
+    snapshotを全blockのreplayと比較する
+
+    Parameters
+    ----------
+    snapshot: dict
+
+    blocks: list of dicts
+        genesis blockからのchain
+
+    block_hashes: list of str
+
+    Returns
+    -------
+    diff : dict
+        address -> (replayした残高, snapshotの残高)．一致する場合は空
+
+    See Also
+    --------
+    >>> blocks = [{"transactions": [{"sender_blockchain_address": "X", "recipient_blockchain_address": "A", "value": 3.0}]}]
+    >>> verify_snapshot({"height": 0, "block_hash": "h", "balances": {"A": 3.0, "X": -3.0}}, blocks, ["h"])
+    {}
+    >>> verify_snapshot({"height": 0, "block_hash": "h", "balances": {"A": 2.0, "X": -3.0}}, blocks, ["h"])
+    {'A': (3.0, 2.0)}
+    """
+    height = snapshot["height"]
+    if height >= len(blocks) or block_hashes[height] != snapshot["block_hash"]:
+        raise ValueError(f"snapshot at height {height} is not on the chain")
+    return diff_balances(
+        replay_balances(blocks[:height + 1]), snapshot["balances"])
+
+
+def main():
+    """
+    datadirのsnapshotをblock storeの全blockのreplayと比較する
+
+    $ python snapshot.py -d data/5000
+    """
+    from argparse import ArgumentParser
+
+    import blockstore
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--datadir", required=True,
+                        help="directory of the block store")
+    parser.add_argument("--height", default=None, type=int,
+                        help="height of the snapshot (all if omitted)")
+    args = parser.parse_args()
+
+    store = blockstore.BlockStore(args.datadir, readonly=True)
+    blocks, block_hashes = store.load()
+    store.close()
+    snapshots = SnapshotStore(os.path.join(args.datadir, "snapshots"))
+    heights = [args.height] if args.height is not None else snapshots.heights()
+
+    ok = True
+    for height in heights:
+        try:
+            diff = verify_snapshot(snapshots.load(height), blocks, block_hashes)
+        except (OSError, ValueError) as ex:
+            print(f"height {height}: error {ex}")
+            ok = False
+            continue
+        if diff:
+            ok = False
+            print(f"height {height}: {len(diff)} mismatched addresses")
+            for address, (expected, actual) in sorted(diff.items()):
+                print(f"  {address}: replay={expected} snapshot={actual}")
+        else:
+            print(f"height {height}: ok")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
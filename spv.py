@@ -0,0 +1,227 @@
+import logging
+import threading
+
+import blockchain
+import merkle
+import mining_engine
+import models
+
+SPV_LOCATOR_MAX = 32
+
+logger = logging.getLogger(__name__)
+
+
+class LightClient(object):
+    """
+    headerだけのchainを持ち，walletのtransactionをMerkle inclusion proofで確認する
+    （Simplified Payment Verification）
+
+    ・GET /headersで新しいheaderだけを取得し，つながりとPoWを確認する
+    ・GET /proofsで自分のaddressのtransactionと証明を取得し，headerのmerkle_rootで確認する
+    ・確認済みのtransactionはaddressごとに保持し，次からは新しいblockの分だけ取得する
+    ・requestはGatewayPoolで応答の速いgatewayに送り，失敗した場合は次のgatewayを試す
+      （gatewayが変わってもheaderのつながりとPoWで確認し，chainが違う場合は共通のheaderまで戻る）
+    ・genesis blockはgatewayを信頼する
+    ・証明できるのはtransactionが含まれていることだけで，gatewayが隠したtransactionはわからない
+
+    Attributes
+    ----------
+    gateways : gateway.GatewayPool
+
+    headers : list of dicts
+        version 2はheader，version 1はblock全体
+
+    header_hashes : list of str
+    """
+
+    def __init__(self, gateways, difficulty=blockchain.MINING_DIFFICULTY):
+        self.gateways = gateways
+        self.difficulty = difficulty
+        self.headers = []
+        self.header_hashes = []
+        self._wallets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def height(self):
+        return len(self.headers) - 1
+
+    def verify_header(self, header, previous_hash):
+        """
+        headerのつながりとPoWを確認する
+
+        Parameters
+        ----------
+        header: dict
+
+        previous_hash: str
+            1つ前のheaderのhash．genesis blockの場合はNone
+
+        Returns
+        -------
+        block_hash : str
+
+        See Also
+        --------
+        >>> block_chain = blockchain.BlockChain()
+        >>> _ = block_chain.mining()
+        >>> _, headers = block_chain.get_headers()
+        >>> light_client = LightClient(None)
+        >>> light_client.verify_header(headers[1], block_chain.block_hashes[0]) == block_chain.tip_hash
+        True
+        >>> light_client.verify_header(dict(headers[1], nonce=headers[1]["nonce"] + 1), block_chain.block_hashes[0])
+        Traceback (most recent call last):
+            ...
+        ValueError: invalid proof of work
+        """
+        if previous_hash is not None:
+            if header["previous_hash"] != previous_hash:
+                raise ValueError("previous_hash does not match")
+            if models.block_version(header) >= 2:
+                valid = mining_engine.valid_proof(
+                    None, header["previous_hash"], header["nonce"],
+                    self.difficulty, header["merkle_root"])
+            else:
+                valid = mining_engine.valid_proof(
+                    header["transactions"], header["previous_hash"],
+                    header["nonce"], self.difficulty)
+            if not valid:
+                raise ValueError("invalid proof of work")
+        return models.block_hash(header)
+
+    def _locator(self):
+        heights = []
+        step = 1
+        height = self.height
+        while height > 0 and len(heights) < SPV_LOCATOR_MAX:
+            heights.append(height)
+            height -= step
+            if len(heights) >= 8:
+                step *= 2
+        if self.headers:
+            heights.append(0)
+        return [self.header_hashes[h] for h in heights] + [-1]
+
+    def sync_headers(self):
+        """
+        gatewayのtipまでheaderを取得する
+        自身のtipをgatewayが知らない場合（chainが置き換わった場合）は
+        共通のheaderまで戻って取得し直す
+
+        Returns
+        -------
+        height : int
+        """
+        with self._lock:
+            for since in self._locator():
+                _, response = self.gateways.get(
+                    "headers", params={"since": since})
+                if response.status_code == 200:
+                    break
+                if response.status_code != 404:
+                    response.raise_for_status()
+            else:
+                raise ValueError("gateway does not share any header")
+
+            while True:
+                response_json = response.json()
+                start_height = response_json["start_height"]
+                headers = response_json["headers"]
+                if start_height < len(self.headers):
+                    self._truncate(start_height)
+                for header in headers:
+                    previous_hash = self.header_hashes[-1] if self.headers else None
+                    block_hash = self.verify_header(header, previous_hash)
+                    self.headers.append(header)
+                    self.header_hashes.append(block_hash)
+                if not headers or self.height >= response_json["height"]:
+                    return self.height
+                _, response = self.gateways.get(
+                    "headers", params={"since": self.height})
+                response.raise_for_status()
+
+    def _truncate(self, height):
+        """
+        height以降のheaderと，そのheaderの確認済みtransactionを捨てる
+        """
+        logger.warning({"action": "spv_reorg", "height": height})
+        del self.headers[height:]
+        del self.header_hashes[height:]
+        for wallet in self._wallets.values():
+            wallet["entries"] = [
+                entry for entry in wallet["entries"] if entry["height"] < height]
+            wallet["height"] = min(wallet["height"], height - 1)
+
+    def verify_entry(self, blockchain_address, entry):
+        """
+        GET /proofsの1件を確認する
+
+        Returns
+        -------
+        transaction : dict
+        """
+        height = entry["height"]
+        if not 0 <= height < len(self.headers):
+            raise ValueError(f"unknown height: {height}")
+        if self.header_hashes[height] != entry["block_hash"]:
+            raise ValueError(f"block hash does not match at {height}")
+        transaction = entry["transaction"]
+        if blockchain_address not in (
+                transaction["sender_blockchain_address"],
+                transaction["recipient_blockchain_address"]):
+            raise ValueError("transaction does not include the address")
+        header = self.headers[height]
+        if models.block_version(header) >= 2:
+            if not merkle.verify_proof(transaction, entry["proof"], header["merkle_root"]):
+                raise ValueError(f"invalid merkle proof at {height}")
+        elif header["transactions"][entry["index"]] != transaction:
+            raise ValueError(f"transaction is not in the block at {height}")
+        return transaction
+
+    def balance(self, blockchain_address):
+        """
+        確認済みのtransactionから残高を計算する
+
+        Returns
+        -------
+        (amount, height) : tuple
+            残高と確認したheaderのheight
+
+        Raises
+        ------
+        ValueError
+            gatewayの返したheader・証明が正しくない場合
+        """
+        self.sync_headers()
+        with self._lock:
+            wallet = self._wallets.setdefault(
+                blockchain_address, {"height": -1, "entries": []})
+            _, response = self.gateways.get(
+                "proofs",
+                params={"blockchain_address": blockchain_address,
+                        "since": wallet["height"]})
+            response.raise_for_status()
+            entries = []
+            for entry in response.json()["proofs"]:
+                # headerを取得した後のblockは次回確認する
+                if entry["height"] > self.height:
+                    continue
+                self.verify_entry(blockchain_address, entry)
+                entries.append(entry)
+            wallet["entries"].extend(entries)
+            wallet["height"] = self.height
+
+            amount = 0.0
+            for entry in wallet["entries"]:
+                transaction = entry["transaction"]
+                value = float(transaction["value"])
+                if transaction["recipient_blockchain_address"] == blockchain_address:
+                    amount += value
+                if transaction["sender_blockchain_address"] == blockchain_address:
+                    amount -= value
+            return amount, self.height
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
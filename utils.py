@@ -1,11 +1,28 @@
 import hashlib
 import collections
+import concurrent.futures
+import errno
 import logging
+import multiprocessing
 import re
+import selectors
 import socket
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+PROBE_TIMEOUT_SEC = 1
+PROBE_BATCH_SIZE = 256
+# 全てのアドレスを調べ直す間隔．nodeの同期の間隔
+# （blockchain.BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC）より長くし，その間の同期では
+# 前回見つかったnodeだけを調べ直す（止まったnodeはすぐに外れる）
+NEIGHBOURS_CACHE_TTL_SEC = 60
+
+# find_neighboursの結果: (引数) -> (見つかった(host, port)のlist, 全て調べた時刻)
+_neighbours_cache = {}
+_neighbours_lock = threading.Lock()
+
 RE_IP = re.compile(
     "(?P<prefix_host>^\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.)(?P<last_ip>\\d{1,3}$)")
 
@@ -38,6 +55,77 @@ def sorted_dict_by_key(unsorted_dict):
     return collections.OrderedDict(sorted(unsorted_dict.items(), key=lambda d: d[0]))
 
 
+class LRUCache(object):
+    """
+    上限付きのLRU cache
+
+    Attributes
+    ----------
+    maxsize : int
+        保持する最大数．超えた場合は最も使われていないものから削除する
+
+    hits : int
+
+    misses : int
+
+    See Also
+    --------
+    >>> cache = LRUCache(2)
+    >>> cache.put("a", 1)
+    >>> cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> cache.get("b") is None
+    True
+    >>> cache.stats()
+    {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1}
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
 def pprint(chains):
     """
     出力形式
@@ -98,9 +186,97 @@ def is_found_host(target, port):
             return False
 
 
+def process_pool(max_workers, start_method):
+    """
+    start_methodのworkerプロセスのProcessPoolExecutorを作る
+    （threadが動いている中でforkしないようにspawnなどを指定する）
+    mp_contextのないPython 3.6ではdefaultのstart methodになる
+
+    See Also
+    --------
+    >>> executor = process_pool(1, "spawn")
+    >>> executor.submit(abs, -1).result()
+    1
+    >>> executor.shutdown()
+    """
+    try:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(start_method))
+    except TypeError:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def probe_hosts(addresses, timeout=PROBE_TIMEOUT_SEC):
+    """
+    複数のnodeが立ち上がっているかを並列に調べる
+    non-blockingのsocketでconnectし，selectorで書き込み可能になるのを待つ
+
+    Parameters
+    ----------
+    addresses : list of tuple
+        [(host, port)]
+
+    timeout : float
+        全体のtimeout
+
+    Returns
+    -------
+    alive : set of tuple
+        接続できた(host, port)
+
+    See Also
+    --------
+    >>> server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    >>> server.bind(("127.0.0.1", 0))
+    >>> server.listen()
+    >>> port = server.getsockname()[1]
+    >>> probe_hosts([("127.0.0.1", port), ("127.0.0.1", 1)]) == {("127.0.0.1", port)}
+    True
+    >>> server.close()
+    """
+    alive = set()
+    selector = selectors.DefaultSelector()
+    try:
+        for address in addresses:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex(address)
+            if err == 0:
+                alive.add(address)
+                sock.close()
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                selector.register(sock, selectors.EVENT_WRITE, address)
+            else:
+                sock.close()
+
+        deadline = time.monotonic() + timeout
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in selector.select(remaining):
+                sock = key.fileobj
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    alive.add(key.data)
+                selector.unregister(sock)
+                sock.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+        selector.close()
+    return alive
+
+
 def find_neighbours(my_host, my_port, start_ip_range, end_ip_range, start_port, end_port):
     """
-    nodeを検索する．    
+    nodeを検索する．
+
+    ・前回見つかったnodeを先に調べる
+    ・全てのアドレスを調べてからNEIGHBOURS_CACHE_TTL_SEC以内で，前回見つかったnodeが
+      応答した場合はそれだけを返す．それ以外は残りのアドレスもPROBE_BATCH_SIZEずつ並列に調べる
+    ・調べている間はlockを持たない
 
     Parameters
     ----------
@@ -123,6 +299,15 @@ def find_neighbours(my_host, my_port, start_ip_range, end_ip_range, start_port,
 
     See Also
     --------
+    >>> server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    >>> server.bind(("127.0.0.1", 0))
+    >>> server.listen()
+    >>> port = server.getsockname()[1]
+    >>> find_neighbours("127.0.0.1", 0, 0, 1, port, port + 1) == [f"127.0.0.1:{port}"]
+    True
+    >>> server.close()
+    >>> find_neighbours("127.0.0.1", 0, 0, 1, port, port + 1)
+    []
     """
     address = f"{my_host}:{my_port}"
     m = RE_IP.search(my_host)
@@ -132,15 +317,36 @@ def find_neighbours(my_host, my_port, start_ip_range, end_ip_range, start_port,
     prefix_host = m.group("prefix_host")
     last_ip = m.group("last_ip")
 
-    neighbours = []
+    key = (my_host, my_port, start_ip_range, end_ip_range, start_port, end_port)
+    with _neighbours_lock:
+        known, scanned_at = _neighbours_cache.get(key, ([], None))
+
+    # 前回見つかったnodeを先に調べる
+    alive = probe_hosts(known) if known else set()
+    found = [address for address in known if address in alive]
+    # 1つも見つからない場合は新しいnodeを探すために全て調べる
+    if found and time.monotonic() - scanned_at < NEIGHBOURS_CACHE_TTL_SEC:
+        with _neighbours_lock:
+            _neighbours_cache[key] = (found, scanned_at)
+        return [f"{host}:{port}" for host, port in found]
+
+    candidates = []
     for guess_port in range(start_port, end_port):
         for ip_range in range(start_ip_range, end_ip_range):
             guess_host = f"{prefix_host}{int(last_ip)+int(ip_range)}"
-            guess_address = f"{guess_host}:{guess_port}"
             # ignored my_host
-            if is_found_host(guess_host, guess_port) and not guess_address == address:
-                neighbours.append(guess_address)
-    return neighbours
+            if not f"{guess_host}:{guess_port}" == address:
+                candidates.append((guess_host, guess_port))
+
+    known = set(known)
+    unknown = [c for c in candidates if c not in known]
+    for i in range(0, len(unknown), PROBE_BATCH_SIZE):
+        alive |= probe_hosts(unknown[i:i + PROBE_BATCH_SIZE])
+
+    found = [c for c in candidates if c in alive]
+    with _neighbours_lock:
+        _neighbours_cache[key] = (found, time.monotonic())
+    return [f"{host}:{port}" for host, port in found]
 
 
 def get_host():
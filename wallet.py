@@ -138,6 +138,28 @@ class Wallet(object):
         return blockchain_address
 
 
+def generate_keypair():
+    """
+    新しいwalletの鍵とaddress（POST /walletの応答と同じ形式）
+
+    Returns
+    -------
+    keypair : dict
+        "private_key", "public_key", "blockchain_address"
+
+    See Also
+    --------
+    >>> sorted(generate_keypair())
+    ['blockchain_address', 'private_key', 'public_key']
+    """
+    wallet = Wallet()
+    return {
+        "private_key": wallet.private_key,
+        "public_key": wallet.public_key,
+        "blockchain_address": wallet.blockchain_address,
+    }
+
+
 class Transaction(object):
     """
     Transactionを構成する機能
@@ -183,16 +205,10 @@ class Transaction(object):
         >>> t = Transaction(wallet_A.private_key, wallet_A.public_key, wallet_A.blockchain_address, wallet_B.blockchain_address, 1.0)
         >>> _ = t.generate_signature()
         """
-        sha256 = hashlib.sha256()
-        transaction = utils.sorted_dict_by_key({
-            "sender_blockchain_address": self.sender_blockchain_address,
-            "recipient_blockchain_address": self.recipient_blockchain_address,
-            "value": float(self.value)
-        })
-        # sha256のupdate
-        sha256.update(str(transaction).encode("utf-8"))
-        # hashのメッセージ
-        message = sha256.digest()
+        message = transaction_message(
+            self.sender_blockchain_address,
+            self.recipient_blockchain_address,
+            self.value)
         # private_keyの作成
         private_key = SigningKey.from_string(
             bytes().fromhex(self.sender_private_key), curve=NIST256p
@@ -203,6 +219,59 @@ class Transaction(object):
         return signature
 
 
+def transaction_message(sender_blockchain_address, recipient_blockchain_address, value):
+    """
+    署名するmessage（transactionsをSHA-256でハッシュ化したbytes）
+    """
+    sha256 = hashlib.sha256()
+    transaction = utils.sorted_dict_by_key({
+        "sender_blockchain_address": sender_blockchain_address,
+        "recipient_blockchain_address": recipient_blockchain_address,
+        "value": float(value)
+    })
+    # sha256のupdate
+    sha256.update(str(transaction).encode("utf-8"))
+    # hashのメッセージ
+    return sha256.digest()
+
+
+def sign_transactions(sender_private_key, sender_blockchain_address, transfers):
+    """
+    同じsenderの複数のtransactionに署名する
+    秘密鍵の読み込みは1度だけ行う
+
+    Parameters
+    ----------
+    sender_private_key : str
+
+    sender_blockchain_address : str
+
+    transfers : list of tuple
+        (recipient_blockchain_address, value)
+
+    Returns
+    -------
+    signatures : list of str
+        Transaction.generate_signatureと同じ形式
+
+    See Also
+    --------
+    >>> wallet_A = Wallet()
+    >>> wallet_B = Wallet()
+    >>> signature, = sign_transactions(wallet_A.private_key, wallet_A.blockchain_address, [(wallet_B.blockchain_address, 1.0)])
+    >>> message = transaction_message(wallet_A.blockchain_address, wallet_B.blockchain_address, 1.0)
+    >>> wallet_A._public_key.verify(bytes.fromhex(signature), message)
+    True
+    """
+    private_key = SigningKey.from_string(
+        bytes().fromhex(sender_private_key), curve=NIST256p)
+    return [
+        private_key.sign(transaction_message(
+            sender_blockchain_address, recipient_blockchain_address, value)).hex()
+        for recipient_blockchain_address, value in transfers
+    ]
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
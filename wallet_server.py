@@ -1,15 +1,105 @@
-import urllib.parse
+import os
 
 from flask import Flask
 from flask import jsonify
 from flask import render_template
 from flask import request
-import requests
 
+import gateway
+import keypool
+import spv
+import utils
 import wallet
 
+SIGN_CHUNK_SIZE = 256
+SIGN_POOL_MIN = 64
+SIGN_WORKERS = None
+# request・keypoolのthreadが動いている中でforkしないようにspawnで作る
+SIGN_START_METHOD = "spawn"
+
 app = Flask(__name__, template_folder="./templates")
 
+cache = {}
+
+
+def get_gateways():
+    """
+    app.config["gw"]（カンマ区切り）のgatewayのGatewayPool
+    connectionとgatewayごとの応答時間を使い回す
+    """
+    gateways = cache.get("gateways")
+    if gateways is None:
+        gateways = gateway.GatewayPool(
+            [gw.strip() for gw in app.config["gw"].split(",") if gw.strip()])
+        cache["gateways"] = gateways
+    return gateways
+
+
+def get_balance_cache():
+    balance_cache = cache.get("balance_cache")
+    if balance_cache is None:
+        balance_cache = gateway.BalanceCache(
+            app.config.get("balance_cache_size", gateway.BALANCE_CACHE_SIZE),
+            app.config.get("balance_cache_ttl", gateway.BALANCE_CACHE_TTL_SEC))
+        cache["balance_cache"] = balance_cache
+    return balance_cache
+
+
+def get_keypool():
+    """
+    作成済みのkeypairのpool（初回に補充を始める）
+    """
+    pool = cache.get("keypool")
+    if pool is None:
+        pool = keypool.KeyPool(
+            size=app.config.get("keypool_size", keypool.KEYPOOL_SIZE),
+            low_watermark=app.config.get(
+                "keypool_low_watermark", keypool.KEYPOOL_LOW_WATERMARK),
+            workers=app.config.get("keypool_workers", keypool.KEYPOOL_WORKERS))
+        pool.start()
+        cache["keypool"] = pool
+    return pool
+
+
+def get_sign_executor():
+    """
+    署名用のprocess pool（初回に作る）
+    """
+    executor = cache.get("sign_executor")
+    if executor is None:
+        executor = utils.process_pool(
+            app.config.get("sign_workers", SIGN_WORKERS) or os.cpu_count(),
+            SIGN_START_METHOD)
+        cache["sign_executor"] = executor
+    return executor
+
+
+def shutdown():
+    """
+    署名・keypairのworker processとgatewayへのconnectionを閉じる
+    """
+    executor = cache.pop("sign_executor", None)
+    if executor is not None:
+        executor.shutdown()
+    pool = cache.pop("keypool", None)
+    if pool is not None:
+        pool.stop()
+    gateways = cache.pop("gateways", None)
+    if gateways is not None:
+        gateways.client.close()
+
+
+def get_light_client():
+    """
+    SPV modeのLightClient（headerと確認済みtransactionを保持するので使い回す）
+    """
+    light_client = cache.get("light_client")
+    if light_client is None:
+        gateways = get_gateways()
+        light_client = spv.LightClient(gateways)
+        cache["light_client"] = light_client
+    return light_client
+
 
 @app.route("/")
 def index():
@@ -18,15 +108,15 @@ def index():
 
 @app.route("/wallet", methods=["POST"])
 def create_wallet():
-    my_wallet = wallet.Wallet()
-    response = {
-        "private_key": my_wallet.private_key,
-        "public_key": my_wallet.public_key,
-        "blockchain_address": my_wallet.blockchain_address,
-    }
+    response = get_keypool().pop()
     return jsonify(response), 200
 
 
+@app.route("/wallet/pool", methods=["GET"])
+def get_keypool_metrics():
+    return jsonify(get_keypool().metrics()), 200
+
+
 @app.route("/transaction", methods=["POST"])
 def create_transaction():
     request_json = request.json
@@ -62,15 +152,104 @@ def create_transaction():
     }
 
     # blockchain nodeにリクエストする
-    response = requests.post(
-        urllib.parse.urljoin(app.config["gw"], "transactions"),
-        json=json_data, timeout=3)
+    _, response = get_gateways().post("transactions", json=json_data)
 
     if response.status_code == 201:
         return jsonify({"message": "success"}), 201
     return jsonify({"message": "fail", "response": response}), 400
 
 
+@app.route("/transactions/batch", methods=["POST"])
+def create_transactions_batch():
+    """
+    同じsenderから複数のrecipientへのtransactionをまとめて作る
+    秘密鍵はSIGN_CHUNK_SIZE件ごとに1度だけ読み込み，SIGN_POOL_MIN件以上の場合は
+    process poolで並列に署名する．署名したtransactionはSIGN_CHUNK_SIZE件ずつ
+    gatewayのPOST /transactions/batchに送る
+
+    See Also
+    --------
+    request : dict
+        key: "sender_private_key", "sender_public_key", "sender_blockchain_address"
+        key: "transfers"
+        val: list in dict．{"recipient_blockchain_address": str, "value": float}
+
+    response : dict
+        gatewayのPOST /transactions/batchの応答をまとめたもの
+        （transactionごとの"results"．失敗したrequestのtransactionは"fail"）
+    """
+    request_json = request.get_json(silent=True) or {}
+    required = (
+        "sender_private_key",
+        "sender_blockchain_address",
+        "sender_public_key",
+        "transfers")
+    if not all(k in request_json for k in required):
+        return jsonify({"message": "missing values"}), 400
+    transfers = request_json["transfers"]
+    if not isinstance(transfers, list):
+        return jsonify({"message": "invalid transfers"}), 400
+    try:
+        transfers = [
+            (transfer["recipient_blockchain_address"], float(transfer["value"]))
+            for transfer in transfers]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "invalid transfers"}), 400
+
+    sender_private_key = request_json["sender_private_key"]
+    sender_blockchain_address = request_json["sender_blockchain_address"]
+    chunks = [
+        transfers[i:i + SIGN_CHUNK_SIZE]
+        for i in range(0, len(transfers), SIGN_CHUNK_SIZE)]
+    try:
+        if len(transfers) < SIGN_POOL_MIN:
+            signed = [wallet.sign_transactions(
+                sender_private_key, sender_blockchain_address, chunk)
+                for chunk in chunks]
+        else:
+            executor = get_sign_executor()
+            signed = list(executor.map(
+                wallet.sign_transactions,
+                [sender_private_key] * len(chunks),
+                [sender_blockchain_address] * len(chunks),
+                chunks))
+    except (ValueError, AssertionError):
+        # hexでない・長さが違う秘密鍵（ecdsaはAssertionErrorの派生を送出する）
+        return jsonify({"message": "invalid sender_private_key"}), 400
+
+    # blockchain nodeに署名したchunkごとにリクエストする（1回のrequestの大きさを抑える）
+    gateways = get_gateways()
+    results = []
+    error = None
+    for chunk, signatures in zip(chunks, signed):
+        json_data = {"transactions": [
+            {
+                "sender_blockchain_address": sender_blockchain_address,
+                "recipient_blockchain_address": recipient_blockchain_address,
+                "sender_public_key": request_json["sender_public_key"],
+                "value": value,
+                "signature": signature,
+            }
+            for (recipient_blockchain_address, value), signature
+            in zip(chunk, signatures)
+        ]}
+        _, response = gateways.post("transactions/batch", json=json_data)
+        if response.status_code == 200:
+            results.extend(response.json()["results"])
+        else:
+            error = response.text
+            results.extend({"message": "fail", "error": error} for _ in chunk)
+
+    success = sum(result["message"] == "success" for result in results)
+    if error is not None and not success:
+        return jsonify({"message": "fail", "error": error}), 400
+    return jsonify({
+        "results": results,
+        "length": len(results),
+        "success": success
+    }), 200
+
+
 @app.route('/wallet/amount', methods=['GET'])
 def calculate_amount():
     # validation check
@@ -79,12 +258,38 @@ def calculate_amount():
         return 'Missing values', 400
 
     my_blockchain_address = request.args.get('blockchain_address')
-    response = requests.get(
-        urllib.parse.urljoin(app.config['gw'], 'amount'),
-        {'blockchain_address': my_blockchain_address},
-        timeout=3)
+    if app.config.get('spv'):
+        # gatewayの残高を信用せず，headerとMerkle proofで確認する
+        try:
+            total, height = get_light_client().balance(my_blockchain_address)
+        except ValueError as e:
+            return jsonify({'message': 'fail', 'error': str(e)}), 400
+        return jsonify(
+            {'message': 'success', 'amount': total, 'height': height}), 200
+
+    # tipが変わっていなければ残高も変わらない
+    # cacheしているtipを渡し，1つのgatewayへの1回のrequestで確認する
+    gateways = get_gateways()
+    balance_cache = get_balance_cache()
+    params = {'blockchain_address': my_blockchain_address}
+    tip_hash = balance_cache.tip_hash(my_blockchain_address)
+    if tip_hash is not None:
+        params['tip_hash'] = tip_hash
+    _, response = gateways.get('amount', params=params)
+    if response.status_code == 304:
+        total = balance_cache.get(my_blockchain_address, tip_hash)
+        if total is not None:
+            return jsonify({'message': 'success', 'amount': total}), 200
+        # 確認の間にcacheが消えた場合は残高を取得し直す
+        del params['tip_hash']
+        _, response = gateways.get('amount', params=params)
+
     if response.status_code == 200:
-        total = response.json()['amount']
+        response_json = response.json()
+        total = response_json['amount']
+        if response_json.get('tip_hash'):
+            balance_cache.put(
+                my_blockchain_address, response_json['tip_hash'], total)
         return jsonify({'message': 'success', 'amount': total}), 200
     return jsonify({'message': 'fail', 'error': response.content}), 400
 
@@ -95,9 +300,29 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--port", default=8080,
                         type=int, help="port to listen on")
     parser.add_argument("-g", "--gw", default="http://127.0.0.1:5000",
-                        type=str, help="blockchain gateway")
+                        type=str, help="blockchain gateways (comma separated)")
+    parser.add_argument("--spv", action="store_true",
+                        help="verify balances with block headers and merkle proofs")
+    parser.add_argument("--balance-cache-ttl", default=gateway.BALANCE_CACHE_TTL_SEC,
+                        type=float, help="seconds to keep a cached balance")
+    parser.add_argument("--keypool-size", default=keypool.KEYPOOL_SIZE,
+                        type=int, help="number of keypairs generated in advance")
+    parser.add_argument("--keypool-workers", default=keypool.KEYPOOL_WORKERS,
+                        type=int, help="processes generating keypairs")
+    parser.add_argument("--sign-workers", default=SIGN_WORKERS,
+                        type=int, help="processes signing batched transactions")
     args = parser.parse_args()
     port = args.port
     app.config["gw"] = args.gw
+    app.config["balance_cache_ttl"] = args.balance_cache_ttl
+    app.config["keypool_size"] = args.keypool_size
+    app.config["keypool_low_watermark"] = min(
+        keypool.KEYPOOL_LOW_WATERMARK, args.keypool_size // 4)
+    app.config["keypool_workers"] = args.keypool_workers
+    app.config["sign_workers"] = args.sign_workers
+    app.config["spv"] = args.spv
 
-    app.run(host="0.0.0.0", port=port, threaded=True, debug=True)
+    try:
+        app.run(host="0.0.0.0", port=port, threaded=True, debug=True)
+    finally:
+        shutdown()